@@ -0,0 +1,38 @@
+"""
+Бэкенд PostGIS с пулом соединений.
+
+Вместо открытия нового соединения на каждый запрос соединение берется из пула процесса
+и возвращается в него при закрытии (в конце запроса при CONN_MAX_AGE = 0).
+Настройки пула задаются ключом POOL в описании базы данных, см. pool.DEFAULTS.
+"""
+from django.contrib.gis.db.backends.postgis.base import DatabaseWrapper as PostGISDatabaseWrapper
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgreSQLDatabaseCreation
+
+from .pool import close_pools, get_pool
+
+
+class DatabaseCreation(PostgreSQLDatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Свободные соединения пула к тестовой базе не дадут ее удалить
+        close_pools(test_database_name)
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(PostGISDatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.get_connection_params(), self.settings_dict.get('POOL', {}))
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL', {}))
+        connection = pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # Для соединения из пула уровень изоляции уже настроен при его создании
+        self.isolation_level = self.settings_dict['OPTIONS'].get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection)
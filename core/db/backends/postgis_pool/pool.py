@@ -0,0 +1,234 @@
+"""
+Пул соединений psycopg2 для бэкенда postgis_pool.
+
+Пулы создаются отдельно в каждом процессе (после fork воркер получает свой пул)
+и для каждого набора параметров соединения. Пул потокобезопасен, но соединения Django
+принадлежат потоку: соединение возвращается в пул, только когда его закрывают в том же
+потоке. Обработчики запросов делают это по сигналу request_finished; код, работающий
+в других потоках (sync_to_async(thread_sensitive=False), фоновые потоки), должен сам
+вызывать connections.close_all(), иначе соединение остается выданным, и после MAX_SIZE
+таких потоков запросы ждут TIMEOUT секунд и получают PoolTimeout.
+"""
+import os
+import threading
+import time
+
+from psycopg2 import extensions
+
+
+DEFAULTS = {
+    # Максимальное число соединений процесса к базе (занятых и свободных)
+    'MAX_SIZE': 10,
+    # Сколько секунд ждать освобождения соединения, если все заняты
+    'TIMEOUT': 30,
+    # Проверять соединение запросом SELECT 1, если оно простаивало дольше HEALTH_CHECK_AFTER секунд
+    'HEALTH_CHECK': True,
+    'HEALTH_CHECK_AFTER': 5,
+    # Закрывать соединения, простаивающие дольше MAX_IDLE или живущие дольше MAX_LIFETIME секунд
+    'MAX_IDLE': 300,
+    'MAX_LIFETIME': 3600,
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _Entry:
+    __slots__ = ('connection', 'created_at', 'returned_at')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = self.returned_at = time.monotonic()
+
+
+class ConnectionPool:
+    def __init__(self, options):
+        self.options = {**DEFAULTS, **options}
+        self._condition = threading.Condition()
+        self._idle = []
+        # Соединение -> запись пула для выданных соединений
+        self._in_use = {}
+        self._size = 0
+        self.checkouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _expired(self, entry, now):
+        return (
+            entry.connection.closed
+            or now - entry.returned_at > self.options['MAX_IDLE']
+            or now - entry.created_at > self.options['MAX_LIFETIME']
+        )
+
+    def _healthy(self, entry, now):
+        if not self.options['HEALTH_CHECK'] or now - entry.returned_at < self.options['HEALTH_CHECK_AFTER']:
+            return True
+        try:
+            with entry.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not entry.connection.autocommit:
+                entry.connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry):
+        self.discarded += 1
+        try:
+            entry.connection.close()
+        except Exception:
+            pass
+
+    def getconn(self, connect):
+        """
+        Выдает свободное соединение либо создает новое функцией connect;
+        если пул заполнен, ждет освобождения не дольше TIMEOUT секунд
+        """
+        started = time.monotonic()
+        deadline = started + self.options['TIMEOUT']
+        while True:
+            entry = None
+            with self._condition:
+                while entry is None:
+                    now = time.monotonic()
+                    while self._idle:
+                        candidate = self._idle.pop()
+                        if self._expired(candidate, now):
+                            self._size -= 1
+                            self._discard(candidate)
+                            continue
+                        entry = candidate
+                        break
+                    if entry is not None:
+                        break
+                    if self._size < self.options['MAX_SIZE']:
+                        self._size += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout(f"No connection available within {self.options['TIMEOUT']}s (MAX_SIZE={self.options['MAX_SIZE']})")
+                    self._condition.wait(remaining)
+
+            if entry is None:
+                # Новое соединение создается вне блокировки
+                try:
+                    entry = _Entry(connect())
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                self.created += 1
+            elif not self._healthy(entry, time.monotonic()):
+                with self._condition:
+                    self._size -= 1
+                self._discard(entry)
+                continue
+
+            waited = time.monotonic() - started
+            with self._condition:
+                self._in_use[id(entry.connection)] = entry
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            return entry.connection
+
+    def putconn(self, connection):
+        """
+        Возвращает соединение в пул: незавершенная транзакция откатывается,
+        сломанные соединения закрываются
+        """
+        with self._condition:
+            entry = self._in_use.pop(id(connection), None)
+        if entry is None:
+            connection.close()
+            return
+        reusable = not connection.closed
+        if reusable and connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except Exception:
+                reusable = False
+            reusable = reusable and connection.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+        with self._condition:
+            if reusable:
+                entry.returned_at = time.monotonic()
+                self._idle.append(entry)
+            else:
+                self._size -= 1
+            self._condition.notify()
+        if not reusable:
+            self._discard(entry)
+
+    def close_idle(self):
+        """
+        Закрывает все свободные соединения
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size': self._size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'max_size': self.options['MAX_SIZE'],
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'discarded': self.discarded,
+                'timeouts': self.timeouts,
+                'wait_time_seconds': self.wait_time,
+                'max_wait_time_seconds': self.max_wait_time,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, options):
+    """
+    Пул текущего процесса для алиаса и параметров соединения
+    """
+    key = (os.getpid(), alias, tuple(sorted((name, str(value)) for name, value in conn_params.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(options)
+        return pool
+
+
+def close_pools(database_name=None):
+    """
+    Закрывает свободные соединения пулов процесса (всех либо к базе database_name)
+    """
+    with _pools_lock:
+        items = list(_pools.items())
+    for (pid, alias, params), pool in items:
+        if pid == os.getpid() and (database_name is None or ('database', str(database_name)) in params):
+            pool.close_idle()
+
+
+def pool_stats():
+    """
+    Метрики пулов текущего процесса по алиасам баз данных
+    """
+    stats = {}
+    with _pools_lock:
+        items = list(_pools.items())
+    for (pid, alias, params), pool in items:
+        if pid != os.getpid():
+            continue
+        alias_stats = stats.setdefault(alias, {})
+        for name, value in pool.stats().items():
+            alias_stats[name] = max(alias_stats.get(name, 0), value) if name.startswith('max_') else alias_stats.get(name, 0) + value
+    return stats
@@ -44,11 +44,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'main.replicas.ReplicaPinMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -75,13 +77,44 @@ WSGI_APPLICATION = 'core.wsgi.application'
 
 DATABASES = {
     'default': {
-         'ENGINE': 'django.contrib.gis.db.backends.postgis',
+         'ENGINE': 'core.db.backends.postgis_pool',
          'NAME': 'pik_gis',
          'USER': 'postgres',
          'PASSWORD' : 'postgres',
+         # Connections are returned to the pool at the end of each request
+         'CONN_MAX_AGE': 0,
+         # Per-process connection pool (see core/db/backends/postgis_pool/pool.py)
+         'POOL': {
+             'MAX_SIZE': 10,
+             'TIMEOUT': 30,
+             'HEALTH_CHECK': True,
+             'HEALTH_CHECK_AFTER': 5,
+             'MAX_IDLE': 300,
+             'MAX_LIFETIME': 3600,
+         },
     },
 }
 
+# Read replica for list/retrieve/point reads (see main.replicas). Locally it is the same
+# database; tests mirror it to default. Enable it in READ_REPLICAS['REPLICAS']
+DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['main.replicas.ReplicaRouter']
+
+READ_REPLICAS = {
+    'PRIMARY': 'default',
+    # alias -> weight, e.g. {'replica': 1}
+    'REPLICAS': {},
+    # 'weighted' (random by weight) or 'latency' (lowest smoothed query latency in this process)
+    'SELECTION': 'weighted',
+    # Clients read from the primary for this many seconds after a successful write: browsers
+    # by cookie, authenticated users (token clients without cookies) by a key in CACHE_ALIAS.
+    # Their next read may reach another worker, so with REPLICAS set CACHE_ALIAS must be a
+    # cache shared by all processes (LocMemCache or DummyCache raise ImproperlyConfigured)
+    'PIN_SECONDS': 10,
+    'CACHE_ALIAS': 'default',
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -125,6 +158,15 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': (
@@ -136,5 +178,143 @@ REST_FRAMEWORK = {
     ],
     'DEFAULT_RENDERER_CLASSES': [
     'rest_framework.renderers.JSONRenderer',
-    ]
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'main.pagination.PkCursorPagination',
+    'PAGE_SIZE': 100,
+}
+
+# In-process point-in-polygon index for /zones/point/ (see main/spatial_index.py)
+# Zone changes made by other processes (other workers, run_zone_jobs) reach a process's index
+# only when it is rebuilt, so point lookups may miss them for up to MAX_AGE seconds
+ZONE_POINT_INDEX = {
+    'ENABLED': False,
+    'NODE_CAPACITY': 16,
+    'REBUILD_THRESHOLD': 256,
+    'MAX_AGE': 300,
+}
+
+# Maximum number of coordinates accepted by POST /zones/points/
+ZONE_POINTS_BATCH_LIMIT = 1000
+
+# Response cache for /zones/point/ (see main/cache.py). Zone changes in any worker or in
+# manage.py run_zone_jobs must reach it, so it needs a cache shared by all processes;
+# enabling it on LocMemCache or DummyCache raises ImproperlyConfigured
+ZONE_POINT_CACHE = {
+    'ENABLED': False,
+    'CACHE_ALIAS': 'default',
+    'GRID': 0.00001,
+    'BUCKET': 0.1,
+    'MAX_BUCKETS': 1024,
+    'TIMEOUT': 300,
+}
+
+# Maximum number of services accepted by POST /services/bulk/
+SERVICE_BULK_LIMIT = 1000
+
+# Rows fetched per server-side cursor round trip by GET /zones/export/
+ZONE_EXPORT_CHUNK_SIZE = 2000
+
+# Per-user "managed providers and zones" cache used by permission checks (see main/access.py)
+# CROSS_REQUEST keeps it across requests; revocations must reach every worker, so it needs
+# a cache shared by all processes (LocMemCache or DummyCache raise ImproperlyConfigured)
+ACCESS_CACHE = {
+    'CROSS_REQUEST': False,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+# Async /zones/point/async/ endpoint: 'asyncpg' (requires the asyncpg package) or 'thread'
+ASYNC_POINT_LOOKUP = {
+    'DRIVER': 'thread',
+    'DATABASE': 'default',
+    'POOL_MIN_SIZE': 1,
+    'POOL_MAX_SIZE': 20,
+}
+
+# ST_Subdivide'd copies of zone geometries used for containment and overlap checks
+# (see main.models.ZonePiece). MAINTAIN keeps the table up to date on zone changes;
+# lookups switch to it only with ENABLED. Rollout: deploy, create the table with
+# manage.py migrate --run-syncdb (main has no migrations), run manage.py rebuild_zone_pieces
+# for the existing zones, then set ENABLED - lookups never see a half-filled table
+ZONE_PIECES = {
+    'ENABLED': False,
+    'MAINTAIN': True,
+    'MAX_VERTICES': 64,
+}
+
+# Deferred zone writes: POST/PUT/PATCH /zones/ with "Prefer: respond-async" answer 202 with
+# a job (see main.jobs), processed by manage.py run_zone_jobs. Rollout like ZONE_PIECES:
+# deploy, create the job table with manage.py migrate --run-syncdb, start manage.py
+# run_zone_jobs, then set ENABLED - until then the header is ignored and writes run inline
+ZONE_JOBS = {
+    'ENABLED': False,
+    'WORKERS': 2,
+    'POLL_INTERVAL': 1.0,
+}
+
+# Per service type coverage (main.models.ServiceCoverage) behind /services/availability/:
+# ST_Subdivide'd zone geometries with min/max service cost. MAINTAIN keeps it up to date
+# by signals; ENABLED answers from it (otherwise from zones and services directly).
+# Rollout like ZONE_PIECES: deploy, manage.py migrate --run-syncdb, run manage.py
+# rebuild_service_coverage, then enable
+SERVICE_COVERAGE = {
+    'ENABLED': False,
+    'MAINTAIN': True,
+    'MAX_VERTICES': 64,
+}
+
+# Limits of /zones/nearest/ (k closest zones) and /zones/within/ (zones within radius metres)
+ZONE_DISTANCE_LOOKUP = {
+    'DEFAULT_K': 10,
+    'MAX_K': 100,
+    'MAX_RADIUS': 50000,
+    'MAX_RESULTS': 1000,
+}
+
+# Vector tiles at /zones/tiles/<z>/<x>/<y>.mvt (see main/tiles.py)
+ZONE_TILES = {
+    'EXTENT': 4096,
+    'BUFFER': 64,
+    'MAX_ZOOM': 22,
+}
+
+# Tile cache (see main/tiles.py). Invalidation must reach every worker, so it needs a
+# cache shared by all processes (Redis, Memcached, database); enabling it on LocMemCache
+# or DummyCache raises ImproperlyConfigured
+ZONE_TILE_CACHE = {
+    'ENABLED': False,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 3600,
+    'MAX_ZOOM': 16,
+    'MAX_TILES': 256,
+}
+
+# Build zone list/point and service list responses from values() rows instead of
+# serializer objects (see main/fastread.py); the JSON output is the same
+API_FAST_READ = True
+
+# Per-endpoint request metrics (see main/metrics.py), Prometheus text at /metrics/
+REQUEST_METRICS = {
+    'ENABLED': True,
+    'SLOW_REQUEST_MS': 500,
+    'SLOW_QUERIES_LOGGED': 5,
+    'LOG_SAMPLE_RATE': 0.0,
+    # /metrics/ requires "Authorization: Bearer <TOKEN>" when TOKEN is set, otherwise it is
+    # served to ALLOWED_IPS only; behind a reverse proxy list it in TRUSTED_PROXIES so the
+    # client address is taken from X-Forwarded-For
+    'TOKEN': None,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+    'TRUSTED_PROXIES': [],
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main.metrics': {'handlers': ['console'], 'level': 'INFO'},
+        'main.jobs': {'handlers': ['console'], 'level': 'INFO'},
+    },
 }
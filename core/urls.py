@@ -16,14 +16,20 @@ Including another URLconf
 from django.contrib.gis import admin
 from django.urls import path
 from rest_framework.routers import DefaultRouter
-from main.views import ZoneViewSet, ProviderViewSet, ServiceViewSet
+from main.views import ZoneViewSet, ZoneJobViewSet, ProviderViewSet, ServiceViewSet
+from main.async_views import zones_point
+from main.metrics import metrics_view
 
 router = DefaultRouter()
 router.register('zones', ZoneViewSet)
 router.register('providers', ProviderViewSet)
 router.register('services', ServiceViewSet)
+router.register('zone-jobs', ZoneJobViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),    
+    path('zones/point/async/', zones_point, name='zone-point-async'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('zones/tiles/<int:z>/<int:x>/<int:y>.mvt', ZoneViewSet.as_view({'get': 'tiles'}), name='zone-tiles'),
 ]
 urlpatterns += router.urls
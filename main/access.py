@@ -0,0 +1,121 @@
+"""
+Кэш области управления пользователя: pk поставщиков, менеджером которых он является,
+и pk зон этих поставщиков.
+
+Область загружается одним запросом и хранится на объекте пользователя до конца запроса.
+С ACCESS_CACHE['CROSS_REQUEST'] она также кладется в кэш Django и переживает запрос;
+изменения поставщиков и зон сбрасывают ее через сигналы (main.signals). Сброс должен
+дойти до всех процессов - иначе отозванные права действовали бы до TIMEOUT, - поэтому
+межзапросный кэш допускается только общий (не LocMemCache и не DummyCache), а версии
+областей (общая и каждого пользователя) хранятся в нем же.
+"""
+import itertools
+import uuid
+
+from django.conf import settings
+
+from main.cache import get_versions, shared_cache
+
+
+DEFAULTS = {
+    'CROSS_REQUEST': False,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+    'KEY_PREFIX': 'managed-scope',
+}
+
+# Поколение областей, запомненных на объектах пользователей на время запроса: растет при
+# любом изменении поставщиков и зон в этом процессе, такие области перечитываются. Запрос
+# и его изменения выполняются в одном процессе; межзапросный кэш версионируется в общем кэше
+_generation = itertools.count(1)
+_current_generation = next(_generation)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ACCESS_CACHE', {})}
+
+
+class ManagedScope:
+    """
+    Поставщики и зоны под управлением пользователя
+    """
+    def __init__(self, provider_ids=(), zone_ids=()):
+        self.provider_ids = frozenset(provider_ids)
+        self.zone_ids = frozenset(zone_ids)
+
+
+EMPTY_SCOPE = ManagedScope()
+
+
+def as_pk(value):
+    """
+    Приводит значение pk из данных запроса к int, None - если это невозможно
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _cache():
+    return shared_cache(get_config()['CACHE_ALIAS'], "ACCESS_CACHE['CROSS_REQUEST']")
+
+
+def _key(*parts):
+    return ':'.join([get_config()['KEY_PREFIX'], *map(str, parts)])
+
+
+def _load(user):
+    from main.models import Provider
+
+    rows = Provider.objects.filter(manager=user).values_list('pk', 'zones__pk')
+    provider_ids, zone_ids = set(), set()
+    for provider_id, zone_id in rows:
+        provider_ids.add(provider_id)
+        if zone_id is not None:
+            zone_ids.add(zone_id)
+    return ManagedScope(provider_ids, zone_ids)
+
+
+def get_scope(user):
+    """
+    Область управления пользователя: не более одного запроса к базе на HTTP-запрос,
+    ни одного - при попадании в межзапросный кэш
+    """
+    if user is None or not user.is_authenticated:
+        return EMPTY_SCOPE
+    cached = getattr(user, '_managed_scope', None)
+    if cached is not None and cached[0] == _current_generation:
+        return cached[1]
+
+    config = get_config()
+    scope = None
+    if config['CROSS_REQUEST']:
+        cache = _cache()
+        key = _key('user', *get_versions(cache, [_key('generation'), _key('version', user.pk)]), user.pk)
+        scope = cache.get(key)
+        if scope is None:
+            scope = _load(user)
+            cache.set(key, scope, config['TIMEOUT'])
+    else:
+        scope = _load(user)
+    user._managed_scope = (_current_generation, scope)
+    return scope
+
+
+def invalidate(user_ids=None):
+    """
+    Сбрасывает области пользователей user_ids (None - всех пользователей)
+    """
+    global _current_generation
+    _current_generation = next(_generation)
+    if not get_config()['CROSS_REQUEST']:
+        return
+    cache = _cache()
+    if user_ids is None:
+        cache.set(_key('generation'), uuid.uuid4().hex, None)
+        return
+    # Новая версия, а не удаление ключа: область, которую параллельный запрос прочитал
+    # до изменения и положит в кэш после сброса, останется под прежней версией
+    version = uuid.uuid4().hex
+    cache.set_many({_key('version', user_id): version for user_id in user_ids}, None)
@@ -0,0 +1,247 @@
+"""
+Асинхронный вариант АПИ зон в точке для работы под ASGI (core/asgi.py).
+
+С ASYNC_POINT_LOOKUP['DRIVER'] = 'asyncpg' запросы к PostGIS выполняются асинхронным
+драйвером asyncpg через пул соединений процесса, и один процесс обслуживает тысячи
+одновременных запросов, не занимая потоков. Ответ, ETag/Last-Modified и кэш ответов
+(ZONE_POINT_CACHE) те же, что у zones/point; параметры вывода геометрии (geometry, simplify,
+precision, geometry_format) этот путь не поддерживает и отвечает на них 400.
+С драйвером 'thread' (по умолчанию, asyncpg не требуется) запрос передается синхронному
+ZoneViewSet.point в пул потоков.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from rest_framework.exceptions import ValidationError
+
+from main.access import as_pk
+from main.cache import point_cache
+from main.conditional import make_validators, set_validator_headers
+from main.fastread import build_zone_payloads
+from main.geometry import GeometryOptions, media_type_params
+from main.models import Provider, Service, ServiceType, Zone, ZonePiece, zone_pieces_enabled
+from main.spatial_index import zone_index
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+DEFAULTS = {
+    # asyncpg или thread
+    'DRIVER': 'thread',
+    # Алиас базы данных из settings.DATABASES, к которой подключается asyncpg
+    'DATABASE': 'default',
+    'POOL_MIN_SIZE': 1,
+    'POOL_MAX_SIZE': 20,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ASYNC_POINT_LOOKUP', {})}
+
+
+# Пулы asyncpg привязаны к циклу событий
+_pools = {}
+
+
+async def get_pool():
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        if asyncpg is None:
+            raise ImproperlyConfigured("ASYNC_POINT_LOOKUP['DRIVER'] = 'asyncpg' requires the asyncpg package")
+        config = get_config()
+        database = settings.DATABASES[config['DATABASE']]
+        pool = _pools[loop] = await asyncpg.create_pool(
+            host=database.get('HOST') or None,
+            port=int(database['PORT']) if database.get('PORT') else None,
+            user=database.get('USER') or None,
+            password=database.get('PASSWORD') or None,
+            database=database['NAME'],
+            min_size=config['POOL_MIN_SIZE'],
+            max_size=config['POOL_MAX_SIZE'],
+        )
+    return pool
+
+
+async def close_pool():
+    """
+    Закрывает пул asyncpg текущего цикла событий
+    """
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+def _tables():
+    return {
+        'zone': Zone._meta.db_table,
+        'provider': Provider._meta.db_table,
+        'service': Service._meta.db_table,
+        'service_type': ServiceType._meta.db_table,
+        'zone_piece': ZonePiece._meta.db_table,
+    }
+
+
+def zone_condition(longitude, latitude, provider_id=None, service_type_id=None):
+    """
+    Условие WHERE по зонам z в точке с фильтрами и его параметры для asyncpg
+    """
+    tables = _tables()
+    zone_ids = zone_index.lookup(longitude, latitude)
+    if zone_ids is None:
+        point = f"ST_SetSRID(ST_MakePoint($1, $2), {Zone._meta.get_field('mpoly').srid})"
+        if zone_pieces_enabled():
+            condition = f'z.id IN (SELECT zone_id FROM "{tables["zone_piece"]}" WHERE ST_Intersects(geom, {point}))'
+        else:
+            condition = f'ST_Contains(z.mpoly, {point})'
+        params = [longitude, latitude]
+    else:
+        condition = 'z.id = ANY($1::bigint[])'
+        params = [zone_ids]
+    if provider_id is not None:
+        params.append(provider_id)
+        condition += f' AND z.provider_id = ${len(params)}'
+    if service_type_id is not None:
+        params.append(service_type_id)
+        condition += f' AND EXISTS (SELECT 1 FROM "{tables["service"]}" fs WHERE fs.zone_id = z.id AND fs.service_type_id = ${len(params)})'
+    return condition, params
+
+
+async def fetch_validators(connection, condition, params, request):
+    """
+    ETag и Last-Modified зон в точке одним агрегирующим запросом, как у ZoneViewSet.validator_aggregates
+    """
+    tables = _tables()
+    row = await connection.fetchrow(f"""
+        SELECT count(DISTINCT z.id) AS "rows", max(z.updated_at) AS updated,
+            max(p.updated_at) AS providers_updated, max(t.updated_at) AS service_types_updated
+        FROM "{tables['zone']}" z JOIN "{tables['provider']}" p ON p.id = z.provider_id
+            LEFT JOIN "{tables['service']}" s ON s.zone_id = z.id
+            LEFT JOIN "{tables['service_type']}" t ON t.id = s.service_type_id
+        WHERE {condition}
+    """, *params)
+    return make_validators(dict(row), request, 'application/json')
+
+
+async def fetch_zone_payloads(connection, condition, params):
+    """
+    Зоны по условию zone_condition с поставщиками и услугами: два запроса через asyncpg
+    """
+    tables = _tables()
+    zone_rows = await connection.fetch(f"""
+        SELECT z.id, z.name, z.provider_id, ST_AsEWKB(z.mpoly) AS mpoly,
+            p.name AS provider_name, p.email, p.phone, p.address, p.manager_id
+        FROM "{tables['zone']}" z JOIN "{tables['provider']}" p ON p.id = z.provider_id
+        WHERE {condition}
+        ORDER BY z.id
+    """, *params)
+    service_rows = await connection.fetch(f"""
+        SELECT s.id, s.name, s.cost, s.zone_id, s.service_type_id, t.name AS service_type_name
+        FROM "{tables['service']}" s JOIN "{tables['service_type']}" t ON t.id = s.service_type_id
+        WHERE s.zone_id = ANY($1::bigint[])
+    """, [row['id'] for row in zone_rows])
+
+    zones = [
+        {'id': row['id'], 'name': row['name'], 'provider_id': row['provider_id'], 'mpoly': str(GEOSGeometry(bytes(row['mpoly'])))}
+        for row in zone_rows
+    ]
+    providers = [
+        {'id': row['provider_id'], 'name': row['provider_name'], 'email': row['email'],
+         'phone': row['phone'], 'address': row['address'], 'manager_id': row['manager_id']}
+        for row in zone_rows
+    ]
+    return build_zone_payloads(zones, providers, [dict(row) for row in service_rows])
+
+
+def _sync_point(request):
+    from main.views import ZoneViewSet
+
+    try:
+        response = ZoneViewSet.as_view({'get': 'point'})(request)
+        response.render()
+        return response
+    finally:
+        # В потоке исполнителя не срабатывает request_finished: соединения, открытые здесь,
+        # закрываем сами, иначе пул postgis_pool считает их выданными навсегда
+        connections.close_all()
+
+
+def _accept_params(request):
+    """
+    Параметры типов из заголовка Accept (geometry-format)
+    """
+    params = {}
+    for media_type in request.META.get('HTTP_ACCEPT', '').split(','):
+        params.update(media_type_params(media_type.strip()))
+    return params
+
+
+def _not_modified(request, validators):
+    etag, last_modified = validators
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    return None if response is None else set_validator_headers(response, validators)
+
+
+def _data_response(data, validators):
+    response = JsonResponse(data, safe=False, json_dumps_params={'ensure_ascii': False})
+    return set_validator_headers(response, validators)
+
+
+async def zones_point(request):
+    """
+    Асинхронное АПИ для получения всех зон, поставщиков и услуг в точке.
+    Параметры те же, что у zones/point: longitude, latitude и фильтры provider, services__service_type.
+    Путь asyncpg публичный (как объявлено для zones/point): аутентификация Django синхронна
+    """
+    if get_config()['DRIVER'] != 'asyncpg':
+        return await sync_to_async(_sync_point, thread_sensitive=False)(request)
+    try:
+        longitude = float(request.GET.get('longitude', '0'))
+        latitude = float(request.GET.get('latitude', '90'))
+    except ValueError:
+        return JsonResponse({'detail': 'longitude and latitude must be numbers'}, status=400)
+    filters = {}
+    for param, name in (('provider', 'provider_id'), ('services__service_type', 'service_type_id')):
+        if request.GET.get(param):
+            filters[name] = as_pk(request.GET[param])
+            if filters[name] is None:
+                return JsonResponse({param: ['Select a valid choice.']}, status=400)
+    try:
+        geometry_options = GeometryOptions.from_query_params(request.GET, _accept_params(request))
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    if not geometry_options.is_default:
+        return JsonResponse({'detail': 'geometry, simplify, precision and geometry_format are not supported '
+                                       'by the asyncpg driver, use zones/point/'}, status=400)
+
+    cache_key = None
+    if point_cache.enabled:
+        # Те же узлы сетки и ключи, что у zones/point: кэш общий для обоих АПИ
+        longitude, latitude = point_cache.snap(longitude, latitude)
+        params = request.GET.copy()
+        params['geometry_format'] = geometry_options.format
+        cache_key = await sync_to_async(point_cache.key, thread_sensitive=False)(longitude, latitude, params)
+        cached = await sync_to_async(point_cache.get, thread_sensitive=False)(cache_key)
+        if cached is not None:
+            data, validators = cached
+            return _not_modified(request, validators) or _data_response(data, validators)
+
+    condition, params = zone_condition(longitude, latitude, **filters)
+    async with (await get_pool()).acquire() as connection:
+        validators = await fetch_validators(connection, condition, params, request)
+        response = _not_modified(request, validators)
+        if response is not None:
+            return response
+        data = await fetch_zone_payloads(connection, condition, params)
+    if cache_key is not None:
+        await sync_to_async(point_cache.set, thread_sensitive=False)(cache_key, (data, validators))
+    return _data_response(data, validators)
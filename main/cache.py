@@ -0,0 +1,155 @@
+"""
+Кэш ответов /zones/point/ на базе кэш-фреймворка Django.
+
+Координаты запроса привязываются к сетке с шагом GRID градусов, ответ вычисляется
+для узла сетки и кэшируется по нему. Узлы сгруппированы в корзины размером BUCKET градусов,
+у каждой корзины есть своя версия, входящая в ключ кэша. При изменении зоны
+меняются версии только тех корзин, которые пересекают старый и новый охват зоны,
+поэтому остальные закэшированные ответы остаются действительными.
+
+Кэш должен быть общим для всех процессов (не LocMemCache и не DummyCache): сброс после
+изменения в одном процессе иначе не дошел бы до остальных. Версия, которой нет в кэше
+(еще не задана или вытеснена), заменяется новой случайной: с версией по умолчанию ключ
+вернулся бы к прежнему и отдал ответ, сохраненный до изменения, вместе с его ETag.
+"""
+import hashlib
+import math
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+
+
+DEFAULTS = {
+    'ENABLED': False,
+    # Алиас кэша из settings.CACHES
+    'CACHE_ALIAS': 'default',
+    # Шаг сетки привязки координат, градусы
+    'GRID': 0.00001,
+    # Размер корзины инвалидации, градусы
+    'BUCKET': 0.1,
+    # Если изменение задевает больше корзин, сбрасывается весь кэш
+    'MAX_BUCKETS': 1024,
+    # Время жизни ответа в секундах
+    'TIMEOUT': 300,
+    'KEY_PREFIX': 'zone-point',
+}
+
+# Параметры запроса, не влияющие на ключ (координаты входят в ключ отдельно)
+COORDINATE_PARAMS = ('longitude', 'latitude')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ZONE_POINT_CACHE', {})}
+
+
+def shared_cache(alias, setting):
+    """
+    Кэш alias из settings.CACHES; ImproperlyConfigured, если он виден только текущему процессу.
+    setting - имя настройки, которой нужен общий кэш (для сообщения об ошибке)
+    """
+    cache = caches[alias]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(f"{setting} requires a cache shared by all processes, CACHES['{alias}'] is not")
+    return cache
+
+
+def get_versions(cache, version_keys):
+    """
+    Текущие версии по ключам version_keys. Отсутствующая версия заменяется новой случайной;
+    add не перетирает версию, которую успел задать другой процесс
+    """
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            version = uuid.uuid4().hex
+            cache.add(key, version, None)
+            versions[key] = cache.get(key, version)
+    return [versions[key] for key in version_keys]
+
+
+class PointResponseCache:
+    """
+    Кэш сериализованных ответов на запрос зон в точке
+    """
+    @property
+    def config(self):
+        return get_config()
+
+    @property
+    def enabled(self):
+        config = self.config
+        if config['ENABLED']:
+            shared_cache(config['CACHE_ALIAS'], 'ZONE_POINT_CACHE')
+        return config['ENABLED']
+
+    @property
+    def cache(self):
+        return caches[self.config['CACHE_ALIAS']]
+
+    def _key(self, *parts):
+        return ':'.join([self.config['KEY_PREFIX'], *map(str, parts)])
+
+    def snap(self, longitude, latitude):
+        """
+        Привязывает координаты к ближайшему узлу сетки
+        """
+        grid = self.config['GRID']
+        return round(longitude / grid) * grid, round(latitude / grid) * grid
+
+    def _bucket(self, longitude, latitude):
+        bucket = self.config['BUCKET']
+        return math.floor(longitude / bucket), math.floor(latitude / bucket)
+
+    def _params_digest(self, query_params):
+        params = sorted((key, value) for key, values in query_params.lists() if key not in COORDINATE_PARAMS for value in values)
+        return hashlib.md5(repr(params).encode()).hexdigest()
+
+    def key(self, longitude, latitude, query_params):
+        """
+        Возвращает ключ ответа для привязанных к сетке координат и прочих параметров запроса.
+        В ключ входят текущие версии всего кэша и корзины, в которую попадает точка
+        """
+        bx, by = self._bucket(longitude, latitude)
+        generation, bucket_version = get_versions(self.cache, [self._key('generation'), self._key('bucket', bx, by)])
+        grid = self.config['GRID']
+        return self._key(
+            'response',
+            generation, bucket_version,
+            round(longitude / grid), round(latitude / grid),
+            self._params_digest(query_params),
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, data):
+        self.cache.set(key, data, self.config['TIMEOUT'])
+
+    def invalidate_extent(self, extent):
+        """
+        Делает недействительными ответы в корзинах, пересекающих охват (xmin, ymin, xmax, ymax)
+        """
+        xmin, ymin, xmax, ymax = extent
+        (bx_min, by_min), (bx_max, by_max) = self._bucket(xmin, ymin), self._bucket(xmax, ymax)
+        if (bx_max - bx_min + 1) * (by_max - by_min + 1) > self.config['MAX_BUCKETS']:
+            self.invalidate_all()
+            return
+        version = uuid.uuid4().hex
+        self.cache.set_many({
+            self._key('bucket', bx, by): version
+            for bx in range(bx_min, bx_max + 1)
+            for by in range(by_min, by_max + 1)
+        }, None)
+
+    def invalidate_all(self):
+        """
+        Делает недействительными все закэшированные ответы
+        """
+        self.cache.set(self._key('generation'), uuid.uuid4().hex, None)
+
+
+point_cache = PointResponseCache()
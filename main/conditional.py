@@ -0,0 +1,111 @@
+"""
+Условные запросы (If-None-Match, If-Modified-Since) к ресурсам на чтение.
+
+Валидаторы ответа вычисляются одним агрегирующим запросом по выборке ресурса: число строк
+и наибольшее время изменения (updated_at) самих сущностей и выводимых вместе с ними
+связанных сущностей. Геометрии при этом не загружаются. Если клиент прислал актуальный
+ETag или дату, отвечаем 304 Not Modified, не выполняя основного запроса.
+"""
+import hashlib
+import json
+
+from django.db.models import Count
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def make_validators(values, request, media_type, user_pk=None):
+    """
+    Пара (ETag, Last-Modified) из значений агрегатов выборки; ETag учитывает также путь
+    с параметрами, формат ответа и пользователя (если ответ от него зависит)
+    """
+    dates = [value for value in values.values() if hasattr(value, 'timestamp')]
+    last_modified = int(max(dates).timestamp()) if dates else None
+    seed = json.dumps([
+        sorted((name, str(value)) for name, value in values.items()),
+        request.get_full_path(), media_type, user_pk,
+    ])
+    etag = 'W/"%s"' % hashlib.sha1(seed.encode()).hexdigest()
+    return etag, last_modified
+
+
+def set_validator_headers(response, validators):
+    """
+    Выставляет ETag и Last-Modified ответу 200 или 304
+    """
+    if response.status_code in (200, 304):
+        etag, last_modified = validators
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+class ConditionalReadMixin:
+    """
+    Миксин вьюсета DRF: ETag и Last-Modified для действий conditional_actions.
+    validator_aggregates - агрегаты выборки ресурса, значения-даты участвуют в Last-Modified.
+    Действие вызывает not_modified(queryset) до выполнения основного запроса
+    """
+    conditional_actions = ('list', 'retrieve')
+    validator_aggregates = {}
+    # Ответ зависит от пользователя (а не только от выборки) - ETag учитывает пользователя
+    validators_vary_by_user = False
+
+    def get_validator_base_queryset(self):
+        return self.get_queryset()
+
+    def get_validator_queryset(self):
+        """
+        Выборка ресурса для вычисления валидаторов: с фильтрами запроса, без подгрузок и аннотаций
+        """
+        queryset = self.filter_queryset(self.get_validator_base_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return queryset
+
+    def get_validators(self, queryset):
+        """
+        Пара (ETag, Last-Modified) для выборки; ETag учитывает также путь с параметрами
+        и согласованный формат ответа
+        """
+        values = queryset.order_by().aggregate(rows=Count('pk', distinct=True), **self.validator_aggregates)
+        return make_validators(
+            values, self.request, getattr(self.request, 'accepted_media_type', ''),
+            self.request.user.pk if self.validators_vary_by_user else None,
+        )
+
+    def not_modified(self, queryset=None):
+        """
+        Ответ 304 (412 для If-Match), если у клиента актуальная версия ресурса, иначе None.
+        Валидаторы запоминаются и выставляются в заголовки ответа; повторный вызов ничего не делает
+        """
+        if self.request.method not in ('GET', 'HEAD') or self.action not in self.conditional_actions:
+            return None
+        if getattr(self, '_validators', None) is not None:
+            return None
+        if queryset is None:
+            queryset = self.get_validator_queryset()
+        return self.check_validators(self.get_validators(queryset))
+
+    def check_validators(self, validators):
+        """
+        Запоминает готовые валидаторы ответа и сверяет их с заголовками запроса
+        """
+        self._validators = validators
+        etag, last_modified = validators
+        return get_conditional_response(self.request, etag=etag, last_modified=last_modified)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        validators = getattr(self, '_validators', None)
+        if validators is not None:
+            set_validator_headers(response, validators)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.not_modified() or super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.not_modified() or super().retrieve(request, *args, **kwargs)
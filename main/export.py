@@ -0,0 +1,77 @@
+"""
+Потоковая выгрузка зон с услугами в GeoJSON/NDJSON.
+
+Каждый объект GeoJSON собирается базой данных (ST_AsGeoJSON, json_agg), строки читаются
+серверным курсором пачками, поэтому потребление памяти не зависит от размера таблицы.
+"""
+import json
+
+from django.contrib.gis.db.models.functions import AsGeoJSON
+from django.db.models import Value
+from django.db.models.expressions import RawSQL
+
+from main.models import Service, ServiceType, Zone
+
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+}
+
+
+def services_json():
+    """
+    Подзапрос, возвращающий услуги зоны JSON-массивом в текстовом виде
+    (так же, как их выводит ServiceSerializerRead, кроме стоимости - она числом)
+    """
+    zone_table, service_table, type_table = Zone._meta.db_table, Service._meta.db_table, ServiceType._meta.db_table
+    return RawSQL(f"""
+        SELECT coalesce(json_agg(json_build_object(
+            'id', s.id,
+            'service_type', json_build_object('id', t.id, 'name', t.name),
+            'name', s.name,
+            'cost', s.cost,
+            'zone', s.zone_id
+        ) ORDER BY s.id), '[]')::text
+        FROM "{service_table}" s JOIN "{type_table}" t ON t.id = s.service_type_id
+        WHERE s.zone_id = "{zone_table}".id
+    """, ())
+
+
+def iter_features(queryset, geometry_options, chunk_size):
+    """
+    Строки GeoJSON Feature для каждой зоны queryset
+    """
+    if geometry_options.mode == 'none':
+        geometry = Value(None)
+    else:
+        geometry = AsGeoJSON(geometry_options.expression(), precision=9 if geometry_options.precision is None else geometry_options.precision)
+    rows = (
+        queryset
+        .order_by('pk')
+        .annotate(geometry_json=geometry, services_json=services_json())
+        .values_list('pk', 'name', 'provider_id', 'geometry_json', 'services_json')
+        .iterator(chunk_size=chunk_size)
+    )
+    for pk, name, provider_id, geometry, services in rows:
+        yield (
+            f'{{"type":"Feature","id":{pk},"geometry":{geometry or "null"},'
+            f'"properties":{{"name":{json.dumps(name, ensure_ascii=False)},"provider":{provider_id},"services":{services}}}}}'
+        )
+
+
+def stream_zones(queryset, geometry_options, fmt, chunk_size):
+    """
+    Выгрузка в формате fmt: ndjson - по объекту на строку, geojson - FeatureCollection
+    """
+    features = iter_features(queryset, geometry_options, chunk_size)
+    if fmt == 'ndjson':
+        for feature in features:
+            yield feature + '\n'
+        return
+    yield '{"type":"FeatureCollection","features":['
+    separator = ''
+    for feature in features:
+        yield separator + feature
+        separator = ',\n'
+    yield ']}\n'
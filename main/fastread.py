@@ -0,0 +1,125 @@
+"""
+Сборка ответа о зонах и услугах напрямую из строк выборки, без объектов сериалайзеров.
+Результат совпадает с выводом ZoneSerializerRead и ServiceSerializerRead
+(см. тест на совпадение в main/tests.py).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import F
+
+from main.geometry import GEOMETRY_ANNOTATION
+from main.models import Service
+
+
+COST_QUANTUM = Decimal('0.01')
+
+# Поля поставщика в выборке зон
+PROVIDER_LOOKUPS = {
+    'id': 'provider_id',
+    'name': 'provider__name',
+    'email': 'provider__email',
+    'phone': 'provider__phone',
+    'address': 'provider__address',
+    'manager_id': 'provider__manager_id',
+}
+
+
+def service_payload(row):
+    return {
+        'id': row['id'],
+        'service_type': {'id': row['service_type_id'], 'name': row['service_type_name']},
+        'name': row['name'],
+        'cost': str(Decimal(row['cost']).quantize(COST_QUANTUM)),
+        'zone': row['zone_id'],
+    }
+
+
+def service_payloads(rows):
+    return [service_payload(row) for row in rows]
+
+
+def availability_payload(row):
+    return {
+        'service_type': row['service_type_id'],
+        'min_cost': str(Decimal(row['min_cost']).quantize(COST_QUANTUM)),
+        'max_cost': str(Decimal(row['max_cost']).quantize(COST_QUANTUM)),
+        'providers': row['providers'],
+        'zones': row['zones'],
+    }
+
+
+def availability_payloads(rows):
+    return [availability_payload(row) for row in rows]
+
+
+def provider_payload(row):
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'email': row['email'],
+        'phone': row['phone'],
+        'address': row['address'],
+        'manager': row['manager_id'],
+    }
+
+
+def build_zone_payloads(zone_rows, provider_rows, service_rows):
+    """
+    zone_rows - словари id, name, provider_id и mpoly (уже в текстовом виде; без ключа - зона без геометрии),
+    provider_rows - словари полей поставщика, service_rows - словари полей услуги
+    с service_type_name. Порядок зон сохраняется, услуги выводятся по возрастанию pk
+    """
+    providers = {row['id']: provider_payload(row) for row in provider_rows}
+    services = defaultdict(list)
+    for row in sorted(service_rows, key=lambda row: row['id']):
+        services[row['zone_id']].append(service_payload(row))
+    payloads = []
+    for row in zone_rows:
+        payload = {
+            'id': row['id'],
+            'services': services.get(row['id'], []),
+            'provider': providers[row['provider_id']],
+            'name': row['name'],
+        }
+        if 'mpoly' in row:
+            payload['mpoly'] = row['mpoly']
+        payloads.append(payload)
+    return payloads
+
+
+def service_values(queryset):
+    """
+    values()-выборка услуг с наименованием типа услуги
+    """
+    return queryset.values('id', 'name', 'cost', 'zone_id', 'service_type_id', service_type_name=F('service_type__name'))
+
+
+def zone_values(queryset, geometry_options):
+    """
+    values()-выборка зон с полями поставщика (одним соединением) и выводимой геометрией
+    согласно параметрам geometry_options (queryset уже должен быть обработан GeometryOptions.apply)
+    """
+    fields = ['id', 'name', *PROVIDER_LOOKUPS.values()]
+    if geometry_options.mode != 'none':
+        fields.append('mpoly' if geometry_options.is_default else GEOMETRY_ANNOTATION)
+    return queryset.values(*fields)
+
+
+def zone_payloads_from_rows(zone_rows):
+    """
+    Ответ о зонах из строк zone_values: услуги зон загружаются еще одним запросом
+    """
+    zones, providers = [], {}
+    for row in zone_rows:
+        zone = {'id': row['id'], 'name': row['name'], 'provider_id': row['provider_id']}
+        if 'mpoly' in row:
+            # Как ModelField сериалайзера: строковое представление значения поля
+            zone['mpoly'] = str(row['mpoly'])
+        elif GEOMETRY_ANNOTATION in row:
+            zone['mpoly'] = str(row[GEOMETRY_ANNOTATION]) if row[GEOMETRY_ANNOTATION] is not None else None
+        zones.append(zone)
+        if row['provider_id'] not in providers:
+            providers[row['provider_id']] = {name: row[lookup] for name, lookup in PROVIDER_LOOKUPS.items()}
+    services = service_values(Service.objects.filter(zone_id__in=[zone['id'] for zone in zones])) if zones else []
+    return build_zone_payloads(zones, providers.values(), services)
@@ -0,0 +1,168 @@
+"""
+Потоковое чтение GeoJSON и приведение геометрий к MultiPolygon.
+
+Файлы с сотнями тысяч объектов не загружаются в память целиком: FeatureCollection
+разбирается по одному объекту из массива features, NDJSON - по одной строке.
+"""
+import json
+import math
+
+from django.contrib.gis.geos import GEOSGeometry, GeometryCollection, MultiPolygon, Polygon
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+class GeoJSONStreamError(ValueError):
+    pass
+
+
+class _Reader:
+    """
+    Буфер над текстовым потоком: дочитывает данные по мере надобности
+    и отбрасывает уже разобранную часть
+    """
+    whitespace = ' \t\n\r'
+
+    def __init__(self, stream, chunk_size, max_value_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_value_size = max_value_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Первый значащий символ после пробелов (без сдвига позиции), '' в конце потока
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise GeoJSONStreamError(f'Expected {char!r} at offset {self.pos}')
+        self.pos += 1
+
+    def value(self):
+        """
+        Разбирает очередное JSON-значение, при необходимости дочитывая поток
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as exc:
+                if len(self.buffer) - self.pos > self.max_value_size:
+                    raise GeoJSONStreamError(f'JSON value exceeds {self.max_value_size} characters')
+                if not self.fill():
+                    raise GeoJSONStreamError(str(exc))
+                continue
+            # Значение в самом конце буфера могло быть обрезано (например, число)
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_feature_collection(stream, chunk_size=DEFAULT_CHUNK_SIZE, max_feature_size=64 * DEFAULT_CHUNK_SIZE):
+    """
+    Последовательно возвращает объекты массива features из GeoJSON FeatureCollection
+    """
+    reader = _Reader(stream, chunk_size, max_feature_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ']':
+                        reader.pos += 1
+                        break
+                    reader.expect(',')
+        else:
+            # Прочие члены коллекции (type, crs, bbox...) пропускаем
+            reader.value()
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
+
+
+def iter_ndjson(stream):
+    """
+    Последовательно возвращает объекты из NDJSON (по одному на строку)
+    """
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            raise GeoJSONStreamError(f'Line {number}: {exc}')
+
+
+def make_valid(geom, using=DEFAULT_DB_ALIAS):
+    """
+    Исправляет невалидную геометрию в PostGIS (ST_MakeValid) и оставляет только полигональные части.
+    В отличие от buffer(0) части самопересекающегося контура не теряются
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT ST_AsEWKB(ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_GeomFromEWKB(%s)), 3)))',
+            [memoryview(geom.ewkb)],
+        )
+        return GEOSGeometry(cursor.fetchone()[0])
+
+
+def to_multipolygon(geometry, srid=4326, using=DEFAULT_DB_ALIAS, report=None):
+    """
+    Превращает геометрию GeoJSON в корректный MultiPolygon:
+    невалидные геометрии исправляются (make_valid), полигоны из коллекций собираются вместе.
+    report - функция, получающая сообщение, если при исправлении изменилась площадь
+    """
+    if not geometry:
+        raise ValueError('Feature has no geometry')
+    geom = GEOSGeometry(json.dumps(geometry))
+    if geom.srid is None:
+        geom.srid = srid
+    if not geom.valid:
+        area = geom.area
+        geom = make_valid(geom, using)
+        if report is not None and not math.isclose(area, geom.area, rel_tol=1e-9, abs_tol=1e-12):
+            report(f'invalid geometry repaired, area changed from {area:.6g} to {geom.area:.6g}')
+    polygons = []
+    stack = [geom]
+    while stack:
+        part = stack.pop()
+        if isinstance(part, Polygon):
+            if not part.empty:
+                polygons.append(part)
+        elif isinstance(part, (MultiPolygon, GeometryCollection)):
+            stack.extend(reversed(list(part)))
+    if not polygons:
+        raise ValueError(f'{geom.geom_type} has no polygonal parts')
+    return MultiPolygon(*polygons, srid=geom.srid)
@@ -0,0 +1,138 @@
+"""
+Управление представлением геометрии зон в ответах на чтение.
+
+Параметры запроса:
+geometry - full (по умолчанию), bbox (только ограничивающий прямоугольник) или none (без геометрии)
+simplify - допуск упрощения в единицах СК зоны (градусах), ST_SimplifyPreserveTopology
+precision - число знаков после запятой в координатах, ST_SnapToGrid
+geometry_format - wkt (по умолчанию, EWKT), wkb (ST_AsBinary) или twkb (ST_AsTWKB);
+    двоичные форматы выводятся шестнадцатеричной строкой. Формат можно также запросить
+    параметром типа в заголовке Accept: application/json; geometry-format=twkb
+
+Все преобразования выполняются в базе данных: полная геометрия не загружается в Python,
+если она не нужна в ответе.
+"""
+import math
+
+from django.contrib.gis.db.models.functions import AsWKB, Envelope, GeoFunc, GeomOutputGeoFunc, SnapToGrid
+from django.db.models import BinaryField, CharField, Func
+from django.http.multipartparser import parse_header
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import ValidationError
+
+
+GEOMETRY_MODES = ('full', 'bbox', 'none')
+GEOMETRY_FORMATS = ('wkt', 'wkb', 'twkb')
+MAX_PRECISION = 15
+# Знаков после запятой в TWKB, если precision не задан (около сантиметра для градусов)
+DEFAULT_TWKB_PRECISION = 7
+# Параметр типа в заголовке Accept
+FORMAT_MEDIA_PARAM = 'geometry-format'
+
+# Имя аннотации с преобразованной геометрией
+GEOMETRY_ANNOTATION = 'mpoly_view'
+
+
+class SimplifyPreserveTopology(GeomOutputGeoFunc):
+    function = 'ST_SimplifyPreserveTopology'
+
+
+class AsTWKB(GeoFunc):
+    function = 'ST_AsTWKB'
+    output_field = BinaryField()
+
+
+class HexEncode(Func):
+    template = "encode(%(expressions)s, 'hex')"
+    output_field = CharField()
+
+
+def media_type_params(media_type):
+    """
+    Параметры типа из заголовка: application/json; geometry-format=twkb -> {'geometry-format': 'twkb'}
+    """
+    if not media_type:
+        return {}
+    _type, params = parse_header(media_type.encode('latin-1', 'replace'))
+    # parse_header в Django 3.2 возвращает значения параметров байтами
+    return {name: value.decode('latin-1') if isinstance(value, bytes) else value for name, value in params.items()}
+
+
+class GeometryOptions:
+    """
+    Параметры вывода геометрии зон, полученные из запроса
+    """
+    def __init__(self, mode='full', simplify=None, precision=None, format='wkt'):
+        self.mode = mode
+        self.simplify = simplify
+        self.precision = precision
+        self.format = format
+
+    @classmethod
+    def from_query_params(cls, query_params, media_params=None):
+        """
+        media_params - параметры согласованного типа ответа; geometry_format из запроса важнее
+        """
+        fmt = query_params.get('geometry_format') or (media_params or {}).get(FORMAT_MEDIA_PARAM, 'wkt')
+        if fmt not in GEOMETRY_FORMATS:
+            raise ValidationError({'geometry_format': _('Expected one of: %(formats)s') % {'formats': ', '.join(GEOMETRY_FORMATS)}})
+        mode = query_params.get('geometry', 'full')
+        if mode not in GEOMETRY_MODES:
+            raise ValidationError({'geometry': _('Expected one of: %(modes)s') % {'modes': ', '.join(GEOMETRY_MODES)}})
+        try:
+            simplify = float(query_params['simplify']) if 'simplify' in query_params else None
+        except ValueError:
+            simplify = -1
+        if simplify is not None and not (math.isfinite(simplify) and simplify >= 0):
+            raise ValidationError({'simplify': _('Expected a non-negative number')})
+        try:
+            precision = int(query_params['precision']) if 'precision' in query_params else None
+        except ValueError:
+            precision = -1
+        if precision is not None and not 0 <= precision <= MAX_PRECISION:
+            raise ValidationError({'precision': _('Expected an integer from 0 to %(max)s') % {'max': MAX_PRECISION}})
+        return cls(mode, simplify, precision, fmt)
+
+    @property
+    def is_default(self):
+        """
+        Геометрия выводится как есть, из поля mpoly
+        """
+        return self.mode == 'full' and not self.simplify and self.precision is None and self.format == 'wkt'
+
+    def expression(self):
+        """
+        Выражение для вычисления выводимой геометрии в базе данных
+        """
+        expression = 'mpoly'
+        if self.mode == 'bbox':
+            expression = Envelope(expression)
+        elif self.simplify:
+            expression = SimplifyPreserveTopology(expression, self.simplify)
+        # TWKB сам округляет координаты до заданного числа знаков
+        if self.precision is not None and self.format != 'twkb':
+            expression = SnapToGrid(expression, 10 ** -self.precision)
+        return expression
+
+    def output_expression(self):
+        """
+        Выражение для выводимой геометрии в формате format: геометрия либо шестнадцатеричная строка
+        """
+        expression = self.expression()
+        if self.format == 'wkb':
+            return HexEncode(AsWKB(expression))
+        if self.format == 'twkb':
+            precision = DEFAULT_TWKB_PRECISION if self.precision is None else self.precision
+            return HexEncode(AsTWKB(expression, precision))
+        return expression
+
+    def apply(self, queryset):
+        """
+        Откладывает загрузку полной геометрии и добавляет аннотацию с преобразованной
+        """
+        if self.is_default:
+            return queryset
+        queryset = queryset.defer('mpoly')
+        if self.mode == 'none':
+            return queryset
+        return queryset.annotate(**{GEOMETRY_ANNOTATION: self.output_expression()})
@@ -0,0 +1,169 @@
+"""
+Отложенная обработка записи зон.
+
+Запрос на создание или изменение зоны с заголовком Prefer: respond-async сразу получает
+ответ 202 с заданием (ZoneJob); тяжелая часть - разбор и проверка геометрии, исправление
+невалидной геометрии ST_MakeValid, сохранение зоны с пересборкой фрагментов и покрытия,
+повторная проверка пересечений услуг зоны и сброс кэшей - выполняется воркерами
+manage.py run_zone_jobs.
+
+Очередь живет в базе: воркер забирает задание SELECT ... FOR UPDATE SKIP LOCKED и выполняет
+его в той же транзакции. Несколько воркеров не получают одно задание, а при падении воркера
+транзакция откатывается и задание снова оказывается в очереди.
+Внутрипроцессные индексы веб-процессов подтягивают изменения воркеров периодической
+перестройкой (ZONE_POINT_INDEX['MAX_AGE']), как и после импорта зон.
+"""
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, router, transaction
+from django.utils import timezone
+
+from main.geojson import make_valid
+from main.models import Zone, ZoneJob, find_service_conflicts, raise_service_conflict
+from main.serializers import ZoneSerializerWrite
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    # Число процессов run_zone_jobs по умолчанию
+    'WORKERS': 2,
+    # Пауза между опросами пустой очереди, секунды
+    'POLL_INTERVAL': 1.0,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ZONE_JOBS', {})}
+
+
+def respond_async(request):
+    """
+    Клиент просит обработать запрос отложенно (Prefer: respond-async, RFC 7240)
+    """
+    preferences = request.headers.get('Prefer', '')
+    return get_config()['ENABLED'] and 'respond-async' in (
+        preference.split(';')[0].strip().lower() for preference in preferences.split(',')
+    )
+
+
+def submit(action, user, data, zone=None):
+    """
+    Ставит запись зоны в очередь
+    """
+    # QueryDict формы приводится к обычному словарю
+    data = data.dict() if hasattr(data, 'dict') else dict(data)
+    return ZoneJob.objects.create(action=action, user=user, data=data, zone=zone)
+
+
+class JobFailed(Exception):
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def repair_geometry(value, using):
+    """
+    Исправляет невалидную геометрию (WKT, EWKT, HEX или GeoJSON) через ST_MakeValid,
+    оставляя только полигоны. Возвращает пару (значение, исправлено ли оно)
+    """
+    try:
+        geometry = GEOSGeometry(json.dumps(value) if isinstance(value, dict) else value)
+    except (GEOSException, TypeError, ValueError):
+        # Неразбираемое значение - ошибку вернет сериалайзер
+        return value, False
+    if geometry.valid:
+        return value, False
+    return make_valid(geometry, using).ewkt, True
+
+
+def check_service_overlaps(zone):
+    """
+    Повторная проверка пересечений услуг зоны с новой геометрией (одним запросом)
+    """
+    services = list(zone.services.values_list('pk', 'service_type_id'))
+    conflicts = find_service_conflicts(
+        [(zone.pk, service_type_id, pk) for pk, service_type_id in services], using=zone._state.db,
+    )
+    errors = {}
+    for (pk, _service_type_id), zone_names in zip(services, conflicts):
+        if zone_names:
+            try:
+                raise_service_conflict(zone_names)
+            except ValidationError as e:
+                errors[str(pk)] = e.message_dict
+    if errors:
+        raise JobFailed({'services': errors})
+
+
+def run_job(job, using):
+    """
+    Выполняет задание: исправление геометрии, проверка, сохранение зоны и проверка ее услуг.
+    Возвращает сохраненную зону, при ошибках проверки выбрасывает JobFailed
+    """
+    data = dict(job.data)
+    if 'mpoly' in data:
+        data['mpoly'], job.repaired = repair_geometry(data['mpoly'], using)
+    instance = None
+    if job.action != ZoneJob.CREATE:
+        instance = Zone.objects.using(using).select_for_update().filter(pk=job.zone_id).first()
+        if instance is None:
+            raise JobFailed({'zone': ['Zone does not exist']})
+    serializer = ZoneSerializerWrite(instance, data=data, partial=job.action == ZoneJob.PARTIAL_UPDATE)
+    if not serializer.is_valid():
+        raise JobFailed(serializer.errors)
+    zone = serializer.save()
+    if instance is not None:
+        check_service_overlaps(zone)
+    return zone
+
+
+def process_next(using=None):
+    """
+    Забирает и выполняет очередное задание; возвращает его либо None, если очередь пуста.
+    Изменения зоны фиксируются вместе с состоянием задания, при ошибке - откатываются
+    """
+    using = using or router.db_for_write(ZoneJob)
+    with transaction.atomic(using=using):
+        job = ZoneJob.objects.using(using).select_for_update(skip_locked=True).filter(
+            status=ZoneJob.PENDING,
+        ).order_by('pk').first()
+        if job is None:
+            return None
+        try:
+            with transaction.atomic(using=using):
+                zone = run_job(job, using)
+        except JobFailed as e:
+            job.status, job.errors = ZoneJob.FAILED, e.errors
+        except Exception:
+            logger.exception('Zone job %s failed', job.pk)
+            job.status, job.errors = ZoneJob.FAILED, {'detail': ['Internal error']}
+        else:
+            job.status, job.errors, job.zone = ZoneJob.DONE, None, zone
+        job.finished_at = timezone.now()
+        job.save(using=using)
+    return job
+
+
+def work(poll_interval=None, once=False):
+    """
+    Цикл воркера. once - выйти, как только очередь опустеет. Возвращает число выполненных заданий
+    """
+    if poll_interval is None:
+        poll_interval = get_config()['POLL_INTERVAL']
+    processed = 0
+    while True:
+        if process_next() is not None:
+            processed += 1
+            continue
+        if once:
+            return processed
+        # Как между HTTP-запросами: закрываем соединения с истекшим CONN_MAX_AGE или ошибкой
+        close_old_connections()
+        time.sleep(poll_interval)
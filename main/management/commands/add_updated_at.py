@@ -0,0 +1,43 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+
+class Command(BaseCommand):
+    help = (
+        'Столбцы updated_at (ETag и Last-Modified ответов) для существующей базы: '
+        'ALTER TABLE ... ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now() '
+        'для всех моделей main с этим полем. Выполнять до выкладки кода, который их читает. '
+        'По умолчанию только печатает SQL, --apply выполняет его'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true', help='Выполнить SQL, а не только напечатать')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Алиас базы данных')
+        parser.add_argument('--lock-timeout', default='5s',
+                            help='lock_timeout каждого ALTER TABLE, чтобы он не копил за собой очередь запросов')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        statements = self.statements(connection)
+        for sql in statements:
+            self.stdout.write(sql + ';')
+            if options['apply']:
+                # Каждая таблица - в своей транзакции: ACCESS EXCLUSIVE держится только на время ее ALTER
+                with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                    cursor.execute("SELECT set_config('lock_timeout', %s, true)", [options['lock_timeout']])
+                    cursor.execute(sql)
+        if options['apply']:
+            self.stdout.write(self.style.SUCCESS(f'{len(statements)} statements applied'))
+
+    def statements(self, connection):
+        qn = connection.ops.quote_name
+        statements = []
+        for model in apps.get_app_config('main').get_models():
+            if 'updated_at' not in {field.name for field in model._meta.concrete_fields}:
+                continue
+            column = qn(model._meta.get_field('updated_at').column)
+            # С PostgreSQL 11 значение по умолчанию now() вычисляется один раз и хранится
+            # в каталоге: таблица не переписывается, существующие строки получают время выкладки
+            statements.append(f'ALTER TABLE {qn(model._meta.db_table)} ADD COLUMN IF NOT EXISTS {column} timestamptz NOT NULL DEFAULT now()')
+        return statements
@@ -0,0 +1,267 @@
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from main.models import ServiceType, Zone
+from main.synthetic import DEFAULT_BBOX, generate
+from main.views import ServiceViewSet, ZoneViewSet
+
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(values, p):
+    """
+    Перцентиль p по методу ближайшего ранга для отсортированного списка values
+    """
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[min(rank, len(values)) - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеры производительности основных АПИ зон и услуг на синтетических данных: '
+        'перцентили задержки, число запросов к базе, размер ответа и пик выделенной памяти. '
+        'Данные создаются в транзакции, которая по умолчанию откатывается. '
+        'Результаты сохраняются в JSON (--output) и сравниваются с прошлым запуском (--compare)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--providers', type=int, default=10, help='Число поставщиков')
+        parser.add_argument('--zones', type=int, default=200, help='Число зон')
+        parser.add_argument('--services', type=int, default=1000, help='Число услуг')
+        parser.add_argument('--service-types', type=int, default=20, help='Число типов услуг')
+        parser.add_argument('--vertices', type=int, default=200, help='Среднее число вершин зоны')
+        parser.add_argument('--bbox', type=float, nargs=4, default=DEFAULT_BBOX, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора данных и запросов')
+        parser.add_argument('--requests', type=int, default=100, help='Число замеряемых запросов на АПИ')
+        parser.add_argument('--warmup', type=int, default=5, help='Число незамеряемых запросов на АПИ перед замером')
+        parser.add_argument('--alloc-samples', type=int, default=10, help='Число запросов на АПИ для замера памяти (tracemalloc)')
+        parser.add_argument('--batch-points', type=int, default=100, help='Число точек в пакетном запросе zones/points')
+        parser.add_argument('--only', nargs='+', help='Замерять только эти АПИ')
+        parser.add_argument('--output', help='Сохранить результаты в JSON-файл')
+        parser.add_argument('--compare', help='JSON-файл прошлого запуска для сравнения')
+        parser.add_argument('--keep', action='store_true', help='Не откатывать созданные данные')
+
+    def handle(self, *args, **options):
+        if options['providers'] < 1 or options['zones'] < 1:
+            raise CommandError('--providers and --zones must be positive')
+        self.options = options
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        # Данные не зафиксированы, поэтому внутрипроцессный индекс (строится в фоне другим
+        # соединением) и кэш ответов отключены: замеряется путь через базу
+        with override_settings(
+            ZONE_POINT_INDEX={**settings.ZONE_POINT_INDEX, 'ENABLED': False},
+            ZONE_POINT_CACHE={**settings.ZONE_POINT_CACHE, 'ENABLED': False},
+        ), transaction.atomic():
+            started = time.perf_counter()
+            self.data = generate(
+                providers=options['providers'], zones=options['zones'], services=options['services'],
+                service_types=options['service_types'], vertices=options['vertices'],
+                bbox=options['bbox'], seed=options['seed'],
+            )
+            self.stdout.write(f'Generated data in {time.perf_counter() - started:.1f}s')
+            results = {
+                'meta': self.meta(),
+                'dataset': self.data.summary(),
+                'endpoints': {},
+            }
+            for name, build in self.scenarios().items():
+                if options['only'] and name not in options['only']:
+                    continue
+                results['endpoints'][name] = self.run_scenario(name, build)
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        self.print_results(results, baseline)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+    def meta(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=settings.BASE_DIR).stdout.strip()
+        except OSError:
+            commit = ''
+        return {
+            'commit': commit or None,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'options': {name: self.options[name] for name in (
+                'providers', 'zones', 'services', 'service_types', 'vertices', 'bbox', 'seed',
+                'requests', 'warmup', 'alloc_samples', 'batch_points',
+            )},
+        }
+
+    def scenarios(self):
+        """
+        АПИ для замера: имя -> функция, строящая по генератору случайных чисел
+        (вьюху, запрос, именованные аргументы вьюхи). Подготовка запроса в замер не входит
+        """
+        factory = APIRequestFactory()
+        data = self.data
+        bbox = data.bbox
+
+        def random_point(rnd):
+            return rnd.uniform(bbox[0], bbox[2]), rnd.uniform(bbox[1], bbox[3])
+
+        def authenticated(request, rnd, user=None):
+            # Пользователь загружается заново для каждого запроса, как при аутентификации
+            user = User.objects.get(pk=(user or rnd.choice(data.users)).pk)
+            force_authenticate(request, user=user)
+            return request
+
+        def zones_list(rnd):
+            provider = rnd.choice(data.providers)
+            return ZoneViewSet.as_view({'get': 'list'}), authenticated(factory.get('/zones/', {'provider': provider.pk}), rnd), {}
+
+        def zones_list_page(rnd):
+            return ZoneViewSet.as_view({'get': 'list'}), authenticated(factory.get('/zones/'), rnd), {}
+
+        def zone_retrieve(rnd):
+            pk = rnd.choice(data.zone_ids)
+            return ZoneViewSet.as_view({'get': 'retrieve'}), authenticated(factory.get(f'/zones/{pk}/'), rnd), {'pk': pk}
+
+        def zones_point(rnd):
+            longitude, latitude = random_point(rnd)
+            request = factory.get('/zones/point/', {'longitude': longitude, 'latitude': latitude})
+            return ZoneViewSet.as_view({'get': 'point'}), authenticated(request, rnd), {}
+
+        def zones_points(rnd):
+            points = [random_point(rnd) for _ in range(self.options['batch_points'])]
+            request = factory.post('/zones/points/', {'points': points}, format='json')
+            return ZoneViewSet.as_view({'post': 'points'}), authenticated(request, rnd), {}
+
+        def services_list(rnd):
+            return ServiceViewSet.as_view({'get': 'list'}), authenticated(factory.get('/services/'), rnd), {}
+
+        def services_availability(rnd):
+            longitude, latitude = random_point(rnd)
+            request = factory.get('/services/availability/', {
+                'longitude': longitude, 'latitude': latitude, 'service_type': rnd.choice(data.service_types).pk,
+            })
+            return ServiceViewSet.as_view({'get': 'availability'}), authenticated(request, rnd), {}
+
+        def services_create(rnd):
+            # Новый тип услуги: проверка пересечений выполняется полностью, но конфликтов нет
+            zone = Zone.objects.defer('mpoly').select_related('provider').get(pk=rnd.choice(data.zone_ids))
+            service_type = ServiceType.objects.create(name='Замер')
+            request = factory.post('/services/', {
+                'name': 'Замер', 'zone': zone.pk, 'service_type': service_type.pk, 'cost': '100.00',
+            }, format='json')
+            return ServiceViewSet.as_view({'post': 'create'}), authenticated(request, rnd, zone.provider.manager), {}
+
+        return {
+            'zones-list': zones_list,
+            'zones-list-page': zones_list_page,
+            'zone-retrieve': zone_retrieve,
+            'zones-point': zones_point,
+            'zones-points': zones_points,
+            'services-list': services_list,
+            'services-availability': services_availability,
+            'services-create': services_create,
+        }
+
+    def execute(self, view, request, kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = view(request, **kwargs)
+            response.render()
+            elapsed = time.perf_counter() - started
+        return elapsed, len(queries), len(response.content), response.status_code
+
+    def run_scenario(self, name, build):
+        options = self.options
+        rnd = random.Random(f'{options["seed"]}-{name}')
+        for _ in range(options['warmup']):
+            self.execute(*build(rnd))
+
+        latencies, query_counts, sizes, errors = [], [], [], 0
+        for _ in range(options['requests']):
+            elapsed, query_count, size, status = self.execute(*build(rnd))
+            latencies.append(elapsed * 1000)
+            query_counts.append(query_count)
+            sizes.append(size)
+            errors += status >= 400
+
+        # Замер памяти отдельно: tracemalloc заметно замедляет выполнение
+        peaks = []
+        tracemalloc.start()
+        try:
+            for _ in range(options['alloc_samples']):
+                view, request, kwargs = build(rnd)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                self.execute(view, request, kwargs)
+                peaks.append((tracemalloc.get_traced_memory()[1] - before) / 1024)
+        finally:
+            tracemalloc.stop()
+
+        latencies.sort()
+        result = {
+            'requests': len(latencies),
+            'errors': errors,
+            'latency_ms': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'min': latencies[0] if latencies else None,
+                'max': latencies[-1] if latencies else None,
+                **{f'p{p}': percentile(latencies, p) for p in PERCENTILES},
+            },
+            'queries': {
+                'mean': sum(query_counts) / len(query_counts) if query_counts else None,
+                'max': max(query_counts, default=None),
+            },
+            'response_bytes_mean': sum(sizes) / len(sizes) if sizes else None,
+            'alloc_peak_kib': {
+                'mean': sum(peaks) / len(peaks) if peaks else None,
+                'max': max(peaks, default=None),
+            },
+        }
+        self.stdout.write(f'{name}: done')
+        return result
+
+    def print_results(self, results, baseline=None):
+        base = (baseline or {}).get('endpoints', {})
+
+        def change(value, old):
+            if old is None or value is None:
+                return ''
+            if not old:
+                return ' (n/a)'
+            return f' ({(value - old) / old * 100:+.0f}%)'
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'{"endpoint":<22}{"p50 ms":>18}{"p95 ms":>18}{"queries":>14}{"KiB out":>12}{"alloc KiB":>12}{"errors":>8}'
+        ))
+        for name, result in results['endpoints'].items():
+            old = base.get(name, {})
+            p50, p95 = result['latency_ms']['p50'], result['latency_ms']['p95']
+            queries = result['queries']['mean']
+            cells = [
+                f'{p50 or 0:.1f}{change(p50, old.get("latency_ms", {}).get("p50"))}',
+                f'{p95 or 0:.1f}{change(p95, old.get("latency_ms", {}).get("p95"))}',
+                f'{queries or 0:.1f}{change(queries, old.get("queries", {}).get("mean"))}',
+            ]
+            self.stdout.write(
+                f'{name:<22}{cells[0]:>18}{cells[1]:>18}{cells[2]:>14}'
+                f'{(result["response_bytes_mean"] or 0) / 1024:>12.1f}{result["alloc_peak_kib"]["mean"] or 0:>12.1f}{result["errors"]:>8}'
+            )
@@ -0,0 +1,96 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from main.models import Service, Zone
+
+
+class Command(BaseCommand):
+    help = (
+        'Индексы зон и услуг (Meta.indexes Zone и Service) для существующей базы: '
+        'CREATE INDEX CONCURRENTLY без блокировки записи и удаление ставших лишними индексов '
+        'внешних ключей и прежнего GiST-индекса mpoly. По умолчанию только печатает SQL, '
+        '--apply выполняет его. У приложения main нет миграций: таблицы, которых еще нет в базе '
+        '(фрагменты, покрытие, задания), вместе с их индексами создает manage.py migrate --run-syncdb'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true', help='Выполнить SQL, а не только напечатать')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Алиас базы данных')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        statements = self.create_statements(connection) + self.drop_statements(connection)
+        for sql in statements:
+            self.stdout.write(sql + ';')
+            if options['apply']:
+                # CONCURRENTLY не выполняется в транзакции: каждый оператор - в режиме autocommit
+                with connection.cursor() as cursor:
+                    cursor.execute(sql)
+        if options['apply']:
+            self.stdout.write(self.style.SUCCESS(f'{len(statements)} statements applied'))
+
+    def create_statements(self, connection):
+        qn = connection.ops.quote_name
+        zone, service = qn(Zone._meta.db_table), qn(Service._meta.db_table)
+
+        def column(model, name):
+            return qn(model._meta.get_field(name).column)
+
+        mpoly = column(Zone, 'mpoly')
+        # Те же индексы, что в Meta.indexes. Схема PostGIS в Django не передает параметры
+        # GiST-индекса геометрии (buffering, fillfactor), поэтому SQL написан явно
+        indexes = [
+            ('zone_mpoly_gist', f'{zone} USING gist ({mpoly}) WITH (buffering = on, fillfactor = 90)'),
+            ('zone_provider_id_idx', f'{zone} ({column(Zone, "provider")}, {column(Zone, "id")})'),
+            ('zone_mpoly_geog_gist', f'{zone} USING gist (({mpoly})::geography)'),
+            ('service_zone_type_idx', f'{service} ({column(Service, "zone")}, {column(Service, "service_type")})'),
+        ]
+        declared = {index.name for model in (Zone, Service) for index in model._meta.indexes}
+        if declared != {name for name, _definition in indexes}:
+            raise CommandError(f'Meta.indexes of Zone and Service ({", ".join(sorted(declared))}) are not covered by this command')
+        invalid = self.invalid_indexes(connection, [name for name, _definition in indexes])
+        statements = []
+        for name, definition in indexes:
+            # Прерванная сборка CONCURRENTLY оставляет невалидный индекс, IF NOT EXISTS его бы пропустил
+            if name in invalid:
+                statements.append(f'DROP INDEX CONCURRENTLY IF EXISTS {qn(name)}')
+            statements.append(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {qn(name)} ON {definition}')
+        return statements
+
+    def drop_statements(self, connection):
+        """
+        Одноколоночные индексы, которые покрывают новые составные и GiST-индексы
+        """
+        qn = connection.ops.quote_name
+        redundant = [
+            (Zone._meta.db_table, Zone._meta.get_field('provider').column, 'btree', 'zone_provider_id_idx'),
+            (Service._meta.db_table, Service._meta.get_field('zone').column, 'btree', 'service_zone_type_idx'),
+            (Zone._meta.db_table, Zone._meta.get_field('mpoly').column, 'gist', 'zone_mpoly_gist'),
+        ]
+        statements = []
+        with connection.cursor() as cursor:
+            for table, column, method, keep in redundant:
+                cursor.execute("""
+                    SELECT i.relname
+                    FROM pg_index x
+                    JOIN pg_class i ON i.oid = x.indexrelid
+                    JOIN pg_class t ON t.oid = x.indrelid
+                    JOIN pg_am am ON am.oid = i.relam
+                    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = x.indkey[0]
+                    WHERE t.relname = %s AND a.attname = %s AND am.amname = %s AND x.indnatts = 1
+                        AND x.indexprs IS NULL AND x.indpred IS NULL
+                        AND NOT x.indisprimary AND NOT x.indisunique AND i.relname <> %s
+                        AND pg_table_is_visible(t.oid)
+                    ORDER BY i.relname
+                """, [table, column, method, keep])
+                statements += [f'DROP INDEX CONCURRENTLY IF EXISTS {qn(name)}' for name, in cursor.fetchall()]
+        return statements
+
+    def invalid_indexes(self, connection, names):
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT i.relname
+                FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                WHERE i.relname = ANY(%s) AND NOT x.indisvalid AND pg_table_is_visible(i.oid)
+            """, [names])
+            return {name for name, in cursor.fetchall()}
@@ -0,0 +1,52 @@
+import json
+
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+
+from main.models import Service, Zone, ZonePiece
+
+
+class Command(BaseCommand):
+    help = (
+        'Печатает планы выполнения (EXPLAIN ANALYZE) для основных запросов к зонам и услугам. '
+        'Запустите до и после изменения индексов и сравните результаты (--output)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--longitude', type=float, help='Долгота точки (по умолчанию - внутри первой зоны)')
+        parser.add_argument('--latitude', type=float, help='Широта точки')
+        parser.add_argument('--no-analyze', action='store_true', help='Только план, без выполнения запросов')
+        parser.add_argument('--output', help='Сохранить планы в JSON-файл')
+
+    def handle(self, *args, **options):
+        zone = Zone.objects.order_by('pk').first()
+        if zone is None:
+            raise CommandError('There are no zones to build sample queries from')
+        if options['longitude'] is not None and options['latitude'] is not None:
+            point = Point(options['longitude'], options['latitude'], srid=4326)
+        else:
+            point = zone.mpoly.point_on_surface
+        service_type_id = Service.objects.filter(zone=zone).values_list('service_type_id', flat=True).first()
+
+        queries = {
+            'point': Zone.objects.filter(mpoly__contains=point),
+            'point_pieces': Zone.objects.filter(pk__in=ZonePiece.objects.filter(geom__intersects=point).values('zone_id')),
+            'point_by_provider': Zone.objects.filter(mpoly__contains=point, provider_id=zone.provider_id),
+            'intersects_by_provider': Zone.objects.filter(mpoly__intersects=zone.mpoly, provider_id=zone.provider_id),
+            'services_by_zones_and_type': Service.objects.filter(
+                zone__in=Zone.objects.filter(mpoly__intersects=zone.mpoly, provider_id=zone.provider_id),
+                service_type_id=service_type_id,
+            ),
+            'provider_zones_page': Zone.objects.filter(provider_id=zone.provider_id).order_by('id')[:50],
+        }
+        analyze = not options['no_analyze']
+        plans = {}
+        for name, queryset in queries.items():
+            plan = queryset.explain(analyze=analyze, buffers=analyze) if analyze else queryset.explain()
+            plans[name] = plan
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(plan + '\n')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(plans, f, ensure_ascii=False, indent=2)
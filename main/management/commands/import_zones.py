@@ -0,0 +1,140 @@
+import json
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from main.geojson import DEFAULT_CHUNK_SIZE, GeoJSONStreamError, iter_feature_collection, iter_ndjson, to_multipolygon
+from main.models import Provider, Zone
+from main.signals import zones_changed_in_bulk
+
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl', '.geojsonl', '.geojsons')
+
+
+class Command(BaseCommand):
+    help = (
+        'Потоковый импорт зон обслуживания из GeoJSON FeatureCollection или NDJSON. '
+        'Геометрии исправляются и приводятся к MultiPolygon, зоны вставляются пачками; '
+        'с --state-file импорт можно продолжить с места остановки'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Путь к файлу, '-' - стандартный ввод")
+        parser.add_argument('--format', choices=['geojson', 'ndjson'], help='Формат файла (по умолчанию - по расширению)')
+        parser.add_argument('--provider', type=int, help='pk поставщика для объектов без свойства поставщика')
+        parser.add_argument('--provider-property', default='provider', help='Свойство объекта с pk поставщика')
+        parser.add_argument('--name-property', default='name', help='Свойство объекта с наименованием зоны')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Число зон в одной транзакции')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Размер блока чтения файла, символов')
+        parser.add_argument('--max-feature-size', type=int, default=64 * DEFAULT_CHUNK_SIZE, help='Максимальный размер одного объекта, символов')
+        parser.add_argument('--state-file', help='Файл с числом обработанных объектов для продолжения импорта')
+        parser.add_argument('--max-errors', type=int, default=None, help='Прервать импорт после стольких ошибочных объектов')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('ndjson' if path.lower().endswith(NDJSON_EXTENSIONS) else 'geojson')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        self.options = options
+        self.skip = self.load_state()
+        self.processed = self.inserted = self.errors = self.repairs = 0
+        self.started = time.monotonic()
+
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8')
+        try:
+            if fmt == 'ndjson':
+                features = iter_ndjson(stream)
+            else:
+                features = iter_feature_collection(stream, options['chunk_size'], options['max_feature_size'])
+            batch = []
+            for feature in features:
+                self.processed += 1
+                if self.processed <= self.skip:
+                    continue
+                zone = self.build_zone(feature)
+                if zone is not None:
+                    batch.append(zone)
+                if len(batch) >= options['batch_size']:
+                    self.flush(batch)
+                    batch = []
+            self.flush(batch)
+        except GeoJSONStreamError as exc:
+            raise CommandError(f'Failed to parse {path}: {exc}')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.report(final=True)
+
+    def build_zone(self, feature):
+        """
+        Строит несохраненную зону из объекта GeoJSON либо учитывает ошибку и возвращает None
+        """
+        try:
+            properties = feature.get('properties') or {}
+            provider_id = properties.get(self.options['provider_property'], self.options['provider'])
+            if provider_id is None:
+                raise ValueError('Feature has no provider')
+            name = properties.get(self.options['name_property']) or f'Zone {self.processed}'
+            mpoly = to_multipolygon(feature.get('geometry'), report=self.repaired)
+            return Zone(name=str(name)[:250], provider_id=int(provider_id), mpoly=mpoly)
+        except Exception as exc:
+            self.error(f'{exc}')
+
+    def flush(self, batch):
+        """
+        Сохраняет пачку зон одной транзакцией и фиксирует прогресс
+        """
+        if batch:
+            known = set(Provider.objects.filter(pk__in={zone.provider_id for zone in batch}).values_list('pk', flat=True))
+            for zone in batch:
+                if zone.provider_id not in known:
+                    self.error(f'Provider {zone.provider_id} does not exist (zone "{zone.name}")')
+            batch = [zone for zone in batch if zone.provider_id in known]
+            with transaction.atomic():
+                Zone.objects.bulk_create(batch)
+                zones_changed_in_bulk([zone.pk for zone in batch])
+            self.inserted += len(batch)
+        # Состояние пишется после фиксации: при сбое между ними пачка будет загружена повторно, но не потеряна
+        if self.processed > self.skip:
+            self.save_state()
+        self.report()
+
+    def repaired(self, message):
+        # Зона загружается, но ее площадь отличается от исходной - сообщаем об этом
+        self.repairs += 1
+        self.stderr.write(f'Feature {self.processed}: {message}')
+
+    def error(self, message):
+        self.errors += 1
+        self.stderr.write(f'Feature {self.processed}: {message}')
+        if self.options['max_errors'] is not None and self.errors > self.options['max_errors']:
+            raise CommandError(f'More than {self.options["max_errors"]} invalid features, import stopped')
+
+    def load_state(self):
+        state_file = self.options['state_file']
+        if not state_file or not os.path.exists(state_file):
+            return 0
+        with open(state_file) as f:
+            processed = json.load(f)['processed']
+        self.stdout.write(f'Resuming after {processed} features')
+        return processed
+
+    def save_state(self):
+        state_file = self.options['state_file']
+        if not state_file:
+            return
+        # Пишем во временный файл и переименовываем, чтобы не оставить его поврежденным
+        tmp_file = f'{state_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'processed': self.processed}, f)
+        os.replace(tmp_file, state_file)
+
+    def report(self, final=False):
+        elapsed = time.monotonic() - self.started
+        rate = (self.processed - self.skip) / elapsed if elapsed else 0
+        message = f'{self.processed} features read, {self.inserted} zones inserted, {self.repairs} repaired with area change, {self.errors} errors, {rate:.0f} features/s'
+        self.stdout.write(self.style.SUCCESS(f'Done: {message}') if final else message)
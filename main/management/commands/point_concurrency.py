@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import json
+import random
+import statistics
+import time
+from urllib.parse import urlencode, urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+async def fetch(host, port, request_bytes):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(request_bytes)
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run(url, concurrency, requests, bbox, user=None, seed=1):
+    """
+    Отправляет requests запросов в точки, случайные в bbox, concurrency одновременными клиентами
+    """
+    parts = urlsplit(url)
+    headers = [f'Host: {parts.netloc}', 'Connection: close']
+    if user:
+        headers.append('Authorization: Basic ' + base64.b64encode(user.encode()).decode())
+    rnd = random.Random(seed)
+    latencies, errors = [], 0
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        query = urlencode({
+            'longitude': rnd.uniform(bbox[0], bbox[2]),
+            'latitude': rnd.uniform(bbox[1], bbox[3]),
+        })
+        queue.put_nowait(f'GET {parts.path}?{query} HTTP/1.1\r\n' + '\r\n'.join(headers) + '\r\n\r\n')
+
+    async def client():
+        nonlocal errors
+        while not queue.empty():
+            request = queue.get_nowait().encode()
+            started = time.perf_counter()
+            try:
+                status = await fetch(parts.hostname, parts.port or 80, request)
+            except OSError:
+                status = None
+            latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(quantiles[49] * 1000, 2),
+        'p95_ms': round(quantiles[94] * 1000, 2),
+        'p99_ms': round(quantiles[98] * 1000, 2),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочное сравнение синхронного (WSGI) и асинхронного (ASGI) АПИ зон в точке: '
+        'заданное число одновременных клиентов против каждого URL, пропускная способность '
+        'и перцентили задержки в JSON. Сервера запускаются отдельно, например '
+        '"gunicorn core.wsgi -w 4 -b :8000" и "uvicorn core.asgi:application --port 8001", затем '
+        'manage.py point_concurrency --url wsgi=http://127.0.0.1:8000/zones/point/ '
+        '--url asgi=http://127.0.0.1:8001/zones/point/async/ --concurrency 500 --requests 20000 --user user:password'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', action='append', required=True, help='имя=URL, можно указать несколько раз')
+        parser.add_argument('--concurrency', type=int, default=100, help='Число одновременных клиентов')
+        parser.add_argument('--requests', type=int, default=5000, help='Число запросов на URL')
+        parser.add_argument('--bbox', type=float, nargs=4, default=[37.3, 55.5, 37.9, 56.0],
+                            metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'), help='Область случайных точек')
+        parser.add_argument('--user', help='логин:пароль для Basic-аутентификации')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора точек')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < 2:
+            raise CommandError('--concurrency must be positive and --requests at least 2')
+        urls = []
+        for item in options['url']:
+            name, sep, url = item.partition('=')
+            if not sep or not name or urlsplit(url).scheme != 'http':
+                raise CommandError(f'Expected --url name=http://host:port/path, got {item!r}')
+            urls.append((name, url))
+        results = {}
+        for name, url in urls:
+            results[name] = asyncio.run(run(
+                url, options['concurrency'], options['requests'], options['bbox'],
+                user=options['user'], seed=options['seed'],
+            ))
+            self.stderr.write(f'{name}: {results[name]["rps"]} rps, {results[name]["errors"]} errors')
+        self.stdout.write(json.dumps(results, indent=2))
+
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import ServiceCoverage, Zone
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает покрытие типов услуг (таблицу ServiceCoverage) для всех либо указанных зон'
+
+    def add_arguments(self, parser):
+        parser.add_argument('zone_ids', nargs='*', type=int, help='pk зон (по умолчанию - все зоны)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Число зон в одной транзакции')
+
+    def handle(self, *args, **options):
+        zone_ids = options['zone_ids'] or list(Zone.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(zone_ids), batch_size):
+            batch = zone_ids[start:start + batch_size]
+            with transaction.atomic():
+                ServiceCoverage.objects.rebuild(batch)
+            self.stdout.write(f'{start + len(batch)} of {len(zone_ids)} zones')
+        self.stdout.write(self.style.SUCCESS(f'{ServiceCoverage.objects.count()} coverage pieces in total'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import Zone, ZonePiece
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает фрагменты геометрий зон (ST_Subdivide) для всех либо указанных зон'
+
+    def add_arguments(self, parser):
+        parser.add_argument('zone_ids', nargs='*', type=int, help='pk зон (по умолчанию - все зоны)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Число зон в одной транзакции')
+
+    def handle(self, *args, **options):
+        zone_ids = options['zone_ids'] or list(Zone.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+        for start in range(0, len(zone_ids), batch_size):
+            batch = zone_ids[start:start + batch_size]
+            with transaction.atomic():
+                ZonePiece.objects.rebuild(batch)
+            self.stdout.write(f'{start + len(batch)} of {len(zone_ids)} zones')
+        self.stdout.write(self.style.SUCCESS(f'{ZonePiece.objects.count()} pieces in total'))
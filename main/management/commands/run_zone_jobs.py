@@ -0,0 +1,49 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from main.jobs import get_config, work
+
+
+class Command(BaseCommand):
+    help = (
+        'Воркеры отложенной записи зон: выполняют задания ZoneJob из очереди в базе '
+        '(SELECT ... FOR UPDATE SKIP LOCKED) в нескольких локальных процессах'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Число процессов (по умолчанию ZONE_JOBS["WORKERS"])')
+        parser.add_argument('--poll-interval', type=float, default=None, help='Пауза между опросами пустой очереди, секунды')
+        parser.add_argument('--once', action='store_true', help='Выйти, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] if options['workers'] is not None else get_config()['WORKERS']
+        if workers < 1:
+            raise CommandError('--workers must be positive')
+        if workers == 1:
+            processed = work(options['poll_interval'], options['once'])
+            self.stdout.write(f'{processed} jobs processed')
+            return
+
+        # Дочерние процессы не должны разделять соединения с родителем - каждый откроет свое
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=work, args=(options['poll_interval'], options['once']), name=f'zone-jobs-{i}')
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {workers} workers')
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
+        failed = [process.name for process in processes if process.exitcode not in (0, None)]
+        if failed and options['once']:
+            raise CommandError(f'Workers failed: {", ".join(failed)}')
@@ -0,0 +1,432 @@
+"""
+Метрики АПИ по действиям вьюх: число SQL-запросов, время в базе, время сериализации,
+размер ответа и длительность запроса.
+
+MetricsMiddleware считает запросы к базе через execute_wrapper, подключенный к каждому
+соединению (в любом потоке, в том числе при вызове из асинхронной цепочки ASGI),
+MetricsMixin для вьюсетов DRF добавляет время сериализации (to_representation, сборка ответа
+из values()-строк без сериалайзеров и рендеринг). Потоковые ответы выполняют запросы к базе уже
+после выхода из middleware: их метрики дописываются по мере выдачи содержимого и записываются
+при закрытии ответа.
+Метрики копятся в памяти процесса и отдаются в текстовом формате Prometheus вьюхой
+metrics_view (доступ по токену REQUEST_METRICS['TOKEN'] либо, без токена, только с адресов
+ALLOWED_IPS); каждый воркер отдает свои метрики. Запросы дольше REQUEST_METRICS['SLOW_REQUEST_MS'] пишутся в лог
+main.metrics вместе с самыми медленными SQL-запросами, остальные - с вероятностью LOG_SAMPLE_RATE.
+"""
+import asyncio
+import bisect
+import contextvars
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+
+from core.db.backends.postgis_pool.pool import pool_stats
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': True,
+    # Запросы не быстрее этого порога (мс) пишутся в лог; None - не писать
+    'SLOW_REQUEST_MS': 500,
+    # Сколько самых медленных SQL-запросов приводить в логе медленного запроса
+    'SLOW_QUERIES_LOGGED': 5,
+    # Доля остальных запросов, которые пишутся в лог
+    'LOG_SAMPLE_RATE': 0.0,
+    # Токен для заголовка Authorization: Bearer <токен> (bearer_token в Prometheus).
+    # Если задан, доступ к метрикам только с ним, независимо от адреса
+    'TOKEN': None,
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],
+    # Адреса обратных прокси: для запросов от них адрес клиента берется из X-Forwarded-For
+    'TRUSTED_PROXIES': [],
+    # Границы корзин гистограммы длительности запроса, секунды
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'REQUEST_METRICS', {})}
+
+
+class RequestMetrics:
+    """
+    Метрики одного HTTP-запроса
+    """
+    def __init__(self, slow_queries_logged=0):
+        self.action = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.slow_queries_logged = slow_queries_logged
+        # Самые медленные запросы: пары (время, SQL) по возрастанию времени
+        self.slowest = []
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += elapsed
+            if self.slow_queries_logged and (len(self.slowest) < self.slow_queries_logged or elapsed > self.slowest[0][0]):
+                bisect.insort(self.slowest, (elapsed, sql))
+                del self.slowest[:-self.slow_queries_logged]
+
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+def current():
+    """
+    Метрики текущего запроса либо None, если они не собираются
+    """
+    return _current.get()
+
+
+def _execute_wrapper(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.execute_wrapper(execute, sql, params, many, context)
+
+
+def instrument(connection):
+    """
+    Подключает к соединению подсчет SQL-запросов в метрики текущего запроса (один раз).
+    Обертка ставится первой: execute_wrapper() других модулей снимает при выходе последнюю
+    """
+    if _execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _execute_wrapper)
+
+
+def _connection_created(sender, connection, **kwargs):
+    # Соединения потоков, в которых асинхронная цепочка выполняет синхронный код
+    instrument(connection)
+
+
+connection_created.connect(_connection_created)
+
+
+class _Series:
+    __slots__ = ('requests', 'queries', 'db_time', 'serialization_time', 'response_bytes', 'duration', 'buckets')
+
+    def __init__(self, bucket_count):
+        self.requests = self.queries = self.response_bytes = 0
+        self.db_time = self.serialization_time = self.duration = 0.0
+        self.buckets = [0] * bucket_count
+
+
+class Registry:
+    """
+    Накопленные метрики процесса по (endpoint, action, method, status)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, labels, metrics, duration, response_bytes, buckets):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _Series(len(buckets))
+            series.requests += 1
+            series.queries += metrics.queries
+            series.db_time += metrics.db_time
+            series.serialization_time += metrics.serialization_time
+            series.response_bytes += response_bytes
+            series.duration += duration
+            index = bisect.bisect_left(buckets, duration)
+            if index < len(buckets):
+                series.buckets[index] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def render(self, buckets):
+        """
+        Метрики в текстовом формате Prometheus
+        """
+        counters = [
+            ('api_requests_total', 'Number of API requests', lambda series: series.requests),
+            ('api_db_queries_total', 'SQL queries executed by API requests', lambda series: series.queries),
+            ('api_db_time_seconds_total', 'Time spent in SQL queries', lambda series: _float(series.db_time)),
+            ('api_serialization_seconds_total', 'Time spent serializing and rendering responses',
+             lambda series: _float(series.serialization_time)),
+            ('api_response_bytes_total', 'Response body size', lambda series: series.response_bytes),
+        ]
+        lines = []
+        with self._lock:
+            items = [(list(zip(LABELS, labels)), series) for labels, series in sorted(self._series.items())]
+            for name, help_text, value in counters:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                lines += [f'{name}{_labels(labels)} {value(series)}' for labels, series in items]
+
+            name = 'api_request_duration_seconds'
+            lines += [f'# HELP {name} API request duration', f'# TYPE {name} histogram']
+            for labels, series in items:
+                cumulative = 0
+                for bound, count in zip(buckets, series.buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels + [("le", _float(bound))])} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(labels + [("le", "+Inf")])} {series.requests}')
+                lines.append(f'{name}_sum{_labels(labels)} {_float(series.duration)}')
+                lines.append(f'{name}_count{_labels(labels)} {series.requests}')
+
+        # Пулы соединений бэкенда postgis_pool
+        pool_values = {}
+        for alias, stats in sorted(pool_stats().items()):
+            for name, value in stats.items():
+                pool_values.setdefault(name, []).append(f'db_pool_{name}{_labels([("database", alias)])} {_float(value)}')
+        for name, values in pool_values.items():
+            lines += [f'# HELP db_pool_{name} Connection pool {name.replace("_", " ")}', f'# TYPE db_pool_{name} gauge', *values]
+        return '\n'.join(lines) + '\n'
+
+
+LABELS = ('endpoint', 'action', 'method', 'status')
+
+
+def _float(value):
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+registry = Registry()
+
+
+class MetricsMiddleware:
+    """
+    Собирает метрики каждого запроса: число и время SQL-запросов всех соединений,
+    длительность и размер ответа. Метка endpoint - имя маршрута, action - действие вьюсета.
+    Работает и в синхронной (WSGI), и в асинхронной (ASGI) цепочке middleware
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Как у MiddlewareMixin: внешние middleware и обработчик ASGI ждут корутину
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        config = get_config()
+        if not config['ENABLED']:
+            return self.get_response(request)
+        metrics = self.start(config)
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            for connection in connections.all():
+                instrument(connection)
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.complete(config, request, response, metrics, started)
+
+    async def __acall__(self, request):
+        config = get_config()
+        if not config['ENABLED']:
+            return await self.get_response(request)
+        metrics = self.start(config)
+        # Синхронные части цепочки выполняются в потоках с копией контекста и видят metrics
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.complete(config, request, response, metrics, started)
+
+    def start(self, config):
+        return RequestMetrics(config['SLOW_QUERIES_LOGGED'] if config['SLOW_REQUEST_MS'] is not None else 0)
+
+    def complete(self, config, request, response, metrics, started):
+        if response.streaming:
+            # Содержимое (и запросы к базе для него) выдается после выхода из middleware
+            def finish(response_bytes):
+                self.finish(config, request, response, metrics, time.perf_counter() - started, response_bytes)
+            response.streaming_content = _MeteredContent(response.streaming_content, metrics, finish)
+        else:
+            self.finish(config, request, response, metrics, time.perf_counter() - started, len(response.content))
+        return response
+
+    def finish(self, config, request, response, metrics, duration, response_bytes):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match else 'unresolved'
+        action = metrics.action or request.method.lower()
+        registry.observe((endpoint, action, request.method, str(response.status_code)), metrics, duration, response_bytes, config['BUCKETS'])
+        self.log(config, request, response, metrics, endpoint, action, duration, response_bytes)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = current()
+        if metrics is not None:
+            # Вьюсеты DRF хранят соответствие методов действиям в actions
+            actions = getattr(view_func, 'actions', None)
+            if actions:
+                metrics.action = actions.get(request.method.lower())
+
+    def log(self, config, request, response, metrics, endpoint, action, duration, response_bytes):
+        slow = config['SLOW_REQUEST_MS'] is not None and duration * 1000 >= config['SLOW_REQUEST_MS']
+        if not slow and not (config['LOG_SAMPLE_RATE'] and random.random() < config['LOG_SAMPLE_RATE']):
+            return
+        record = {
+            'endpoint': endpoint,
+            'action': action,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 3),
+            'queries': metrics.queries,
+            'db_time_ms': round(metrics.db_time * 1000, 3),
+            'serialization_ms': round(metrics.serialization_time * 1000, 3),
+            'response_bytes': response_bytes,
+        }
+        if slow:
+            record['slowest_queries'] = [
+                {'duration_ms': round(elapsed * 1000, 3), 'sql': sql} for elapsed, sql in reversed(metrics.slowest)
+            ]
+        logger.log(logging.WARNING if slow else logging.INFO, json.dumps(record, ensure_ascii=False), extra={'metrics': record})
+
+
+class _MeteredContent:
+    """
+    Содержимое потокового ответа: SQL-запросы при выдаче каждой части идут в метрики запроса.
+    StreamingHttpResponse вызывает close содержимого при закрытии ответа - тогда метрики
+    записываются вызовом on_close(число выданных байт)
+    """
+    def __init__(self, content, metrics, on_close):
+        self._content = content
+        self._metrics = metrics
+        self._on_close = on_close
+        self._size = 0
+
+    def __iter__(self):
+        iterator = iter(self._content)
+        while True:
+            # Контекст устанавливается на время получения каждой части: между ними сервер
+            # выполняет свой код, а генератор своего контекста не имеет
+            token = _current.set(self._metrics)
+            try:
+                chunk = next(iterator, None)
+            finally:
+                _current.reset(token)
+            if chunk is None:
+                return
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self):
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close(self._size)
+
+
+class _TimedRenderer:
+    """
+    Обертка рендерера ответа DRF, добавляющая время рендеринга ко времени сериализации
+    """
+    def __init__(self, renderer, metrics):
+        self._renderer = renderer
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._renderer, name)
+
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._renderer.render(*args, **kwargs)
+        finally:
+            self._metrics.serialization_time += time.perf_counter() - started
+
+
+def timed_representation(to_representation, metrics):
+    """
+    Обертка to_representation сериалайзера, добавляющая время его выполнения ко времени
+    сериализации (без времени SQL-запросов, выполненных при этом, например, для prefetch_related)
+    """
+    def wrapper(*args, **kwargs):
+        started, db_time = time.perf_counter(), metrics.db_time
+        try:
+            return to_representation(*args, **kwargs)
+        finally:
+            metrics.serialization_time += time.perf_counter() - started - (metrics.db_time - db_time)
+    return wrapper
+
+
+class MetricsMixin:
+    """
+    Миксин вьюсета DRF: время сериализации и рендеринга ответа в метриках запроса
+    """
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        metrics = current()
+        if metrics is not None:
+            # serializer.data вызывает to_representation верхнего сериалайзера (ListSerializer при many=True)
+            serializer.to_representation = timed_representation(serializer.to_representation, metrics)
+        return serializer
+
+    def build_payload(self, build, *args):
+        """
+        Ответ, собранный build(*args) из values()-строк без сериалайзеров; время сборки
+        (без времени SQL-запросов) учитывается как время сериализации
+        """
+        metrics = current()
+        if metrics is None:
+            return build(*args)
+        return timed_representation(build, metrics)(*args)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        metrics = current()
+        if metrics is not None and getattr(response, 'accepted_renderer', None) is not None:
+            response.accepted_renderer = _TimedRenderer(response.accepted_renderer, metrics)
+        return response
+
+
+def client_address(request, trusted_proxies):
+    """
+    Адрес клиента: REMOTE_ADDR либо, для запросов от доверенных прокси, ближайший
+    к ним недоверенный адрес X-Forwarded-For (левее стоящие адреса клиент может подделать)
+    """
+    address = request.META.get('REMOTE_ADDR')
+    if address in trusted_proxies:
+        forwarded = [item.strip() for item in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if item.strip()]
+        for address in reversed(forwarded):
+            if address not in trusted_proxies:
+                break
+    return address
+
+
+def metrics_view(request):
+    """
+    Метрики процесса в текстовом формате Prometheus. С токеном TOKEN - только по нему,
+    иначе только с адресов ALLOWED_IPS
+    """
+    config = get_config()
+    if config['TOKEN']:
+        scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), config['TOKEN'].encode()):
+            raise Http404
+    elif client_address(request, config['TRUSTED_PROXIES']) not in config['ALLOWED_IPS']:
+        raise Http404
+    return HttpResponse(registry.render(config['BUCKETS']), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,7 +1,14 @@
 from django.contrib.gis.db import models
+from django.contrib.postgres.indexes import GistIndex
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connections, router, transaction
+from django.db.models import Max, Min
+from django.db.models.expressions import RawSQL
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
+from main.access import as_pk, get_scope
 
 # Create your models here.
 
@@ -42,6 +49,9 @@ class ServiceType(models.Model):
     Модель типа услуги
     """
     name = models.CharField(max_length=250, verbose_name="наименование типа услуги")
+    # Время изменения - для ETag и Last-Modified ответов (main/conditional.py). На существующей
+    # базе столбцы updated_at всех моделей добавляет manage.py add_updated_at до выкладки кода
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="время изменения")
 
     def __str__(self):
         return self.name
@@ -56,12 +66,13 @@ class Provider(models.Model, ManagebleByUserMixin, CreatableByUserMixin, Updateb
     phone = models.CharField(max_length=10, verbose_name="телефон")
     address = models.CharField(max_length=250, verbose_name="адрес центрального офиса")
     manager = models.ForeignKey(User, on_delete=models.DO_NOTHING, verbose_name="менеджер организации", null=False, blank=False, related_name="providers")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="время изменения")
 
     def __str__(self):
         return self.name
 
     def is_manager(self, user):
-        return self.manager == user
+        return self.manager_id == user.pk
 
     @classmethod
     def can_create(self, user, data):
@@ -73,65 +84,251 @@ class Provider(models.Model, ManagebleByUserMixin, CreatableByUserMixin, Updateb
         return True
 
 
+class AsGeography(models.Func):
+    """
+    Приведение геометрии к geography: расстояния в метрах по сфероиду
+    """
+    template = '(%(expressions)s)::geography'
+    output_field = models.GeometryField(geography=True)
+
+
+class ZoneQuerySet(models.QuerySet):
+    """
+    QuerySet зон обслуживания с пространственными выборками
+    """
+    def containing(self, point):
+        """
+        Зоны, содержащие точку. При включенной таблице фрагментов (ZONE_PIECES)
+        проверка выполняется по небольшим фрагментам зон, а не по полной геометрии
+        """
+        if zone_pieces_enabled():
+            # Точка на линии разреза лежит на границе соседних фрагментов и ни одним из них
+            # не содержится - для фрагментов проверяется пересечение
+            return self.filter(pk__in=ZonePiece.objects.filter(geom__intersects=point).values('zone_id'))
+        return self.filter(mpoly__contains=point)
+
+    def _geography_sql(self):
+        # Совпадает с выражением функционального индекса zone_mpoly_geog_gist
+        qn = connections[self.db].ops.quote_name
+        return f'({qn(self.model._meta.db_table)}.{qn("mpoly")})::geography'
+
+    def with_distance(self, longitude, latitude):
+        """
+        Аннотация distance - расстояние от зоны до точки в метрах (0 для зон, содержащих точку)
+        """
+        return self.annotate(distance=RawSQL(
+            f'ST_Distance({self._geography_sql()}, ST_MakePoint(%s, %s)::geography)',
+            (float(longitude), float(latitude)), output_field=models.FloatField(),
+        ))
+
+    def _distinct_zones(self):
+        """
+        Те же зоны без повторов: фильтр по услугам (services__service_type) соединяет таблицу
+        услуг, и зона с несколькими подходящими услугами встречается в выборке несколько раз
+        """
+        if not self.query.where:
+            return self
+        return self.model.objects.using(self.db).filter(pk__in=self.values('pk'))
+
+    def nearest(self, longitude, latitude, k):
+        """
+        Пары (pk, расстояние в метрах) для k ближайших к точке зон по возрастанию расстояния.
+        Порядок задает оператор KNN <-> по geography-индексу: число просматриваемых зон не зависит от размера таблицы
+        """
+        knn = RawSQL(
+            f'{self._geography_sql()} <-> ST_MakePoint(%s, %s)::geography',
+            (float(longitude), float(latitude)), output_field=models.FloatField(),
+        )
+        rows = self._distinct_zones().with_distance(longitude, latitude).annotate(knn=knn).order_by('knn').values_list('pk', 'distance')[:k]
+        # <-> считает расстояние на сфере, distance - на сфероиде: уточняем порядок
+        return sorted(rows, key=lambda row: row[1])
+
+    def within_distance(self, longitude, latitude, radius, limit):
+        """
+        Пары (pk, расстояние в метрах) для зон не дальше radius метров от точки (не больше limit)
+        по возрастанию расстояния. ST_DWithin по geography-индексу
+        """
+        within = RawSQL(
+            f'ST_DWithin({self._geography_sql()}, ST_MakePoint(%s, %s)::geography, %s)',
+            (float(longitude), float(latitude), float(radius)), output_field=models.BooleanField(),
+        )
+        return list(self._distinct_zones().filter(within).with_distance(longitude, latitude).order_by('distance', 'pk').values_list('pk', 'distance')[:limit])
+
+    def ids_by_points(self, points):
+        """
+        Одним пространственным соединением с массивом точек находит зоны, содержащие каждую точку.
+        points - последовательность пар (долгота, широта).
+        Возвращает список списков pk зон в порядке входных точек
+        """
+        result = [[] for _ in points]
+        if not points:
+            return result
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        srid = self.model._meta.get_field('mpoly').srid
+        if zone_pieces_enabled():
+            # Соединение с фрагментами зон: зона может встретиться несколько раз;
+            # точки на линиях разреза находятся пересечением (см. containing)
+            table, zone_id, geom = qn(ZonePiece._meta.db_table), qn('zone_id'), qn('geom')
+            predicate = 'ST_Intersects'
+        else:
+            table, zone_id, geom = qn(self.model._meta.db_table), qn('id'), qn('mpoly')
+            predicate = 'ST_Contains'
+        params = [[float(lon) for lon, _ in points], [float(lat) for _, lat in points], srid]
+        where = ''
+        if self.query.where:
+            # Ограничиваем соединение зонами, прошедшими фильтры текущего QuerySet
+            subquery, subquery_params = self.values('pk').query.sql_with_params()
+            where = f'WHERE z.{zone_id} IN ({subquery})'
+            params.extend(subquery_params)
+        sql = f"""
+            SELECT DISTINCT p.idx, z.{zone_id}
+            FROM unnest(%s::float8[], %s::float8[]) WITH ORDINALITY AS p(lon, lat, idx)
+            JOIN {table} z ON {predicate}(z.{geom}, ST_SetSRID(ST_MakePoint(p.lon, p.lat), %s))
+            {where}
+            ORDER BY p.idx, z.{zone_id}
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for idx, pk in cursor.fetchall():
+                result[idx - 1].append(pk)
+        return result
+
+
 class Zone(models.Model, ManagebleByUserMixin, CreatableByUserMixin, UpdatebleByUserMixin):
     """
     Модель зоны обслуживания
     """
     name = models.CharField(max_length=250, verbose_name="наименование зоны")
-    mpoly = models.MultiPolygonField()
-    provider = models.ForeignKey(Provider, on_delete=models.CASCADE, verbose_name="поставщик услуги", null=False, blank=False, related_name="zones")
+    # Пространственный индекс объявлен в Meta.indexes (на существующей базе - manage.py create_indexes)
+    mpoly = models.MultiPolygonField(spatial_index=False)
+    # Отдельный индекс не нужен: provider - первая колонка индекса (provider, id)
+    provider = models.ForeignKey(Provider, on_delete=models.CASCADE, verbose_name="поставщик услуги", null=False, blank=False, related_name="zones", db_index=False)
+    # Обновляется и при изменении услуг зоны (main.signals): они входят в ответ о зоне
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="время изменения")
+
+    objects = ZoneQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # GiST-индекс для mpoly__contains/mpoly__intersects; buffering ускоряет построение на больших таблицах
+            GistIndex(fields=['mpoly'], name='zone_mpoly_gist', buffering=True, fillfactor=90),
+            # Зоны поставщика в порядке pk: фильтр provider со страницами по курсору
+            models.Index(fields=['provider', 'id'], name='zone_provider_id_idx'),
+            # Функциональный индекс по geography: ближайшие зоны (<->) и поиск в радиусе в метрах (ST_DWithin)
+            GistIndex(AsGeography('mpoly'), name='zone_mpoly_geog_gist'),
+        ]
 
     def __str__(self):
         return self.name
 
     def is_manager(self, user):
-        return self.provider.manager == user
+        return self.provider_id in get_scope(user).provider_ids
 
     @classmethod
     def can_create(cls, user, data):
-        return data['provider'] in user.providers.all().values_list('pk', flat=True)
+        return as_pk(data.get('provider')) in get_scope(user).provider_ids
 
     def can_update(self, user, data):
         """
         Возвращает True, если пользователь является менеджером поставщика зоны
         и не пытается передать зону чужому провайдеру
         """
-        if self.provider.manager != user:
+        if not self.is_manager(user):
             return False
-        if 'provider' in data and self.provider != data['provider']:
+        if 'provider' in data and self.provider_id != as_pk(data['provider']):
             # Попытка смены поставщика
             return Zone.can_create(user, data)
         return True
     
 
+def zone_pieces_enabled():
+    """
+    Поиск и проверки пересечений идут по таблице фрагментов
+    """
+    return getattr(settings, 'ZONE_PIECES', {}).get('ENABLED', False)
+
+
+def zone_pieces_maintained():
+    """
+    Фрагменты пересобираются при изменении зон. MAINTAIN без ENABLED - таблица наполняется
+    (manage.py rebuild_zone_pieces) и поддерживается, но поиск по ней еще не включен
+    """
+    config = getattr(settings, 'ZONE_PIECES', {})
+    return config.get('ENABLED', False) or config.get('MAINTAIN', False)
+
+
+class ZonePieceQuerySet(models.QuerySet):
+    def rebuild(self, zone_ids=None):
+        """
+        Пересобирает фрагменты зон zone_ids (None - всех зон) из их текущей геометрии
+        """
+        connection = connections[router.db_for_write(ZonePiece)]
+        qn = connection.ops.quote_name
+        max_vertices = getattr(settings, 'ZONE_PIECES', {}).get('MAX_VERTICES', 64)
+        pieces = self.filter(zone_id__in=zone_ids) if zone_ids is not None else self.all()
+        where, params = '', [max_vertices]
+        if zone_ids is not None:
+            where = f'WHERE {qn("id")} = ANY(%s)'
+            params.append(list(zone_ids))
+        # Зона не должна оставаться без фрагментов ни между удалением и вставкой, ни при ошибке вставки
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            pieces.using(connection.alias).delete()
+            cursor.execute(f"""
+                INSERT INTO {qn(ZonePiece._meta.db_table)} ({qn("zone_id")}, {qn("geom")})
+                SELECT {qn("id")}, ST_Subdivide({qn("mpoly")}, %s) FROM {qn(Zone._meta.db_table)}
+                {where}
+            """, params)
+
+
+class ZonePiece(models.Model):
+    """
+    Фрагмент геометрии зоны не более чем с ZONE_PIECES['MAX_VERTICES'] вершинами (ST_Subdivide).
+    Проверка вхождения точки и пересечений по фрагментам - несколько тестов небольших
+    полигонов вместо обхода всех вершин большой зоны. Поддерживается сигналами сохранения зоны
+    """
+    zone = models.ForeignKey(Zone, on_delete=models.CASCADE, related_name="pieces")
+    geom = models.GeometryField()
+
+    objects = ZonePieceQuerySet.as_manager()
+
+
 class Service(models.Model, ManagebleByUserMixin, CreatableByUserMixin, UpdatebleByUserMixin):
     """
     Модель услуги, оказываемой в рамках одной зоны
     """
     name = models.CharField(max_length=250, verbose_name="наименование услуги")
-    zone = models.ForeignKey(Zone, on_delete=models.CASCADE, verbose_name="зона обслуживания", null=False, blank=False, related_name="services")
+    # Отдельный индекс не нужен: zone - первая колонка индекса (zone, service_type)
+    zone = models.ForeignKey(Zone, on_delete=models.CASCADE, verbose_name="зона обслуживания", null=False, blank=False, related_name="services", db_index=False)
     service_type = models.ForeignKey(ServiceType, on_delete=models.CASCADE, verbose_name="тип услуги", null=False, blank=False, related_name="services")
     cost = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="стоимость услуги", null=False, blank=False)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="время изменения")
+
+    class Meta:
+        indexes = [
+            # Услуги зон по типу: проверка пересечений и фильтр services__service_type
+            models.Index(fields=['zone', 'service_type'], name='service_zone_type_idx'),
+        ]
 
     def __str__(self):
         return self.name
     
     def is_manager(self, user):
-        return self.zone.provider.manager == user
+        return self.zone_id in get_scope(user).zone_ids
 
     @classmethod
     def can_create(cls, user, data):
         # Пользователь может создать услугу только в своих зонах        
-        return data['zone'] in Zone.objects.filter(provider__manager=user).values_list('pk', flat=True)
+        return as_pk(data.get('zone')) in get_scope(user).zone_ids
     
     def can_update(self, user, data):
         """
         Возвращает True, если пользователь является менеджером поставщика зоны
         и не пытается передать услугу в чужую зону
         """
-        if self.zone.provider.manager != user:
+        if not self.is_manager(user):
             return False        
-        if 'zone' in data and data['zone'] != self.zone.pk:
+        if 'zone' in data and as_pk(data['zone']) != self.zone_id:
             return Service.can_create(user,data)
         return True
 
@@ -142,23 +339,229 @@ class Service(models.Model, ManagebleByUserMixin, CreatableByUserMixin, Updatebl
         одного и того же поставщика с одинаковым типом услуг,
         т.к. это противоречит здравому смыслу
         """
-
-        # qs зон данного поставщика, которые имеют пересечения
-        self_intersected_zones_qs = Zone.objects.filter(mpoly__intersects=self.zone.mpoly, provider=self.zone.provider)
-        if not self_intersected_zones_qs.exists():
+        if self.zone_id is None or self.service_type_id is None:
+            # Незаполненные поля отловит clean_fields
             return
+        conflicts = find_service_conflicts([(self.zone_id, self.service_type_id, self.pk)])[0]
+        if conflicts:
+            raise_service_conflict(conflicts)
 
-        # qs услуг того же типа данного поставщика в зонах пересечения
-        self_intersected_serv_qs = Service.objects.filter(zone__in=self_intersected_zones_qs, service_type=self.service_type)
-        if not self_intersected_serv_qs.exists():
-            return
-        
-        # Если в базу руками не лазить, то на данном этапе qs должен содержать одну запись
-        zone_name = self_intersected_serv_qs.first().zone.name
-        raise ValidationError({
-            'service_type': f"{_('Service type intersects with other one in zone with name:')} {zone_name}"
-        })
-
-    def save(self, *args, **kwargs):
-        self.full_clean()
-        return super().save(*args,**kwargs)
\ No newline at end of file
+    def save(self, *args, check_overlaps=True, **kwargs):
+        """
+        check_overlaps=False - пересечения уже проверены вызывающей стороной
+        (например, сериалайзером), повторный пространственный запрос не нужен
+        """
+        if check_overlaps:
+            self.full_clean()
+        else:
+            self.clean_fields()
+            self.validate_unique()
+        return super().save(*args,**kwargs)
+
+
+def find_service_conflicts(candidates, using=None, within_batch=False, replaced_ids=()):
+    """
+    Проверяет пересечения для набора услуг одним пространственным запросом.
+    candidates - последовательность троек (zone_id, service_type_id, service_id),
+    service_id - pk уже существующей услуги (она не конфликтует сама с собой) либо None.
+    Возвращает для каждой услуги список наименований зон того же поставщика,
+    которые пересекаются с ее зоной и уже содержат услугу того же типа.
+    within_batch=True - услуги набора проверяются и друг с другом (как будто созданы по порядку):
+    для более поздней из пары пересекающихся услуг возвращается зона более ранней.
+    replaced_ids - pk существующих услуг, которые набор изменяет: их прежнее состояние в базе не учитывается
+    """
+    result = [[] for _ in candidates]
+    if not candidates:
+        return result
+    connection = connections[using or router.db_for_write(Service)]
+    qn = connection.ops.quote_name
+    zone_table, service_table = qn(Zone._meta.db_table), qn(Service._meta.db_table)
+    if zone_pieces_enabled():
+        # Грубая проверка по охватам зон, точная - по парам небольших фрагментов
+        piece_table = qn(ZonePiece._meta.db_table)
+        intersects = f"""z1.{qn("mpoly")} && z2.{qn("mpoly")} AND EXISTS (
+            SELECT 1 FROM {piece_table} p1 JOIN {piece_table} p2 ON ST_Intersects(p1.{qn("geom")}, p2.{qn("geom")})
+            WHERE p1.{qn("zone_id")} = z1.{qn("id")} AND p2.{qn("zone_id")} = z2.{qn("id")}
+        )"""
+    else:
+        intersects = f'ST_Intersects(z1.{qn("mpoly")}, z2.{qn("mpoly")})'
+    batch_sql = ''
+    if within_batch:
+        batch_sql = f"""
+            UNION ALL
+            SELECT c2.idx, z1.{qn("name")}, c1.idx
+            FROM c c1
+            JOIN c c2 ON c1.idx < c2.idx AND c1.service_type_id = c2.service_type_id
+            JOIN {zone_table} z1 ON z1.{qn("id")} = c1.zone_id
+            JOIN {zone_table} z2
+                ON z2.{qn("id")} = c2.zone_id
+                AND z2.{qn("provider_id")} = z1.{qn("provider_id")} AND {intersects}
+        """
+    sql = f"""
+        WITH c AS (
+            SELECT * FROM unnest(%s::bigint[], %s::bigint[], %s::bigint[])
+                WITH ORDINALITY AS c(zone_id, service_type_id, service_id, idx)
+        )
+        SELECT c.idx, z2.{qn("name")}, 0
+        FROM c
+        JOIN {zone_table} z1 ON z1.{qn("id")} = c.zone_id
+        JOIN {zone_table} z2
+            ON z2.{qn("provider_id")} = z1.{qn("provider_id")} AND {intersects}
+        WHERE EXISTS (
+            SELECT 1 FROM {service_table} s
+            WHERE s.{qn("zone_id")} = z2.{qn("id")}
+                AND s.{qn("service_type_id")} = c.service_type_id
+                AND s.{qn("id")} IS DISTINCT FROM c.service_id
+                AND NOT (s.{qn("id")} = ANY(%s::bigint[]))
+        )
+        {batch_sql}
+        ORDER BY 1, 3
+    """
+    zone_ids, service_type_ids, service_ids = (list(column) for column in zip(*candidates))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [zone_ids, service_type_ids, service_ids, list(replaced_ids)])
+        for idx, zone_name, _order in cursor.fetchall():
+            result[idx - 1].append(zone_name)
+    return result
+
+
+def raise_service_conflict(zone_names):
+    """
+    Ошибка валидации услуги, пересекающейся с услугой того же типа в зонах zone_names
+    """
+    raise ValidationError({
+        'service_type': f"{_('Service type intersects with other one in zone with name:')} {zone_names[0]}"
+    })
+
+
+def service_coverage_enabled():
+    """
+    Доступность услуг определяется по таблице покрытия
+    """
+    return getattr(settings, 'SERVICE_COVERAGE', {}).get('ENABLED', False)
+
+
+def service_coverage_maintained():
+    """
+    Покрытие пересобирается при изменении услуг и зон (см. zone_pieces_maintained)
+    """
+    config = getattr(settings, 'SERVICE_COVERAGE', {})
+    return config.get('ENABLED', False) or config.get('MAINTAIN', False)
+
+
+class ServiceCoverageQuerySet(models.QuerySet):
+    def rebuild(self, zone_ids=None):
+        """
+        Пересобирает покрытие зон zone_ids (None - всех зон) по их текущим геометриям и услугам
+        """
+        connection = connections[router.db_for_write(ServiceCoverage)]
+        qn = connection.ops.quote_name
+        max_vertices = getattr(settings, 'SERVICE_COVERAGE', {}).get('MAX_VERTICES', 64)
+        coverage = self.filter(zone_id__in=zone_ids) if zone_ids is not None else self.all()
+        where, params = '', [max_vertices]
+        if zone_ids is not None:
+            where = f'WHERE {qn("zone_id")} = ANY(%s)'
+            params.append(list(zone_ids))
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            coverage.using(connection.alias).delete()
+            cursor.execute(f"""
+                INSERT INTO {qn(ServiceCoverage._meta.db_table)}
+                    ({qn("service_type_id")}, {qn("zone_id")}, {qn("provider_id")}, {qn("min_cost")}, {qn("max_cost")}, {qn("geom")})
+                SELECT s.service_type_id, z.{qn("id")}, z.{qn("provider_id")}, s.min_cost, s.max_cost,
+                    ST_Subdivide(z.{qn("mpoly")}, %s)
+                FROM (
+                    SELECT {qn("zone_id")} AS zone_id, {qn("service_type_id")} AS service_type_id,
+                        min({qn("cost")}) AS min_cost, max({qn("cost")}) AS max_cost
+                    FROM {qn(Service._meta.db_table)} {where}
+                    GROUP BY 1, 2
+                ) s
+                JOIN {qn(Zone._meta.db_table)} z ON z.{qn("id")} = s.zone_id
+            """, params)
+
+    def availability(self, point, service_type_id=None):
+        """
+        Доступность типов услуг в точке: по типу - наименьшая и наибольшая стоимость,
+        поставщики и зоны. Один запрос по пространственному индексу фрагментов покрытия
+        """
+        # Пересечение, а не вхождение: точка на линии разреза не содержится ни в одном фрагменте
+        queryset = self.filter(geom__intersects=point)
+        if service_type_id is not None:
+            queryset = queryset.filter(service_type_id=service_type_id)
+        return queryset.values('service_type_id').annotate(
+            min_cost=Min('min_cost'),
+            max_cost=Max('max_cost'),
+            providers=ArrayAgg('provider_id', distinct=True, ordering='provider_id'),
+            zones=ArrayAgg('zone_id', distinct=True, ordering='zone_id'),
+        ).order_by('service_type_id')
+
+
+class ServiceCoverage(models.Model):
+    """
+    Покрытие типа услуги: фрагмент (ST_Subdivide) зоны, где оказываются услуги этого типа,
+    с наименьшей и наибольшей стоимостью услуг типа в зоне и поставщиком зоны.
+    Вопрос «доступна ли услуга типа в точке и почем» решается поиском по индексу фрагментов
+    без загрузки зон и услуг. Поддерживается сигналами сохранения и удаления услуг и зон
+    """
+    service_type = models.ForeignKey(ServiceType, on_delete=models.CASCADE, related_name="coverage")
+    zone = models.ForeignKey(Zone, on_delete=models.CASCADE, related_name="coverage")
+    provider = models.ForeignKey(Provider, on_delete=models.CASCADE, related_name="+", db_index=False)
+    min_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    max_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    geom = models.GeometryField()
+
+    objects = ServiceCoverageQuerySet.as_manager()
+
+
+def service_availability(point, service_type_id=None):
+    """
+    Доступность типов услуг в точке (см. ServiceCoverageQuerySet.availability).
+    Без таблицы покрытия (SERVICE_COVERAGE) - по зонам, содержащим точку, и их услугам
+    """
+    if service_coverage_enabled():
+        return ServiceCoverage.objects.availability(point, service_type_id)
+    queryset = Service.objects.filter(zone__in=Zone.objects.containing(point))
+    if service_type_id is not None:
+        queryset = queryset.filter(service_type_id=service_type_id)
+    return queryset.values('service_type_id').annotate(
+        min_cost=Min('cost'),
+        max_cost=Max('cost'),
+        providers=ArrayAgg('zone__provider_id', distinct=True, ordering='zone__provider_id'),
+        zones=ArrayAgg('zone_id', distinct=True, ordering='zone_id'),
+    ).order_by('service_type_id')
+
+
+class ZoneJob(models.Model):
+    """
+    Задание отложенной записи зоны (заголовок Prefer: respond-async): данные запроса
+    сохраняются как есть, проверка, исправление геометрии и сохранение зоны выполняются
+    воркером (manage.py run_zone_jobs, main/jobs.py). Очередь - сама таблица заданий
+    """
+    CREATE, UPDATE, PARTIAL_UPDATE = 'create', 'update', 'partial_update'
+    ACTION_CHOICES = (
+        (CREATE, 'создание'),
+        (UPDATE, 'изменение'),
+        (PARTIAL_UPDATE, 'частичное изменение'),
+    )
+    PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'в очереди'),
+        (DONE, 'выполнено'),
+        (FAILED, 'ошибка'),
+    )
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES, verbose_name="действие")
+    # Изменяемая зона; для создания - созданная зона после выполнения
+    zone = models.ForeignKey(Zone, on_delete=models.SET_NULL, null=True, blank=True, related_name="jobs", verbose_name="зона")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="zone_jobs", verbose_name="автор")
+    data = models.JSONField(verbose_name="данные запроса")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, verbose_name="состояние")
+    errors = models.JSONField(null=True, blank=True, verbose_name="ошибки")
+    # Геометрия была невалидной и исправлена ST_MakeValid
+    repaired = models.BooleanField(default=False, verbose_name="геометрия исправлена")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="время создания")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="время выполнения")
+
+    class Meta:
+        indexes = [
+            # Выборка очередного задания: только ожидающие, по порядку поступления
+            models.Index(fields=['id'], name='zone_job_pending_idx', condition=models.Q(status='pending')),
+        ]
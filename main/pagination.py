@@ -0,0 +1,18 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PkCursorPagination(CursorPagination):
+    """
+    Постраничный вывод по курсору в порядке первичного ключа.
+    Выборка страницы - это WHERE id > курсор ORDER BY id LIMIT n, поэтому время ответа
+    не растет с номером страницы. Размер страницы задается параметром page_size,
+    значения по умолчанию можно переопределить атрибутами page_size и max_page_size вьюсета
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = getattr(view, 'page_size', self.page_size)
+        self.max_page_size = getattr(view, 'max_page_size', self.max_page_size)
+        return super().paginate_queryset(queryset, request, view)
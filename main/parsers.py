@@ -0,0 +1,31 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Парсер потока NDJSON: по одному JSON-значению на строку.
+    Возвращает список значений, пустые строки пропускаются.
+    Если у вьюсета задан max_batch_items, поток дочитывается не дальше этого предела
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        limit = getattr(parser_context.get('view'), 'max_batch_items', None)
+        items = []
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if limit is not None and len(items) >= limit:
+                raise ParseError(f'NDJSON parse error - more than {limit} items')
+            try:
+                items.append(json.loads(line.decode(encoding)))
+            except ValueError as exc:
+                raise ParseError(f'NDJSON parse error at line {number} - {exc}')
+        return items
@@ -0,0 +1,241 @@
+"""
+Чтение с реплик базы данных.
+
+Действия чтения вьюсетов с ReplicaReadMixin (по умолчанию list, retrieve и point) выполняют
+запросы на одной из реплик READ_REPLICAS['REPLICAS']: алиас выбранной реплики хранится
+в контекстной переменной на время запроса, ReplicaRouter отдает его в db_for_read.
+Все записи и остальные чтения идут в основную базу.
+
+Реплика выбирается случайно по весам (SELECTION='weighted') либо с наименьшей сглаженной
+задержкой запросов в этом процессе (SELECTION='latency').
+
+Чтение своих записей: после успешного изменяющего запроса ReplicaPinMiddleware на
+PIN_SECONDS закрепляет клиента за основной базой - cookie для браузеров и ключом в кэше
+для аутентифицированного пользователя (токены без cookie). Следующий запрос клиента может
+попасть в другой процесс, поэтому ключи пользователей хранятся только в общем кэше
+(LocMemCache и DummyCache не допускаются).
+"""
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from main.cache import shared_cache
+
+
+DEFAULTS = {
+    'PRIMARY': DEFAULT_DB_ALIAS,
+    # Алиас реплики -> вес; пусто - все чтения идут в основную базу
+    'REPLICAS': {},
+    # 'weighted' - случайно по весам, 'latency' - с наименьшей задержкой
+    'SELECTION': 'weighted',
+    # Коэффициент сглаживания задержки и доля случайных выборов для ее обновления (SELECTION='latency')
+    'LATENCY_ALPHA': 0.2,
+    'EXPLORE_RATE': 0.05,
+    # Сколько секунд после изменяющего запроса клиент читает из основной базы
+    'PIN_SECONDS': 10,
+    'COOKIE_NAME': 'db_primary',
+    'CACHE_ALIAS': 'default',
+    'KEY_PREFIX': 'db-primary',
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'READ_REPLICAS', {})}
+
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+def read_alias():
+    """
+    Реплика для чтений текущего запроса либо None - основная база
+    """
+    return _read_alias.get()
+
+
+class ReplicaSelector:
+    """
+    Выбор реплики по весам или по сглаженной задержке запросов в этом процессе
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}
+
+    def choose(self, config=None):
+        config = config or get_config()
+        replicas = {alias: weight for alias, weight in config['REPLICAS'].items() if weight > 0}
+        if not replicas:
+            return None
+        if config['SELECTION'] == 'latency' and random.random() >= config['EXPLORE_RATE']:
+            with self._lock:
+                # Реплики без замеров выбираются первыми
+                return min(replicas, key=lambda alias: self._latency.get(alias, 0.0))
+        aliases = list(replicas)
+        return random.choices(aliases, weights=[replicas[alias] for alias in aliases])[0]
+
+    def observe(self, alias, seconds, alpha):
+        with self._lock:
+            previous = self._latency.get(alias)
+            self._latency[alias] = seconds if previous is None else previous + alpha * (seconds - previous)
+
+    def latency(self, alias):
+        with self._lock:
+            return self._latency.get(alias)
+
+    def reset(self):
+        with self._lock:
+            self._latency = {}
+
+    def execute_wrapper(self, alias, alpha):
+        def wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                self.observe(alias, time.perf_counter() - started, alpha)
+        return wrapper
+
+
+selector = ReplicaSelector()
+
+
+def _pin_key(config, user_id):
+    return f'{config["KEY_PREFIX"]}:{user_id}'
+
+
+def _pin_cache(config):
+    return shared_cache(config['CACHE_ALIAS'], "READ_REPLICAS['CACHE_ALIAS']")
+
+
+def is_pinned(request, config=None):
+    """
+    Клиент недавно что-то изменил и должен читать из основной базы
+    """
+    config = config or get_config()
+    if config['COOKIE_NAME'] in request.COOKIES:
+        return True
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return _pin_cache(config).get(_pin_key(config, user.pk)) is not None
+    return False
+
+
+def pin(request, response, config=None):
+    config = config or get_config()
+    response.set_cookie(config['COOKIE_NAME'], '1', max_age=config['PIN_SECONDS'], httponly=True, samesite='Lax')
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        _pin_cache(config).set(_pin_key(config, user.pk), 1, config['PIN_SECONDS'])
+
+
+class ReplicaRouter:
+    """
+    Роутер баз данных: чтения действий с ReplicaReadMixin - на выбранную реплику,
+    записи - в основную базу. Миграции на реплики не применяются, они приходят репликацией
+    """
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Объекты, прочитанные с реплики, сохраняются в основную базу
+        return get_config()['PRIMARY']
+
+    def allow_relation(self, obj1, obj2, **hints):
+        config = get_config()
+        databases = {config['PRIMARY'], *config['REPLICAS']}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_config()['REPLICAS']:
+            return False
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Миксин вьюсета DRF: действия replica_actions читают с реплики, если клиент
+    не закреплен за основной базой после своих изменений
+    """
+    replica_actions = ('list', 'retrieve', 'point')
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _read_alias.set(None)
+        self._replica_stack = ExitStack()
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            self._replica_stack.close()
+            _read_alias.reset(token)
+
+    def initial(self, request, *args, **kwargs):
+        # Аутентификация и проверка прав - по основной базе, до выбора реплики
+        super().initial(request, *args, **kwargs)
+        alias = self.get_read_alias(request)
+        if alias is not None:
+            config = get_config()
+            if config['SELECTION'] == 'latency':
+                self._replica_stack.enter_context(
+                    connections[alias].execute_wrapper(selector.execute_wrapper(alias, config['LATENCY_ALPHA']))
+                )
+            _read_alias.set(alias)
+
+    def get_read_alias(self, request):
+        """
+        Реплика для чтений этого запроса либо None
+        """
+        if request.method not in ('GET', 'HEAD') or self.action not in self.replica_actions:
+            return None
+        config = get_config()
+        if not config['REPLICAS'] or is_pinned(request, config):
+            return None
+        return selector.choose(config)
+
+
+class ReplicaPinMiddleware:
+    """
+    После успешного изменяющего запроса закрепляет клиента за основной базой на PIN_SECONDS.
+    Работает и в синхронной (WSGI), и в асинхронной (ASGI) цепочке middleware
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Как у MiddlewareMixin: внешние middleware и обработчик ASGI ждут корутину
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        response = self.get_response(request)
+        config = self.pin_config(request, response)
+        if config is not None:
+            pin(request, response, config)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        config = self.pin_config(request, response)
+        if config is not None:
+            # request.user может загружаться из базы, ключ пишется в кэш - оба синхронные
+            await sync_to_async(pin)(request, response, config)
+        return response
+
+    def pin_config(self, request, response):
+        """
+        Настройки, если после ответа клиента нужно закрепить за основной базой, иначе None
+        """
+        if request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400:
+            return None
+        config = get_config()
+        return config if config['REPLICAS'] else None
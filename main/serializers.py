@@ -1,57 +1,132 @@
 from rest_framework import serializers
-from main.models import Provider, Zone, Service, ServiceType
+from main.models import Provider, Zone, ZoneJob, Service, ServiceType, find_service_conflicts, raise_service_conflict
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.utils.translation import gettext_lazy as _
+from main.geometry import GEOMETRY_ANNOTATION
 
 
 class ServiceTypeSerializer(serializers.ModelSerializer):
     class Meta:
         model = ServiceType
-        fields = '__all__'
+        # updated_at - служебное поле для ETag и Last-Modified, в ответы не выводится
+        exclude = ('updated_at',)
 
 class ServiceSerializerRead(serializers.ModelSerializer):
     service_type = ServiceTypeSerializer()
     class Meta:
         model = Service
-        fields = '__all__'
+        exclude = ('updated_at',)
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Связанный объект берется из заранее загруженного словаря context['preloaded'][модель],
+    если он передан (пакетная обработка), иначе - запросом к базе
+    """
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        preloaded = self.context.get('preloaded', {}).get(model)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        try:
+            pk = model._meta.pk.to_python(data)
+        except (TypeError, ValidationError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in preloaded:
+            self.fail('does_not_exist', pk_value=data)
+        return preloaded[pk]
+
 
 class ServiceSerializerWrite(serializers.ModelSerializer):    
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
+
     class Meta:
         model = Service
-        fields = '__all__'
+        exclude = ('updated_at',)
 
     def validate(self, data):
-        # Проведем валидацию по правилам модели
-        tmp_obj = Service(**data)
-        try:
-            tmp_obj.clean()
-        except ValidationError as e:
-            raise serializers.ValidationError(e)
+        if not self.context.get('check_overlaps', True):
+            # Пересечения проверяются вызывающей стороной для всего пакета сразу
+            return data
+        # Проведем валидацию пересечений по правилам модели одним запросом;
+        # при частичном обновлении недостающие поля берем из текущей услуги - по pk, не загружая
+        # связанную зону: ее строка содержит всю геометрию
+        zone_id = data['zone'].pk if 'zone' in data else getattr(self.instance, 'zone_id', None)
+        service_type_id = data['service_type'].pk if 'service_type' in data else getattr(self.instance, 'service_type_id', None)
+        if zone_id is not None and service_type_id is not None:
+            conflicts = find_service_conflicts([(zone_id, service_type_id, getattr(self.instance, 'pk', None))])[0]
+            if conflicts:
+                try:
+                    raise_service_conflict(conflicts)
+                except ValidationError as e:
+                    raise serializers.ValidationError(e)
 
         return data
+
+    def create(self, validated_data):
+        # Пересечения уже проверены в validate
+        instance = Service(**validated_data)
+        instance.save(check_overlaps=False)
+        return instance
+
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(check_overlaps=False)
+        return instance
     
 
 class ProviderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Provider
-        fields = '__all__'
+        exclude = ('updated_at',)
         read_only_fields = ('manager',)
 
     def create(self, data):
         data['manager'] = self.context['manager']
         return super().create(data)
 
+class GeometryTextField(serializers.Field):
+    """
+    Вывод геометрии в EWKT, как это делает ModelSerializer для поля mpoly
+    """
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return str(value)
+
+
 class ZoneSerializerRead(serializers.ModelSerializer):
     services = ServiceSerializerRead(many=True)
     provider = ProviderSerializer()
 
     class Meta:
         model = Zone
-        fields = '__all__'
+        exclude = ('updated_at',)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # Параметры вывода геометрии (main.geometry.GeometryOptions) передаются вьюсетом через контекст
+        options = self.context.get('geometry_options')
+        if options is not None and not options.is_default:
+            if options.mode == 'none':
+                del fields['mpoly']
+            else:
+                fields['mpoly'] = GeometryTextField(source=GEOMETRY_ANNOTATION)
+        return fields
     
 class ZoneSerializerWrite(serializers.ModelSerializer):    
 
     class Meta:
         model = Zone
-        fields = '__all__'
+        exclude = ('updated_at',)
+
 
+
+class ZoneJobSerializer(serializers.ModelSerializer):
+    # Данные запроса (с полной геометрией) в ответ не выводятся
+
+    class Meta:
+        model = ZoneJob
+        exclude = ('data', 'user')
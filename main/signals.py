@@ -0,0 +1,178 @@
+"""
+Обработчики сигналов моделей: поддержание внутрипроцессных индексов и кэшей в актуальном состоянии
+"""
+from django.contrib.gis.db.models.functions import Envelope
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from main import access
+from main.cache import point_cache
+from main.models import Zone, ZonePiece, Service, ServiceCoverage, Provider, ServiceType, service_coverage_maintained, zone_pieces_maintained
+from main.spatial_index import zone_index
+from main.tiles import tile_cache
+
+
+def extent_caches():
+    """
+    Включенные кэши, инвалидируемые по охватам зон: ответы /zones/point/ и тайлы
+    """
+    return [cache for cache in (point_cache, tile_cache) if cache.enabled]
+
+
+def zone_extents(zone_ids):
+    """
+    Возвращает охваты зон, не загружая их полные геометрии
+    """
+    envelopes = Zone.objects.filter(pk__in=zone_ids).annotate(envelope=Envelope('mpoly')).values_list('envelope', flat=True)
+    return [envelope.extent for envelope in envelopes]
+
+
+def invalidate_extents(extents):
+    """
+    Сбрасывает закэшированные ответы в охватах после фиксации транзакции
+    """
+    extents = [extent for extent in extents if extent is not None]
+    caches = extent_caches()
+    if extents and caches:
+        transaction.on_commit(lambda: [cache.invalidate_extent(extent) for cache in caches for extent in extents])
+
+
+def invalidate_extent_caches():
+    """
+    Сбрасывает кэши по охватам целиком после фиксации транзакции
+    """
+    for cache in extent_caches():
+        transaction.on_commit(cache.invalidate_all)
+
+
+def invalidate_access(provider_ids=(), user_ids=()):
+    """
+    Сбрасывает закэшированные области управления менеджеров поставщиков provider_ids
+    и пользователей user_ids: сразу для текущего процесса и повторно после фиксации транзакции
+    """
+    user_ids = set(user_ids)
+    if access.get_config()['CROSS_REQUEST'] and provider_ids:
+        user_ids |= set(Provider.objects.filter(pk__in=provider_ids).values_list('manager_id', flat=True))
+    access.invalidate(user_ids)
+    transaction.on_commit(lambda: access.invalidate(user_ids))
+
+
+def cross_request_access():
+    return access.get_config()['CROSS_REQUEST']
+
+
+def rebuild_coverage(zone_ids):
+    """
+    Пересобирает покрытие типов услуг зон zone_ids в текущей транзакции
+    """
+    zone_ids = {pk for pk in zone_ids if pk is not None}
+    if zone_ids and service_coverage_maintained():
+        ServiceCoverage.objects.rebuild(zone_ids)
+
+
+def touch(model, pks):
+    """
+    Обновляет время изменения сущностей, чей вывод зависит от измененных связанных сущностей
+    (услуги выводятся в составе зон). update() не вызывает сигналов сохранения
+    """
+    pks = {pk for pk in pks if pk is not None}
+    if pks:
+        model.objects.filter(pk__in=pks).update(updated_at=timezone.now())
+
+
+@receiver(pre_save, sender=Zone)
+def zone_before_save(sender, instance, **kwargs):
+    # Запоминаем прежний охват зоны, чтобы сбросить и его
+    instance._old_extents = zone_extents([instance.pk]) if instance.pk and extent_caches() else []
+    # и прежнего поставщика - зона могла перейти к другому
+    instance._old_provider_ids = list(Zone.objects.filter(pk=instance.pk).values_list('provider_id', flat=True)) if instance.pk and cross_request_access() else []
+
+
+@receiver(post_save, sender=Zone)
+def zone_saved(sender, instance, **kwargs):
+    if zone_pieces_maintained():
+        # Фрагменты пересобираются в той же транзакции, что и сохранение зоны
+        ZonePiece.objects.rebuild([instance.pk])
+    # Покрытие зависит от геометрии и поставщика зоны; у новой зоны услуг еще нет
+    if not kwargs.get('created'):
+        rebuild_coverage([instance.pk])
+    transaction.on_commit(lambda: zone_index.update(instance))
+    invalidate_extents(getattr(instance, '_old_extents', []) + [instance.mpoly.extent])
+    invalidate_access({instance.provider_id, *getattr(instance, '_old_provider_ids', [])})
+
+
+@receiver(post_delete, sender=Zone)
+def zone_deleted(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: zone_index.remove(pk))
+    invalidate_extents([instance.mpoly.extent])
+    invalidate_access({instance.provider_id})
+    # Last-Modified списка зон поставщика должен измениться и после удаления зоны
+    touch(Provider, [instance.provider_id])
+
+
+@receiver(pre_save, sender=Provider)
+def provider_before_save(sender, instance, **kwargs):
+    # Поставщик мог сменить менеджера
+    instance._old_manager_ids = list(Provider.objects.filter(pk=instance.pk).values_list('manager_id', flat=True)) if instance.pk and cross_request_access() else []
+
+
+@receiver(post_save, sender=Provider)
+@receiver(post_delete, sender=Provider)
+def provider_changed(sender, instance, **kwargs):
+    invalidate_access(user_ids={instance.manager_id, *getattr(instance, '_old_manager_ids', [])})
+
+
+@receiver(pre_save, sender=Service)
+def service_before_save(sender, instance, **kwargs):
+    # Услуга могла быть перенесена из другой зоны
+    instance._old_zone_ids = list(Service.objects.filter(pk=instance.pk).values_list('zone_id', flat=True)) if instance.pk else []
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def service_changed(sender, instance, **kwargs):
+    zone_ids = {instance.zone_id, *getattr(instance, '_old_zone_ids', [])}
+    touch(Zone, zone_ids)
+    rebuild_coverage(zone_ids)
+    if extent_caches():
+        invalidate_extents(zone_extents(zone_ids))
+
+
+@receiver(post_save, sender=Provider)
+@receiver(post_delete, sender=Provider)
+@receiver(post_save, sender=ServiceType)
+@receiver(post_delete, sender=ServiceType)
+def shared_entity_changed(sender, instance, **kwargs):
+    # Поставщики и типы услуг выводятся во множестве зон - сбрасываем кэши целиком
+    invalidate_extent_caches()
+
+
+def zones_changed_in_bulk(zone_ids=None):
+    """
+    Вызывается после массовых изменений зон в обход save()/delete() (bulk_create, update).
+    zone_ids - измененные зоны, их фрагменты и покрытие пересобираются (None - не трогаются)
+    """
+    if zone_ids is not None:
+        if zone_pieces_maintained():
+            ZonePiece.objects.rebuild(zone_ids)
+        rebuild_coverage(zone_ids)
+
+    def invalidate():
+        zone_index.invalidate()
+        point_cache.invalidate_all()
+        tile_cache.invalidate_all()
+        access.invalidate()
+    transaction.on_commit(invalidate)
+
+
+def services_changed_in_bulk(zone_ids):
+    """
+    Вызывается после массовых изменений услуг в зонах zone_ids в обход save()/delete()
+    """
+    touch(Zone, zone_ids)
+    rebuild_coverage(zone_ids)
+    if extent_caches():
+        invalidate_extents(zone_extents(zone_ids))
@@ -0,0 +1,271 @@
+"""
+Внутрипроцессный пространственный индекс зон обслуживания.
+
+Хранит подготовленные (prepared) геометрии Zone.mpoly и упакованное
+R-дерево (Sort-Tile-Recursive) по их ограничивающим прямоугольникам.
+Позволяет ответить на вопрос "какие зоны содержат точку" без обращения к PostGIS.
+
+Индекс живет в памяти одного процесса: изменения зон, сделанные в этом процессе,
+применяются сразу через сигналы, изменения из других процессов (других воркеров
+и run_zone_jobs) подтягиваются только периодической перестройкой
+(ZONE_POINT_INDEX['MAX_AGE']) - до этого ответы по точке могут их не учитывать.
+"""
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+
+
+DEFAULTS = {
+    # Индекс выключен, пока явно не включен в настройках
+    'ENABLED': False,
+    # Число элементов в узле R-дерева
+    'NODE_CAPACITY': 16,
+    # После скольких точечных изменений дерево перестраивается из памяти
+    'REBUILD_THRESHOLD': 256,
+    # Максимальный возраст индекса в секундах до фоновой перестройки из БД (None - бессрочно).
+    # Изменения зон из других процессов видны в этом процессе не раньше перестройки
+    'MAX_AGE': 300,
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ZONE_POINT_INDEX', {})}
+
+
+def _bbox_contains(bbox, x, y):
+    return bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]
+
+
+def _bbox_union(bboxes):
+    xmin, ymin, xmax, ymax = zip(*bboxes)
+    return (min(xmin), min(ymin), max(xmax), max(ymax))
+
+
+class STRTree:
+    """
+    Статическое R-дерево, упакованное методом Sort-Tile-Recursive.
+    items - последовательность пар (bbox, value), где bbox = (xmin, ymin, xmax, ymax)
+    """
+    def __init__(self, items, capacity=16):
+        self.capacity = max(2, capacity)
+        # Узел - пара (bbox, children); у листьев children - список пар (bbox, value)
+        level = [(bbox, value) for bbox, value in items]
+        self.size = len(level)
+        self.root = None
+        if not level:
+            return
+        leaf = True
+        while True:
+            level = [(_bbox_union([b for b, _ in group]), (leaf, group)) for group in self._pack(level)]
+            leaf = False
+            if len(level) == 1:
+                self.root = level[0]
+                return
+
+    def _pack(self, entries):
+        """
+        Разбивает записи на группы не больше capacity: сначала на вертикальные полосы по x,
+        затем каждую полосу - по y
+        """
+        def center_x(entry):
+            return entry[0][0] + entry[0][2]
+
+        def center_y(entry):
+            return entry[0][1] + entry[0][3]
+
+        node_count = math.ceil(len(entries) / self.capacity)
+        slice_count = math.ceil(math.sqrt(node_count))
+        slice_size = slice_count * self.capacity
+        entries = sorted(entries, key=center_x)
+        for i in range(0, len(entries), slice_size):
+            vertical_slice = sorted(entries[i:i + slice_size], key=center_y)
+            for j in range(0, len(vertical_slice), self.capacity):
+                yield vertical_slice[j:j + self.capacity]
+
+    def query(self, x, y):
+        """
+        Возвращает значения, ограничивающий прямоугольник которых содержит точку (x, y)
+        """
+        if self.root is None or not _bbox_contains(self.root[0], x, y):
+            return []
+        result = []
+        stack = [self.root[1]]
+        while stack:
+            leaf, children = stack.pop()
+            for bbox, child in children:
+                if not _bbox_contains(bbox, x, y):
+                    continue
+                if leaf:
+                    result.append(child)
+                else:
+                    stack.append(child)
+        return result
+
+
+class ZoneIndex:
+    """
+    Индекс "точка в полигоне" по зонам обслуживания.
+    Пока индекс не построен (холодный) или выключен, lookup возвращает None,
+    и вызывающая сторона должна обратиться к базе данных
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Подготовленные геометрии GEOS не потокобезопасны: contains выполняется под блокировкой
+        self._geos_lock = threading.Lock()
+        self._build_thread = None
+        # Журналы идущих построений: изменения (pk, запись либо None для удаленной зоны),
+        # сделанные после начала чтения зон из базы, применяются к построенному индексу
+        self._journals = []
+        # Увеличивается при сбросе: построение, начатое до сброса, не подменяет индекс
+        self._generation = 0
+        self._reset()
+
+    def _reset(self):
+        # pk -> (bbox, prepared geometry)
+        self._entries = {}
+        self._tree = None
+        # pk зон, измененных после постройки дерева; проверяются перебором
+        self._pending = set()
+        self._built_at = None
+
+    @property
+    def enabled(self):
+        return get_config()['ENABLED']
+
+    @property
+    def warm(self):
+        return self._tree is not None
+
+    @staticmethod
+    def _entry(mpoly):
+        return (mpoly.extent, mpoly.prepared)
+
+    def build(self):
+        """
+        Синхронно строит индекс по всем зонам из базы данных
+        """
+        from main.models import Zone
+
+        journal = []
+        with self._lock:
+            generation = self._generation
+            self._journals.append(journal)
+        try:
+            entries = {pk: self._entry(mpoly) for pk, mpoly in Zone.objects.values_list('pk', 'mpoly').iterator()}
+            tree = STRTree(((bbox, pk) for pk, (bbox, _) in entries.items()), get_config()['NODE_CAPACITY'])
+        finally:
+            with self._lock:
+                self._journals.remove(journal)
+        with self._lock:
+            if generation != self._generation:
+                return
+            # Изменения, пришедшие во время чтения, могли не попасть в выборку - применяем их поверх
+            for pk, entry in journal:
+                if entry is None:
+                    entries.pop(pk, None)
+                else:
+                    entries[pk] = entry
+            self._entries = entries
+            self._tree = tree
+            self._pending = {pk for pk, entry in journal if entry is not None}
+            self._built_at = time.monotonic()
+            self._compact()
+
+    def build_in_background(self):
+        """
+        Запускает построение индекса в фоновом потоке, если оно еще не идет
+        """
+        with self._lock:
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return
+            self._build_thread = threading.Thread(target=self._background_build, name='zone-index-build', daemon=True)
+            self._build_thread.start()
+
+    def _background_build(self):
+        from django.db import connection
+
+        try:
+            self.build()
+        finally:
+            connection.close()
+
+    def invalidate(self):
+        """
+        Сбрасывает индекс; до следующего построения запросы пойдут в базу данных
+        """
+        with self._lock:
+            self._generation += 1
+            self._reset()
+
+    def update(self, zone):
+        """
+        Добавляет или заменяет зону в индексе
+        """
+        # Построение, начатое после этой проверки, прочитает зону из базы уже измененной
+        if not self.warm and not self._journals:
+            return
+        entry = self._entry(zone.mpoly)
+        with self._lock:
+            for journal in self._journals:
+                journal.append((zone.pk, entry))
+            if self._tree is None:
+                return
+            self._entries[zone.pk] = entry
+            # Множество заменяется целиком, чтобы не мешать одновременно идущим запросам
+            self._pending = self._pending | {zone.pk}
+            self._compact()
+
+    def remove(self, pk):
+        """
+        Удаляет зону из индекса
+        """
+        if not self.warm and not self._journals:
+            return
+        with self._lock:
+            for journal in self._journals:
+                journal.append((pk, None))
+            if self._tree is None:
+                return
+            self._entries.pop(pk, None)
+            self._pending = self._pending - {pk}
+            self._compact()
+
+    def _compact(self):
+        # Слишком много изменений проверяется перебором - перестраиваем дерево из памяти
+        if len(self._pending) > get_config()['REBUILD_THRESHOLD']:
+            self._tree = STRTree(((bbox, pk) for pk, (bbox, _) in self._entries.items()), get_config()['NODE_CAPACITY'])
+            self._pending = set()
+
+    def lookup(self, x, y):
+        """
+        Возвращает отсортированный список pk зон, содержащих точку (x, y),
+        либо None, если индекс выключен или еще не построен
+        """
+        config = get_config()
+        if not config['ENABLED']:
+            return None
+        tree, entries, pending = self._tree, self._entries, self._pending
+        if tree is None:
+            self.build_in_background()
+            return None
+        if config['MAX_AGE'] is not None and time.monotonic() - self._built_at > config['MAX_AGE']:
+            # Индекс устарел: продолжаем отвечать из памяти, пока строится новый
+            self.build_in_background()
+
+        point = Point(x, y)
+        result = []
+        for pk in set(tree.query(x, y)) | pending:
+            entry = entries.get(pk)
+            if entry is None or not _bbox_contains(entry[0], x, y):
+                continue
+            with self._geos_lock:
+                contains = entry[1].contains(point)
+            if contains:
+                result.append(pk)
+        return sorted(result)
+
+
+zone_index = ZoneIndex()
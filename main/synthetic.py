@@ -0,0 +1,107 @@
+"""
+Генератор синтетических данных для замеров производительности (manage.py benchmark).
+
+Зоны - звездообразные многоугольники с заданным числом вершин, расставленные по сетке
+внутри bbox так, что соседние зоны слегка перекрываются; поставщики чередуются по зонам,
+услуги распределяются по зонам и типам случайно. При одном и том же seed данные совпадают.
+"""
+import math
+import random
+from dataclasses import dataclass, field
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import MultiPolygon, Polygon
+
+from main.models import Provider, Service, ServiceType, Zone
+from main.signals import services_changed_in_bulk, zones_changed_in_bulk
+
+
+DEFAULT_BBOX = (37.3, 55.5, 37.9, 55.95)
+
+
+@dataclass
+class SyntheticData:
+    bbox: tuple
+    users: list = field(default_factory=list)
+    providers: list = field(default_factory=list)
+    zone_ids: list = field(default_factory=list)
+    service_types: list = field(default_factory=list)
+    vertex_counts: list = field(default_factory=list)
+
+    def summary(self):
+        return {
+            'providers': len(self.providers),
+            'zones': len(self.zone_ids),
+            'service_types': len(self.service_types),
+            'services': Service.objects.filter(zone_id__in=self.zone_ids).count(),
+            'vertices_total': sum(self.vertex_counts),
+            'vertices_max': max(self.vertex_counts, default=0),
+        }
+
+
+def zone_polygon(rnd, cx, cy, radius, vertices):
+    """
+    Звездообразный (и потому простой) многоугольник вокруг центра с vertices вершинами
+    """
+    step = 2 * math.pi / vertices
+    ring = []
+    for i in range(vertices):
+        angle = step * i + rnd.uniform(0, step * 0.5)
+        r = radius * rnd.uniform(0.7, 1.0)
+        ring.append((cx + r * math.cos(angle), cy + r * math.sin(angle)))
+    ring.append(ring[0])
+    return Polygon(ring, srid=4326)
+
+
+def generate(providers=10, zones=200, services=1000, service_types=20, vertices=200,
+             bbox=DEFAULT_BBOX, seed=0, batch_size=500):
+    """
+    Создает пользователей-менеджеров, providers поставщиков, zones зон со случайным числом
+    вершин от vertices / 2 до vertices * 3 / 2 и services услуг
+    """
+    rnd = random.Random(seed)
+    data = SyntheticData(bbox=tuple(bbox))
+    prefix = f'bench-{seed}'
+
+    data.users = User.objects.bulk_create([
+        User(username=f'{prefix}-manager-{i}', email=f'{prefix}-manager-{i}@example.com') for i in range(providers)
+    ])
+    data.providers = Provider.objects.bulk_create([
+        Provider(name=f'Поставщик {i}', email=f'provider-{i}@example.com', phone=f'{i:010d}'[-10:],
+                 address=f'Улица {i}', manager=user)
+        for i, user in enumerate(data.users)
+    ])
+    data.service_types = ServiceType.objects.bulk_create([
+        ServiceType(name=f'Тип услуги {i}') for i in range(service_types)
+    ])
+
+    columns = max(1, math.ceil(math.sqrt(zones)))
+    rows = max(1, math.ceil(zones / columns))
+    width, height = (bbox[2] - bbox[0]) / columns, (bbox[3] - bbox[1]) / rows
+    # Радиус больше половины ячейки - соседние зоны перекрываются
+    radius = 0.6 * min(width, height)
+    for start in range(0, zones, batch_size):
+        batch = []
+        for j in range(start, min(start + batch_size, zones)):
+            cx = bbox[0] + (j % columns + 0.5 + rnd.uniform(-0.1, 0.1)) * width
+            cy = bbox[1] + (j // columns + 0.5 + rnd.uniform(-0.1, 0.1)) * height
+            count = rnd.randint(max(4, vertices // 2), max(4, vertices * 3 // 2))
+            data.vertex_counts.append(count)
+            batch.append(Zone(
+                name=f'Зона {j}', provider=data.providers[j % providers],
+                mpoly=MultiPolygon(zone_polygon(rnd, cx, cy, radius, count), srid=4326),
+            ))
+        Zone.objects.bulk_create(batch)
+        zone_ids = [zone.pk for zone in batch]
+        zones_changed_in_bulk(zone_ids)
+        data.zone_ids.extend(zone_ids)
+
+    for start in range(0, services, batch_size):
+        Service.objects.bulk_create([
+            Service(name=f'Услуга {k}', zone_id=rnd.choice(data.zone_ids), service_type=rnd.choice(data.service_types),
+                    cost=round(rnd.uniform(100, 10000), 2))
+            for k in range(start, min(start + batch_size, services))
+        ])
+    # Покрытие типов услуг по созданным услугам
+    services_changed_in_bulk(data.zone_ids)
+    return data
@@ -1,15 +1,82 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+from unittest import mock, skipUnless
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.core.management import CommandError, call_command
+from django.test.utils import CaptureQueriesContext
+from django.db import DatabaseError, connection, connections
+from django.core.cache import caches
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.contrib.gis.geos import GEOSGeometry, MultiPolygon, Polygon
 from main.models import *
 from django.contrib.auth.models import User
-from main.views import ProviderViewSet
+from main.views import ProviderViewSet, ZoneViewSet, ServiceViewSet
+from main.async_views import asyncpg, close_pool, zones_point
 
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
 from main import serializers
+from main.spatial_index import STRTree, ZoneIndex
+from main.access import get_scope
+from main.cache import point_cache
+from main.tiles import tile_cache, tile_range
+from main.metrics import MetricsMiddleware, registry as metrics_registry
+from main.replicas import ReplicaRouter, ReplicaSelector, get_config as get_replica_config
+from main.geojson import iter_feature_collection
+from core.db.backends.postgis_pool.pool import ConnectionPool, PoolTimeout
+from psycopg2 import extensions as psycopg2_extensions
 
 
 # Create your tests here.
 
+def square(bbox):
+    """
+    Мультиполигон-прямоугольник (xmin, ymin, xmax, ymax) в WGS 84
+    """
+    return MultiPolygon(Polygon.from_bbox(bbox), srid=4326)
+
+
+class SharedCacheFixture:
+    """
+    Кэш 'shared' - файловый, то есть общий для процессов: кэши, сбрасываемые из других
+    процессов, не включаются на LocMemCache
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache_settings = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory.name},
+        })
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        super().setUp()
+
+
+class ProviderFixture:
+    """
+    Общие данные тестов: пользователь vasya и его поставщик self.provider
+    """
+    def setUp(self):
+        super().setUp()
+        self.vasya = User.objects.create(username='vasya', email='vasya@mail.com', password='password')
+        self.provider = self.create_provider('Поставщик')
+
+    def create_provider(self, name, email='p@mail.com', address='Ленина 1'):
+        return Provider.objects.create(name=name, email=email, phone='123', address=address, manager=self.vasya)
+
+    def create_zone(self, name, bbox, provider=None):
+        return Zone.objects.create(name=name, provider=provider or self.provider, mpoly=square(bbox))
+
+
 class CreateProvider(TestCase):
     def setUp(self):
         self.vasya = User.objects.create(username='vasya', email='vasya@mail.com', password='password')        
@@ -43,4 +110,1120 @@ class CreateProvider(TestCase):
         provider = Provider.objects.get(pk=2)
         serializer = serializers.ProviderSerializer(
             provider, data=new_data)        
-        self.assertEqual(serializer.is_valid(), True)
\ No newline at end of file
+        self.assertEqual(serializer.is_valid(), True)
+
+class ZonePointIndex(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zone = self.create_zone('Квадрат', (0, 0, 10, 10))
+
+    def test_str_tree_matches_brute_force(self):
+        """R-дерево возвращает ровно те прямоугольники, которые содержат точку"""
+        boxes = [(x, y, x + 3, y + 2) for x in range(0, 40, 2) for y in range(0, 40, 3)]
+        tree = STRTree([(box, i) for i, box in enumerate(boxes)], capacity=4)
+        for x, y in [(0, 0), (5.5, 7.1), (39, 39), (100, 100)]:
+            expected = [i for i, b in enumerate(boxes) if b[0] <= x <= b[2] and b[1] <= y <= b[3]]
+            self.assertEqual(sorted(tree.query(x, y)), expected)
+
+    @override_settings(ZONE_POINT_INDEX={'ENABLED': True})
+    def test_index_answers_point_lookup(self):
+        """Прогретый индекс находит зону по точке без запроса к базе"""
+        index = ZoneIndex()
+        index.build()
+        with self.assertNumQueries(0):
+            self.assertEqual(index.lookup(5, 5), [self.zone.pk])
+            self.assertEqual(index.lookup(15, 5), [])
+        index.remove(self.zone.pk)
+        self.assertEqual(index.lookup(5, 5), [])
+
+    @override_settings(ZONE_POINT_INDEX={'ENABLED': True})
+    def test_update_during_build_is_kept(self):
+        """Изменение зоны, пришедшее во время построения, не теряется при подмене индекса"""
+        index = ZoneIndex()
+        moved = Zone(pk=self.zone.pk, mpoly=square((20, 0, 30, 10)))
+        build_entry = ZoneIndex._entry
+
+        def entry(mpoly):
+            # Зону меняют в другом потоке, пока построение читает из базы ее старую версию
+            if mpoly is not moved.mpoly:
+                index.update(moved)
+            return build_entry(mpoly)
+
+        with mock.patch.object(ZoneIndex, '_entry', staticmethod(entry)):
+            index.build()
+        self.assertEqual(index.lookup(5, 5), [])
+        self.assertEqual(index.lookup(25, 5), [self.zone.pk])
+
+
+class ZoneDistanceLookups(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_provider('Другой', 'd@mail.com', 'Ленина 2')
+        self.near = self.create_zone('Ближняя', (0, 0, 1, 1))
+        self.middle = self.create_zone('Средняя', (2, 0, 3, 1), self.other)
+        self.far = self.create_zone('Дальняя', (10, 0, 11, 1))
+
+    def get(self, action, params):
+        request = APIRequestFactory().get(f'/zones/{action}/', params)
+        force_authenticate(request, user=self.vasya)
+        return ZoneViewSet.as_view({'get': action})(request)
+
+    def test_nearest_zones_are_ordered_by_distance(self):
+        """Ближайшие зоны выводятся по возрастанию расстояния в метрах с учетом фильтров"""
+        response = self.get('nearest', {'longitude': 1.2, 'latitude': 0.5, 'k': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([zone['id'] for zone in response.data], [self.near.pk, self.middle.pk])
+        self.assertAlmostEqual(response.data[0]['distance'], 22264, delta=100)
+        self.assertIn('services', response.data[0])
+        response = self.get('nearest', {'longitude': 1.2, 'latitude': 0.5, 'k': 5, 'provider': self.other.pk})
+        self.assertEqual([zone['id'] for zone in response.data], [self.middle.pk])
+        inside = self.get('nearest', {'longitude': 0.5, 'latitude': 0.5, 'k': 1})
+        self.assertEqual((inside.data[0]['id'], inside.data[0]['distance']), (self.near.pk, 0))
+
+    def test_service_filter_does_not_repeat_zones(self):
+        """Зона с несколькими услугами отобранного типа выводится один раз и не вытесняет другие из k ближайших"""
+        service_type = ServiceType.objects.create(name='Доставка')
+        # Создание в обход проверки пересечений: две услуги одного типа в одной зоне
+        Service.objects.bulk_create([
+            Service(name=f'Доставка {number}', zone=zone, service_type=service_type, cost=100)
+            for number, zone in enumerate([self.near, self.near, self.middle])
+        ])
+        params = {'longitude': 1.2, 'latitude': 0.5, 'services__service_type': service_type.pk}
+        response = self.get('nearest', {**params, 'k': 2})
+        self.assertEqual([zone['id'] for zone in response.data], [self.near.pk, self.middle.pk])
+        response = self.get('within', {**params, 'radius': 50000})
+        self.assertEqual([zone['id'] for zone in response.data], [self.near.pk])
+
+    def test_zones_within_radius(self):
+        """В радиус попадают только зоны не дальше заданного числа метров"""
+        response = self.get('within', {'longitude': 1.2, 'latitude': 0.5, 'radius': 50000})
+        self.assertEqual([zone['id'] for zone in response.data], [self.near.pk])
+        response = self.get('within', {'longitude': 1.2, 'latitude': 0.5, 'radius': 50000, 'geometry': 'none'})
+        self.assertNotIn('mpoly', response.data[0])
+        self.assertEqual(self.get('within', {'longitude': 1.2, 'latitude': 0.5}).status_code, 400)
+        self.assertEqual(self.get('nearest', {'latitude': 0.5}).status_code, 400)
+        self.assertEqual(self.get('nearest', {'longitude': 1.2, 'latitude': 0.5, 'k': 0}).status_code, 400)
+        self.assertEqual(self.get('within', {'longitude': 1.2, 'latitude': 0.5, 'radius': 0}).status_code, 400)
+
+
+class ZonePointsBatch(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.left = self.create_zone('Левая', (0, 0, 10, 10))
+        self.right = self.create_zone('Правая', (5, 0, 15, 10))
+
+    def test_points_are_resolved_in_one_request(self):
+        """Зоны возвращаются сгруппированными по входным точкам в их порядке"""
+        view = ZoneViewSet.as_view({'post': 'points'})
+        request = APIRequestFactory().post('/zones/points/', {'points': [[7, 5], {'longitude': 1, 'latitude': 1}, [50, 50]]}, format='json')
+        force_authenticate(request, user=self.vasya)
+        response = view(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([[zone['id'] for zone in item['zones']] for item in response.data],
+                         [[self.left.pk, self.right.pk], [self.left.pk], []])
+
+    def test_index_reset_during_lookup(self):
+        """Если индекс сбросили посреди пакета, все точки ищутся в базе"""
+        index = mock.Mock(enabled=True, warm=True, lookup=mock.Mock(side_effect=[[self.left.pk, self.right.pk], None, []]))
+        request = APIRequestFactory().post('/zones/points/', {'points': [[7, 5], [1, 1], [50, 50]]}, format='json')
+        force_authenticate(request, user=self.vasya)
+        with mock.patch('main.views.zone_index', index):
+            response = ZoneViewSet.as_view({'post': 'points'})(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([[zone['id'] for zone in item['zones']] for item in response.data],
+                         [[self.left.pk, self.right.pk], [self.left.pk], []])
+
+
+def cut_point(pieces):
+    """
+    Точка на общей линии разреза двух фрагментов ST_Subdivide либо None
+    """
+    for i, first in enumerate(pieces):
+        for second in pieces[i + 1:]:
+            shared = first.intersection(second)
+            lines = [shared] if shared.geom_type == 'LineString' else list(shared) if shared.geom_type == 'MultiLineString' else []
+            if lines and lines[0].length > 0:
+                # Разрезы идут по осям, середина отрезка лежит ровно на линии разреза
+                (x0, y0), (x1, y1) = lines[0][0], lines[0][1]
+                return GEOSGeometry(f'POINT({(x0 + x1) / 2} {(y0 + y1) / 2})', srid=4326)
+    return None
+
+
+@override_settings(ZONE_PIECES={'ENABLED': True, 'MAX_VERTICES': 64})
+class ZonePieces(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Окружность из 1000 вершин делится на несколько фрагментов
+        circle = GEOSGeometry('POINT(0 0)', srid=4326).buffer(10, quadsegs=250)
+        self.zone = Zone.objects.create(name='Круг', provider=self.provider, mpoly=MultiPolygon(circle, srid=4326))
+
+    def test_point_lookup_uses_pieces(self):
+        """Сохранение зоны пересобирает фрагменты, по ним находится зона в точке"""
+        self.assertGreater(self.zone.pieces.count(), 1)
+        self.assertEqual(list(Zone.objects.containing(GEOSGeometry('POINT(3 4)', srid=4326)).values_list('pk', flat=True)), [self.zone.pk])
+        self.assertEqual(list(Zone.objects.containing(GEOSGeometry('POINT(9 9)', srid=4326))), [])
+        self.zone.mpoly = square((20, 20, 30, 30))
+        self.zone.save()
+        self.assertEqual(self.zone.pieces.count(), 1)
+        self.assertEqual(list(Zone.objects.containing(GEOSGeometry('POINT(25 25)', srid=4326))), [self.zone])
+        self.zone.delete()
+        self.assertFalse(ZonePiece.objects.exists())
+
+    def test_failed_rebuild_keeps_pieces(self):
+        """Ошибка при вставке фрагментов откатывает и их удаление"""
+        count = self.zone.pieces.count()
+        # ST_Subdivide не принимает max_vertices меньше 5
+        with override_settings(ZONE_PIECES={'ENABLED': True, 'MAX_VERTICES': 1}):
+            with self.assertRaises(DatabaseError):
+                ZonePiece.objects.rebuild([self.zone.pk])
+        self.assertEqual(self.zone.pieces.count(), count)
+
+    def test_point_on_cut_line(self):
+        """Точка на линии разреза между фрагментами находится во всех видах поиска"""
+        pieces = [piece.geom for piece in self.zone.pieces.all()]
+        point = cut_point(pieces)
+        self.assertIsNotNone(point)
+        self.assertFalse(any(piece.contains(point) for piece in pieces))
+        self.assertEqual(list(Zone.objects.containing(point).values_list('pk', flat=True)), [self.zone.pk])
+        self.assertEqual(Zone.objects.ids_by_points([(point.x, point.y)]), [[self.zone.pk]])
+
+
+@override_settings(SERVICE_COVERAGE={'ENABLED': True, 'MAX_VERTICES': 64})
+class ServiceAvailability(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_provider('Другой', 'd@mail.com', 'Ленина 2')
+        self.delivery = ServiceType.objects.create(name='Доставка')
+        self.cleaning = ServiceType.objects.create(name='Уборка')
+        self.left = self.create_zone('Левая', (0, 0, 10, 10))
+        self.right = self.create_zone('Правая', (5, 0, 15, 10), self.other)
+        Service.objects.create(name='Доставка слева', zone=self.left, service_type=self.delivery, cost=300)
+        self.service = Service.objects.create(name='Доставка справа', zone=self.right, service_type=self.delivery, cost=150)
+        Service.objects.create(name='Уборка справа', zone=self.right, service_type=self.cleaning, cost=1000)
+
+    def get(self, params):
+        request = APIRequestFactory().get('/services/availability/', params)
+        force_authenticate(request, user=self.vasya)
+        return ServiceViewSet.as_view({'get': 'availability'})(request)
+
+    def test_availability_in_one_query(self):
+        """Доступность и цены типа услуги в точке находятся одним запросом по покрытию"""
+        with self.assertNumQueries(1):
+            response = self.get({'longitude': 7, 'latitude': 5, 'service_type': self.delivery.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'service_type': self.delivery.pk, 'available': True, 'min_cost': '150.00', 'max_cost': '300.00',
+            'providers': sorted([self.provider.pk, self.other.pk]), 'zones': [self.left.pk, self.right.pk],
+        })
+        response = self.get({'longitude': 2, 'latitude': 5})
+        self.assertEqual([row['service_type'] for row in response.data], [self.delivery.pk])
+        response = self.get({'longitude': 2, 'latitude': 5, 'service_type': self.cleaning.pk})
+        self.assertFalse(response.data['available'])
+        self.assertEqual(self.get({'latitude': 5}).status_code, 400)
+
+    def test_coverage_follows_changes(self):
+        """Покрытие пересобирается при изменении и удалении услуг и зон"""
+        self.service.cost = 500
+        self.service.save()
+        self.assertEqual(self.get({'longitude': 12, 'latitude': 5, 'service_type': self.delivery.pk}).data['min_cost'], '500.00')
+        self.service.delete()
+        self.assertFalse(self.get({'longitude': 12, 'latitude': 5, 'service_type': self.delivery.pk}).data['available'])
+        self.right.mpoly = square((20, 0, 30, 10))
+        self.right.save()
+        self.assertEqual(self.get({'longitude': 7, 'latitude': 5}).data[0]['zones'], [self.left.pk])
+        response = self.get({'longitude': 25, 'latitude': 5})
+        self.assertEqual([row['service_type'] for row in response.data], [self.cleaning.pk])
+        self.right.delete()
+        self.assertFalse(ServiceCoverage.objects.filter(zone_id=self.right.pk).exists())
+
+    def test_point_on_cut_line(self):
+        """Точка на линии разреза между фрагментами покрытия считается покрытой"""
+        circle = GEOSGeometry('POINT(50 50)', srid=4326).buffer(10, quadsegs=250)
+        zone = Zone.objects.create(name='Круг', provider=self.provider, mpoly=MultiPolygon(circle, srid=4326))
+        Service.objects.create(name='Уборка в круге', zone=zone, service_type=self.cleaning, cost=700)
+        pieces = list(ServiceCoverage.objects.filter(zone=zone).values_list('geom', flat=True))
+        self.assertGreater(len(pieces), 1)
+        point = cut_point(pieces)
+        self.assertIsNotNone(point)
+        response = self.get({'longitude': point.x, 'latitude': point.y, 'service_type': self.cleaning.pk})
+        self.assertTrue(response.data['available'])
+        self.assertEqual(response.data['zones'], [zone.pk])
+
+    @override_settings(SERVICE_COVERAGE={'ENABLED': False})
+    def test_availability_without_coverage(self):
+        """Без таблицы покрытия ответ тот же"""
+        response = self.get({'longitude': 7, 'latitude': 5, 'service_type': self.delivery.pk})
+        self.assertEqual((response.data['min_cost'], response.data['max_cost']), ('150.00', '300.00'))
+
+
+@override_settings(ZONE_JOBS={'ENABLED': True})
+class DeferredZoneWrites(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service_type = ServiceType.objects.create(name='Доставка')
+
+    def send(self, method, path, data, action, **kwargs):
+        request = getattr(APIRequestFactory(), method)(path, data, format='json', HTTP_PREFER='respond-async')
+        force_authenticate(request, user=self.vasya)
+        return ZoneViewSet.as_view({method: action})(request, **kwargs)
+
+    def run_jobs(self):
+        call_command('run_zone_jobs', workers=1, once=True, stdout=io.StringIO())
+
+    def test_create_is_deferred(self):
+        """Зона создается воркером, невалидная геометрия исправляется ST_MakeValid"""
+        response = self.send('post', '/zones/', {
+            'name': 'Бабочка', 'provider': self.provider.pk,
+            'mpoly': 'SRID=4326;MULTIPOLYGON(((0 0, 10 10, 10 0, 0 10, 0 0)))',
+        }, 'create')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], ZoneJob.PENDING)
+        self.assertIn(f'/zone-jobs/{response.data["id"]}/', response['Location'])
+        self.assertFalse(Zone.objects.exists())
+        self.run_jobs()
+        job = ZoneJob.objects.get(pk=response.data['id'])
+        self.assertEqual((job.status, job.repaired), (ZoneJob.DONE, True))
+        self.assertTrue(job.zone.mpoly.valid)
+        self.assertAlmostEqual(job.zone.mpoly.area, 50)
+
+    def test_update_with_service_overlap_fails(self):
+        """Изменение геометрии, при котором услуги зоны пересекаются, откатывается"""
+        left = self.create_zone('Левая', (0, 0, 10, 10))
+        right = self.create_zone('Правая', (20, 0, 30, 10))
+        Service.objects.create(name='Доставка слева', zone=left, service_type=self.service_type, cost=100)
+        service = Service.objects.create(name='Доставка справа', zone=right, service_type=self.service_type, cost=100)
+        response = self.send('patch', f'/zones/{right.pk}/', {'mpoly': 'SRID=4326;MULTIPOLYGON(((5 0, 15 0, 15 10, 5 10, 5 0)))'},
+                             'partial_update', pk=right.pk)
+        self.assertEqual(response.status_code, 202)
+        self.run_jobs()
+        job = ZoneJob.objects.get(pk=response.data['id'])
+        self.assertEqual(job.status, ZoneJob.FAILED)
+        self.assertIn(str(service.pk), job.errors['services'])
+        right.refresh_from_db()
+        self.assertEqual(right.mpoly.extent, (20, 0, 30, 10))
+
+
+class ReadQueryCount(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service_type = ServiceType.objects.create(name='Доставка')
+
+    def add_zone(self, number):
+        zone = self.create_zone(f'Зона {number}', (number * 10, 0, number * 10 + 5, 5))
+        Service.objects.create(name=f'Услуга {number}', zone=zone, service_type=self.service_type, cost=100)
+
+    def count_queries(self, view, path):
+        request = APIRequestFactory().get(path)
+        force_authenticate(request, user=self.vasya)
+        with CaptureQueriesContext(connection) as context:
+            response = view(request)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_zone_list_query_count_is_constant(self):
+        """Число запросов при выводе списка зон не зависит от количества зон"""
+        view = ZoneViewSet.as_view({'get': 'list'})
+        self.add_zone(1)
+        one = self.count_queries(view, '/zones/')
+        for number in range(2, 6):
+            self.add_zone(number)
+        self.assertEqual(self.count_queries(view, '/zones/'), one)
+        # Валидаторы ответа (ETag), зоны с поставщиками и услуги с типами
+        self.assertEqual(one, 3)
+        slow_view = ZoneViewSet.as_view({'get': 'list'}, fast_read=False)
+        self.assertEqual(self.count_queries(slow_view, '/zones/'), 4)
+
+    def test_service_list_query_count_is_constant(self):
+        """Число запросов при выводе списка услуг не зависит от количества услуг"""
+        view = ServiceViewSet.as_view({'get': 'list'})
+        self.add_zone(1)
+        one = self.count_queries(view, '/services/')
+        for number in range(2, 6):
+            self.add_zone(number)
+        self.assertEqual(self.count_queries(view, '/services/'), one)
+        self.assertEqual(one, 2)
+
+
+class FastReadParity(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        providers = [self.provider, self.create_provider('Поставщик 1', 'p1@mail.com')]
+        service_types = [ServiceType.objects.create(name=name) for name in ('Доставка', 'Уборка')]
+        for number in range(4):
+            zone = self.create_zone(f'Зона {number}', (number, 0, number + 5.123456, 5), providers[number % 2])
+            for service_type in service_types[:number % 2 + 1]:
+                Service.objects.create(name=f'{service_type} {number}', zone=zone, service_type=service_type, cost='99.5')
+
+    def get(self, action, path, params, fast_read, viewset=ZoneViewSet):
+        request = APIRequestFactory().get(path, params)
+        force_authenticate(request, user=self.vasya)
+        response = viewset.as_view({'get': action}, fast_read=fast_read)(request)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.render().content)
+
+    def test_fast_read_matches_serializers(self):
+        """Ответы без сериалайзеров совпадают с выводом ZoneSerializerRead и ServiceSerializerRead"""
+        cases = [
+            ('list', '/zones/', {}),
+            ('list', '/zones/', {'provider': Provider.objects.first().pk, 'page_size': 1}),
+            ('list', '/zones/', {'geometry': 'bbox', 'precision': 2}),
+            ('list', '/zones/', {'simplify': 0.1}),
+            ('list', '/zones/', {'geometry': 'none'}),
+            ('list', '/zones/', {'geometry_format': 'twkb'}),
+            ('point', '/zones/point/', {'longitude': 4.5, 'latitude': 1}),
+        ]
+        for action, path, params in cases:
+            with self.subTest(action=action, params=params):
+                self.assertEqual(self.get(action, path, params, True), self.get(action, path, params, False))
+        self.assertEqual(self.get('list', '/services/', {}, True, ServiceViewSet),
+                         self.get('list', '/services/', {}, False, ServiceViewSet))
+
+    def test_fast_point_query_count_is_constant(self):
+        """Зоны в точке выводятся без сериалайзеров тем же числом запросов, что и список"""
+        def count():
+            with CaptureQueriesContext(connection) as context:
+                self.get('point', '/zones/point/', {'longitude': 4.5, 'latitude': 1}, True)
+            return len(context.captured_queries)
+
+        before = count()
+        # Валидаторы ответа (ETag), зоны с поставщиками и услуги с типами
+        self.assertEqual(before, 3)
+        zone = self.create_zone('Зона 4', (4, 0, 9, 5))
+        Service.objects.create(name='Доставка 4', zone=zone, service_type=ServiceType.objects.first(), cost=1)
+        self.assertEqual(count(), before)
+
+
+class ConditionalRequests(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service_type = ServiceType.objects.create(name='Доставка')
+        self.zone = self.create_zone('Квадрат', (0, 0, 10, 10))
+
+    def get(self, action, path, params=None, **headers):
+        request = APIRequestFactory().get(path, params or {}, **headers)
+        force_authenticate(request, user=self.vasya)
+        kwargs = {'pk': self.zone.pk} if action == 'retrieve' else {}
+        return ZoneViewSet.as_view({'get': action})(request, **kwargs)
+
+    def test_unchanged_resources_are_not_modified(self):
+        """Повторный запрос с ETag получает 304 одним агрегирующим запросом, изменение услуги меняет ETag"""
+        cases = [
+            ('list', '/zones/', {'provider': self.provider.pk}),
+            ('retrieve', f'/zones/{self.zone.pk}/', {}),
+            ('point', '/zones/point/', {'longitude': 5, 'latitude': 5}),
+        ]
+        for action, path, params in cases:
+            with self.subTest(action=action):
+                response = self.get(action, path, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('Last-Modified', response)
+                etag = response['ETag']
+                with self.assertNumQueries(1):
+                    response = self.get(action, path, params, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+        etag = self.get('list', '/zones/')['ETag']
+        Service.objects.create(name='Доставка', zone=self.zone, service_type=self.service_type, cost=100)
+        self.assertEqual(self.get('list', '/zones/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_deleted_zone_changes_validators(self):
+        """Удаление зоны из списка меняет ETag, даже если остальные зоны не менялись"""
+        self.create_zone('Другой', (20, 0, 30, 10))
+        etag = self.get('list', '/zones/')['ETag']
+        self.zone.delete()
+        self.assertEqual(self.get('list', '/zones/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+@override_settings(ACCESS_CACHE={'CROSS_REQUEST': True, 'CACHE_ALIAS': 'shared'})
+class CrossRequestScopeCache(SharedCacheFixture, ProviderFixture, TestCase):
+    def scope(self):
+        # Свежий объект пользователя - как в новом запросе, возможно другого процесса
+        return get_scope(User.objects.get(pk=self.vasya.pk))
+
+    def test_revoked_manager_loses_scope(self):
+        """Область берется из общего кэша и сбрасывается при смене менеджера поставщика"""
+        self.assertEqual(self.scope().provider_ids, {self.provider.pk})
+        with self.assertNumQueries(1):
+            self.assertEqual(self.scope().provider_ids, {self.provider.pk})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.provider.manager = User.objects.create(username='petya')
+            self.provider.save()
+        self.assertEqual(self.scope().provider_ids, frozenset())
+
+    def test_process_local_cache_is_refused(self):
+        """Межзапросный кэш областей нельзя включить на кэше отдельного процесса"""
+        with override_settings(ACCESS_CACHE={'CROSS_REQUEST': True, 'CACHE_ALIAS': 'default'}):
+            with self.assertRaises(ImproperlyConfigured):
+                get_scope(self.vasya)
+
+
+@override_settings(ZONE_POINT_CACHE={'ENABLED': True, 'CACHE_ALIAS': 'shared', 'KEY_PREFIX': 'test-zone-point'})
+class ZonePointCache(SharedCacheFixture, ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zone = self.create_zone('Квадрат', (0, 0, 1, 1))
+
+    def get_point(self, longitude, latitude):
+        request = APIRequestFactory().get('/zones/point/', {'longitude': longitude, 'latitude': latitude})
+        force_authenticate(request, user=self.vasya)
+        return ZoneViewSet.as_view({'get': 'point'})(request)
+
+    def test_repeated_lookup_is_served_from_cache(self):
+        """Повторный запрос в ту же ячейку сетки не обращается к базе"""
+        self.assertEqual(len(self.get_point(0.5, 0.5).data), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.get_point(0.500001, 0.5).data), 1)
+
+    def test_zone_edit_evicts_only_touched_cells(self):
+        """Изменение зоны сбрасывает ответы в ее охвате, но не в далеких ячейках"""
+        self.get_point(0.5, 0.5)
+        self.get_point(50, 50)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.name = 'Новое имя'
+            self.zone.save()
+        self.assertEqual(self.get_point(0.5, 0.5).data[0]['name'], 'Новое имя')
+        with self.assertNumQueries(0):
+            self.get_point(50, 50)
+
+    def test_evicted_version_does_not_revive_response(self):
+        """Вытесненная версия корзины не возвращает ответ, сохраненный до изменения зоны"""
+        self.get_point(0.5, 0.5)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.name = 'Новое имя'
+            self.zone.save()
+        self.assertEqual(self.get_point(0.5, 0.5).data[0]['name'], 'Новое имя')
+        caches['shared'].delete_many([point_cache._key('generation'), point_cache._key('bucket', *point_cache._bucket(*point_cache.snap(0.5, 0.5)))])
+        self.assertEqual(self.get_point(0.5, 0.5).data[0]['name'], 'Новое имя')
+
+    def test_process_local_cache_is_refused(self):
+        """Кэш точек нельзя включить на кэше отдельного процесса"""
+        with override_settings(ZONE_POINT_CACHE={'ENABLED': True, 'CACHE_ALIAS': 'default'}):
+            with self.assertRaises(ImproperlyConfigured):
+                point_cache.enabled
+
+
+@override_settings(ZONE_TILE_CACHE={'ENABLED': True, 'CACHE_ALIAS': 'shared'})
+class ZoneTiles(SharedCacheFixture, ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.zone = self.create_zone('Квадрат', (37.5, 55.7, 37.7, 55.8))
+
+    def get_tile(self, z, x, y, params=None, **headers):
+        request = APIRequestFactory().get(f'/zones/tiles/{z}/{x}/{y}.mvt', params or {}, **headers)
+        force_authenticate(request, user=self.vasya)
+        return ZoneViewSet.as_view({'get': 'tiles'})(request, z=z, x=x, y=y)
+
+    def test_tile_range_covers_extent(self):
+        """Диапазон тайлов охвата включает тайл с точкой и соседние"""
+        (x0, x1), (y0, y1) = tile_range((37.6, 55.75, 37.6, 55.75), 10)
+        self.assertEqual((x0, x1, y0, y1), (617, 619, 319, 321))
+        self.assertEqual(tile_range((-180, -90, 180, 90), 1), ((0, 1), (0, 1)))
+
+    def test_tiles_are_filtered_and_cached(self):
+        """Тайл содержит зоны в его охвате с учетом фильтров, повторный запрос берется из кэша"""
+        response = self.get_tile(10, 618, 320)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn('Квадрат'.encode(), response.content)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_tile(10, 618, 320).content, response.content)
+        self.assertEqual(self.get_tile(10, 0, 0).content, b'')
+        self.assertEqual(self.get_tile(10, 618, 320, {'provider': self.provider.pk + 1}).status_code, 400)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.name = 'Новый квадрат'
+            self.zone.save()
+        self.assertIn('Новый квадрат'.encode(), self.get_tile(10, 618, 320).content)
+        self.assertEqual(self.get_tile(3, 8, 0).status_code, 404)
+
+    def test_only_tiles_in_zone_extent_are_invalidated(self):
+        """Изменение зоны сбрасывает тайлы ее прежнего и нового охвата, остальные берутся из кэша"""
+        outside = self.get_tile(10, 0, 0)
+        self.get_tile(10, 618, 320)
+        self.get_tile(10, 620, 320)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.mpoly = square((37.9, 55.7, 38.0, 55.8))
+            self.zone.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_tile(10, 0, 0)['ETag'], outside['ETag'])
+        # Прежний охват: зоны в тайле больше нет, новый охват: зона появилась
+        self.assertNotIn('Квадрат'.encode(), self.get_tile(10, 618, 320).content)
+        self.assertIn('Квадрат'.encode(), self.get_tile(10, 620, 320).content)
+
+    def test_evicted_version_does_not_revive_etag(self):
+        """Вытесненная из кэша версия уровня не возвращает прежний ETag: нет ложного 304"""
+        etag = self.get_tile(10, 618, 320)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.zone.name = 'Новый квадрат'
+            self.zone.save()
+        changed = self.get_tile(10, 618, 320)
+        self.assertNotEqual(changed['ETag'], etag)
+        caches['shared'].delete_many([tile_cache._key('generation'), tile_cache._key('zoom', 10), tile_cache._key('version', 10, 618, 320)])
+        for previous in (etag, changed['ETag']):
+            response = self.get_tile(10, 618, 320, HTTP_IF_NONE_MATCH=previous)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('Новый квадрат'.encode(), response.content)
+        self.assertEqual(self.get_tile(10, 618, 320, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_process_local_cache_is_refused(self):
+        """Кэш тайлов нельзя включить на кэше отдельного процесса"""
+        with override_settings(ZONE_TILE_CACHE={'ENABLED': True, 'CACHE_ALIAS': 'default'}):
+            with self.assertRaises(ImproperlyConfigured):
+                tile_cache.enabled
+
+
+class ZoneGeometryOptions(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        triangle = Polygon(((0, 0), (10, 0), (10.000001, 5), (10, 10), (0, 0)))
+        self.zone = Zone.objects.create(name='Треугольник', provider=self.provider, mpoly=MultiPolygon(triangle, srid=4326))
+
+    def get_zones(self, params, **headers):
+        request = APIRequestFactory().get('/zones/', params, **headers)
+        force_authenticate(request, user=self.vasya)
+        return ZoneViewSet.as_view({'get': 'list'})(request)
+
+    def test_geometry_can_be_omitted_or_reduced(self):
+        """Геометрию можно исключить, заменить прямоугольником или упростить"""
+        self.assertNotIn('mpoly', self.get_zones({'geometry': 'none'}).data['results'][0])
+        bbox = GEOSGeometry(self.get_zones({'geometry': 'bbox'}).data['results'][0]['mpoly'])
+        self.assertEqual(bbox.extent, (0, 0, 10.000001, 10))
+        simplified = GEOSGeometry(self.get_zones({'simplify': '0.001', 'precision': '3'}).data['results'][0]['mpoly'])
+        self.assertEqual(simplified.num_coords, 4)
+        self.assertEqual(GEOSGeometry(self.get_zones({}).data['results'][0]['mpoly']).num_coords, 5)
+
+    def test_binary_geometry_formats(self):
+        """WKB и TWKB выводятся шестнадцатеричной строкой, формат можно запросить через Accept"""
+        wkb = self.get_zones({'geometry_format': 'wkb'}).data['results'][0]['mpoly']
+        self.assertTrue(GEOSGeometry(bytes.fromhex(wkb)).equals(self.zone.mpoly))
+        twkb = self.get_zones({'geometry_format': 'twkb', 'precision': 6}).data['results'][0]['mpoly']
+        self.assertLess(len(twkb), len(wkb) / 2)
+        response = self.get_zones({}, HTTP_ACCEPT='application/json; geometry-format=twkb')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['mpoly'], self.get_zones({'geometry_format': 'twkb'}).data['results'][0]['mpoly'])
+
+    def test_invalid_geometry_options_are_rejected(self):
+        """Неверные параметры геометрии приводят к ошибке 400"""
+        self.assertEqual(self.get_zones({'geometry': 'points'}).status_code, 400)
+        self.assertEqual(self.get_zones({'precision': 'many'}).status_code, 400)
+        for simplify in ('-1', 'nan', 'inf'):
+            self.assertEqual(self.get_zones({'simplify': simplify}).status_code, 400)
+        self.assertEqual(self.get_zones({'geometry_format': 'svg'}).status_code, 400)
+
+
+class ServiceOverlaps(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.service_type = ServiceType.objects.create(name='Доставка')
+        self.left = self.create_zone('Левая', (0, 0, 10, 10))
+        self.right = self.create_zone('Правая', (5, 0, 15, 10))
+        self.far = self.create_zone('Дальняя', (50, 0, 60, 10))
+        self.service = Service.objects.create(name='Доставка слева', zone=self.left, service_type=self.service_type, cost=100)
+
+    def test_conflicts_are_found_in_one_query(self):
+        """Пересечения для нескольких услуг находятся одним запросом"""
+        with self.assertNumQueries(1):
+            conflicts = find_service_conflicts([
+                (self.right.pk, self.service_type.pk, None),
+                (self.far.pk, self.service_type.pk, None),
+                (self.left.pk, self.service_type.pk, self.service.pk),
+            ])
+        self.assertEqual(conflicts, [['Левая'], [], []])
+
+    def test_overlapping_service_is_rejected_and_own_update_is_allowed(self):
+        """Услугу того же типа нельзя создать в пересекающейся зоне, но существующую можно изменить"""
+        with self.assertRaises(ValidationError):
+            Service.objects.create(name='Доставка справа', zone=self.right, service_type=self.service_type, cost=100)
+        self.service.cost = 200
+        self.service.save()
+
+    def test_partial_update_does_not_load_zone_geometry(self):
+        """Частичное обновление услуги проверяет пересечения по pk зоны, не загружая ее геометрию"""
+        service = Service.objects.get(pk=self.service.pk)
+        serializer = serializers.ServiceSerializerWrite(service, data={'name': 'Доставка'}, partial=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(serializer.is_valid())
+        zone_mpoly = f'{connection.ops.quote_name(Zone._meta.db_table)}.{connection.ops.quote_name("mpoly")}'
+        self.assertFalse(any(zone_mpoly in query['sql'] for query in queries.captured_queries))
+        other = Service.objects.create(name='Доставка вдали', zone=self.far, service_type=self.service_type, cost=100)
+        self.assertFalse(serializers.ServiceSerializerWrite(other, data={'zone': self.right.pk}, partial=True).is_valid())
+
+    def test_bulk_create_reports_per_item_errors(self):
+        """Пакетное создание проверяет пересечения с существующими услугами и внутри пакета"""
+        other_type = ServiceType.objects.create(name='Уборка')
+        view = ServiceViewSet.as_view({'post': 'bulk'})
+
+        def post(data):
+            request = APIRequestFactory().post('/services/bulk/', data, format='json')
+            force_authenticate(request, user=self.vasya)
+            return view(request)
+
+        response = post([
+            {'name': 'Уборка слева', 'zone': self.left.pk, 'service_type': other_type.pk, 'cost': '10.00'},
+            {'name': 'Уборка справа', 'zone': self.right.pk, 'service_type': other_type.pk, 'cost': '10.00'},
+            {'name': 'Доставка справа', 'zone': self.right.pk, 'service_type': self.service_type.pk, 'cost': '10.00'},
+            {'name': 'Доставка вдали', 'zone': self.far.pk, 'service_type': self.service_type.pk, 'cost': '10.00'},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([bool(item_errors) for item_errors in response.data], [False, True, True, False])
+        self.assertEqual(Service.objects.count(), 1)
+
+        response = post([
+            {'name': 'Уборка слева', 'zone': self.left.pk, 'service_type': other_type.pk, 'cost': '10.00'},
+            {'name': 'Доставка вдали', 'zone': self.far.pk, 'service_type': self.service_type.pk, 'cost': '10.00'},
+        ])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Service.objects.count(), 3)
+
+    def test_bulk_update(self):
+        """Пакетное изменение учитывает новое состояние всех услуг пакета"""
+        far_service = Service.objects.create(name='Доставка вдали', zone=self.far, service_type=self.service_type, cost=100)
+        view = ServiceViewSet.as_view({'patch': 'bulk'})
+
+        def patch(data):
+            request = APIRequestFactory().patch('/services/bulk/', data, format='json')
+            force_authenticate(request, user=self.vasya)
+            return view(request)
+
+        # Левая услуга уходит вдаль, дальняя - в правую зону: с прежним состоянием левой был бы конфликт
+        response = patch([
+            {'id': far_service.pk, 'zone': self.right.pk},
+            {'id': self.service.pk, 'zone': self.far.pk, 'cost': '50.00'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.service.refresh_from_db()
+        self.assertEqual((self.service.zone_id, str(self.service.cost)), (self.far.pk, '50.00'))
+        self.assertEqual(Service.objects.get(pk=far_service.pk).zone_id, self.right.pk)
+
+        response = patch([{'id': far_service.pk, 'zone': self.left.pk}, {'zone': self.left.pk}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.data[1]), ['id'])
+        self.assertEqual(Service.objects.get(pk=far_service.pk).zone_id, self.right.pk)
+
+
+class ImportZones(ProviderFixture, TestCase):
+    def feature(self, name, coordinates):
+        return {'type': 'Feature', 'properties': {'name': name}, 'geometry': {'type': 'Polygon', 'coordinates': coordinates}}
+
+    def test_feature_collection_is_read_in_small_chunks(self):
+        """Объекты FeatureCollection читаются по одному при любом размере блока"""
+        features = [self.feature(f'Зона {i}', [[[0, 0], [1, 0], [1, 1], [0, 0]]]) for i in range(20)]
+        text = json.dumps({'type': 'FeatureCollection', 'crs': {'properties': {'name': 'features'}}, 'features': features})
+        for chunk_size in (1, 7, 4096):
+            self.assertEqual(list(iter_feature_collection(io.StringIO(text), chunk_size)), features)
+
+    def test_import_repairs_geometries_and_resumes(self):
+        """Импорт исправляет геометрии, пропускает ошибочные объекты и продолжается с места остановки"""
+        bowtie = [[[0, 0], [2, 2], [2, 0], [0, 2], [0, 0]]]
+        square = [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]
+        lines = [self.feature('Бабочка', bowtie), self.feature('Квадрат', square), {'type': 'Feature', 'properties': {}, 'geometry': None}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'zones.ndjson')
+            state = os.path.join(directory, 'state.json')
+            with open(path, 'w') as f:
+                f.write('\n'.join(json.dumps(line) for line in lines[:2]))
+            stderr = io.StringIO()
+            call_command('import_zones', path, provider=self.provider.pk, batch_size=1, state_file=state, stdout=io.StringIO(), stderr=stderr)
+            self.assertIn('Feature 1: invalid geometry repaired, area changed', stderr.getvalue())
+            with open(path, 'a') as f:
+                f.write('\n' + json.dumps(lines[2]) + '\n' + json.dumps(self.feature('Еще квадрат', square)))
+            call_command('import_zones', path, provider=self.provider.pk, state_file=state, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(list(Zone.objects.order_by('pk').values_list('name', flat=True)), ['Бабочка', 'Квадрат', 'Еще квадрат'])
+        bowtie_zone = Zone.objects.get(name='Бабочка')
+        self.assertTrue(bowtie_zone.mpoly.valid)
+        self.assertEqual(len(bowtie_zone.mpoly), 2)
+        # ST_MakeValid сохраняет обе половины бабочки
+        self.assertAlmostEqual(bowtie_zone.mpoly.area, 2)
+
+
+class ExportZones(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        service_type = ServiceType.objects.create(name='Доставка')
+        for number in range(3):
+            zone = self.create_zone(f'Зона "{number}"', (number * 10, 0, number * 10 + 5, 5))
+            Service.objects.create(name='Доставка', zone=zone, service_type=service_type, cost=100)
+
+    def export(self, params):
+        request = APIRequestFactory().get('/zones/export/', params)
+        force_authenticate(request, user=self.vasya)
+        response = ZoneViewSet.as_view({'get': 'export'})(request)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_ndjson_export_streams_one_feature_per_line(self):
+        """NDJSON-выгрузка содержит по объекту на зону с геометрией и услугами"""
+        features = [json.loads(line) for line in self.export({}).splitlines()]
+        self.assertEqual([feature['properties']['name'] for feature in features], ['Зона "0"', 'Зона "1"', 'Зона "2"'])
+        self.assertEqual(features[1]['geometry']['type'], 'MultiPolygon')
+        self.assertEqual(features[2]['properties']['services'][0]['service_type']['name'], 'Доставка')
+
+    def test_geojson_export_is_a_feature_collection(self):
+        """GeoJSON-выгрузка - корректная FeatureCollection"""
+        collection = json.loads(self.export({'output': 'geojson', 'geometry': 'none'}))
+        self.assertEqual(len(collection['features']), 3)
+        self.assertIsNone(collection['features'][0]['geometry'])
+
+
+class CursorPaginationTest(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        providers = [self.provider, self.create_provider('Поставщик 1')]
+        for number in range(7):
+            self.create_zone(f'Зона {number}', (number * 10, 0, number * 10 + 5, 5), providers[number % 2])
+
+    def test_pages_follow_pk_order_with_filters(self):
+        """Курсорные страницы идут по возрастанию pk и сочетаются с фильтрами"""
+        view = ZoneViewSet.as_view({'get': 'list'})
+        url, params, seen = '/zones/', {'page_size': 2, 'provider': self.provider.pk, 'geometry': 'none'}, []
+        while url:
+            request = APIRequestFactory().get(url, params)
+            force_authenticate(request, user=self.vasya)
+            response = view(request)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(zone['id'] for zone in response.data['results'])
+            url, params = response.data['next'], {}
+        self.assertEqual(seen, list(Zone.objects.filter(provider=self.provider).order_by('pk').values_list('pk', flat=True)))
+
+
+class ManagedScopeCache(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.petya = User.objects.create(username='petya', email='petya@mail.com', password='password')
+        self.zone = self.create_zone('Квадрат', (0, 0, 1, 1))
+
+    def test_permission_checks_cost_at_most_one_query(self):
+        """Все проверки прав пользователя в рамках запроса стоят не больше одного запроса"""
+        user = User.objects.get(pk=self.vasya.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(self.zone.is_manager(user))
+            self.assertTrue(Zone.can_create(user, {'provider': self.provider.pk}))
+            self.assertTrue(Service.can_create(user, {'zone': str(self.zone.pk)}))
+            self.assertTrue(self.zone.can_update(user, {'provider': self.provider.pk}))
+        self.assertFalse(Service.can_create(self.petya, {'zone': self.zone.pk}))
+
+    def test_scope_is_refreshed_after_changes(self):
+        """После создания зоны пользователь сразу получает права на нее"""
+        user = User.objects.get(pk=self.vasya.pk)
+        self.assertTrue(self.zone.is_manager(user))
+        zone = self.create_zone('Новая', (2, 2, 3, 3))
+        self.assertTrue(zone.is_manager(user))
+
+
+class Benchmark(TestCase):
+    def test_synthetic_data_and_report(self):
+        """Генератор создает заданный объем данных, замер пишет метрики по каждому АПИ и откатывает данные"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.json')
+            call_command('benchmark', providers=2, zones=6, services=12, vertices=16, requests=3, warmup=1,
+                         alloc_samples=1, batch_points=5, output=path, stdout=io.StringIO())
+            with open(path) as f:
+                results = json.load(f)
+        self.assertEqual(results['dataset']['zones'], 6)
+        self.assertEqual(results['dataset']['services'], 12)
+        self.assertIn('zones-point', results['endpoints'])
+        for result in results['endpoints'].values():
+            self.assertEqual(result['requests'], 3)
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['queries']['mean'], 0)
+        self.assertFalse(Zone.objects.exists())
+
+    def test_point_concurrency(self):
+        """Нагрузочная команда считает запросы и ошибки по каждому URL"""
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path.startswith('/ok/') else 500)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            base = f'http://127.0.0.1:{server.server_port}'
+            stdout = io.StringIO()
+            call_command('point_concurrency', url=[f'ok={base}/ok/', f'fail={base}/fail/'], concurrency=3, requests=6,
+                         stdout=stdout, stderr=io.StringIO())
+        finally:
+            server.shutdown()
+            server.server_close()
+        results = json.loads(stdout.getvalue())
+        self.assertEqual((results['ok']['requests'], results['ok']['errors']), (6, 0))
+        self.assertEqual(results['fail']['errors'], 6)
+        with self.assertRaises(CommandError):
+            call_command('point_concurrency', url=['no-name'])
+
+
+class CreateIndexes(TestCase):
+    def test_prints_concurrent_index_sql(self):
+        """Команда печатает CREATE INDEX CONCURRENTLY для индексов из Meta, лишних индексов в новой базе нет"""
+        stdout = io.StringIO()
+        call_command('create_indexes', stdout=stdout)
+        statements = stdout.getvalue().splitlines()
+        self.assertEqual([sql.split()[6] for sql in statements],
+                         ['"zone_mpoly_gist"', '"zone_provider_id_idx"', '"zone_mpoly_geog_gist"', '"service_zone_type_idx"'])
+        self.assertTrue(all(sql.startswith('CREATE INDEX CONCURRENTLY IF NOT EXISTS') for sql in statements))
+        self.assertIn('WITH (buffering = on, fillfactor = 90)', statements[0])
+
+
+class AddUpdatedAt(ProviderFixture, TestCase):
+    def test_adds_missing_columns_only(self):
+        """Команда добавляет updated_at со значением по умолчанию и ничего не меняет, если столбец уже есть"""
+        stdout = io.StringIO()
+        call_command('add_updated_at', stdout=stdout)
+        statements = stdout.getvalue().splitlines()
+        tables = {model._meta.db_table for model in (Zone, Service, Provider, ServiceType)}
+        self.assertEqual({sql.split()[2].strip('"') for sql in statements}, tables)
+        self.assertTrue(all(sql.endswith('ADD COLUMN IF NOT EXISTS "updated_at" timestamptz NOT NULL DEFAULT now();') for sql in statements))
+        zone = self.create_zone('Квадрат', (0, 0, 10, 10))
+        with connection.cursor() as cursor:
+            cursor.execute(f'ALTER TABLE "{Zone._meta.db_table}" DROP COLUMN "updated_at"')
+        call_command('add_updated_at', '--apply', stdout=io.StringIO())
+        self.assertIsNotNone(Zone.objects.get(pk=zone.pk).updated_at)
+
+
+@override_settings(ASYNC_POINT_LOOKUP={'DRIVER': 'thread'})
+class AsyncPointParity(ProviderFixture, TransactionTestCase):
+    # Драйвер 'thread' выполняет ZoneViewSet.point в другом потоке со своим соединением:
+    # данные должны быть зафиксированы, поэтому TransactionTestCase
+    def setUp(self):
+        super().setUp()
+        service_type = ServiceType.objects.create(name='Доставка')
+        for number in range(3):
+            zone = self.create_zone(f'Зона {number}', (number, 0, number + 5, 5))
+            Service.objects.create(name=f'Доставка {number}', zone=zone, service_type=service_type, cost='99.5')
+
+    def request(self, path, params, **headers):
+        request = APIRequestFactory().get(path, params, **headers)
+        force_authenticate(request, user=self.vasya)
+        return request
+
+    def test_async_point_matches_sync(self):
+        """Асинхронное АПИ зон в точке отвечает так же, как zones/point"""
+        for params in ({'longitude': 4.5, 'latitude': 1}, {'longitude': 1.5, 'latitude': 1, 'provider': Provider.objects.get().pk}, {'longitude': 50, 'latitude': 50}):
+            with self.subTest(params=params):
+                expected = ZoneViewSet.as_view({'get': 'point'})(self.request('/zones/point/', params)).render()
+                response = async_to_sync(zones_point)(self.request('/zones/point/async/', params))
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+    @skipUnless(asyncpg, 'asyncpg is not installed')
+    @override_settings(ASYNC_POINT_LOOKUP={'DRIVER': 'asyncpg', 'POOL_MAX_SIZE': 2})
+    def test_asyncpg_point_matches_sync(self):
+        """Путь asyncpg отвечает так же, как zones/point, отдает ETag и отклоняет параметры геометрии"""
+        cases = [{'longitude': 4.5, 'latitude': 1}, {'longitude': 1.5, 'latitude': 1, 'provider': self.provider.pk},
+                 {'longitude': 4.5, 'latitude': 1, 'services__service_type': ServiceType.objects.get().pk}, {'longitude': 50, 'latitude': 50}]
+
+        async def run():
+            try:
+                responses = [await zones_point(self.request('/zones/point/async/', params)) for params in cases]
+                not_modified = await zones_point(self.request('/zones/point/async/', cases[0], HTTP_IF_NONE_MATCH=responses[0]['ETag']))
+                rejected = [
+                    await zones_point(self.request('/zones/point/async/', {**cases[0], **options}))
+                    for options in ({'geometry': 'bbox'}, {'simplify': 'abc'}, {'geometry_format': 'twkb'})
+                ]
+                return responses, not_modified, rejected
+            finally:
+                await close_pool()
+
+        responses, not_modified, rejected = async_to_sync(run)()
+        for params, response in zip(cases, responses):
+            with self.subTest(params=params):
+                expected = ZoneViewSet.as_view({'get': 'point'})(self.request('/zones/point/', params)).render()
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(json.loads(response.content), json.loads(expected.content))
+        self.assertIn('Last-Modified', responses[0])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], responses[0]['ETag'])
+        self.assertEqual([response.status_code for response in rejected], [400, 400, 400])
+
+    def test_thread_driver_returns_connections(self):
+        """Соединения, открытые в потоках исполнителя, возвращаются в пул после ответа"""
+        in_use = connection.pool.stats()['in_use']
+        for _ in range(3):
+            async_to_sync(zones_point)(self.request('/zones/point/async/', {'longitude': 4.5, 'latitude': 1}))
+        self.assertEqual(connection.pool.stats()['in_use'], in_use)
+
+
+@override_settings(READ_REPLICAS={'REPLICAS': {'replica': 1}, 'CACHE_ALIAS': 'shared'})
+class ReplicaReads(SharedCacheFixture, ProviderFixture, TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        super().setUp()
+        self.create_zone('Квадрат', (0, 0, 10, 10))
+        self.client.force_login(self.vasya)
+        self.async_client.force_login(self.vasya)
+
+    def read_alias(self, action, cookies=None, user=None):
+        request = RequestFactory().get('/zones/')
+        request.COOKIES = cookies or {}
+        request.user = user or AnonymousUser()
+        return ZoneViewSet(action=action).get_read_alias(request)
+
+    def test_reads_are_routed_to_replica(self):
+        """Чтения list, retrieve и point идут на реплику, записи и прочие действия - в основную базу"""
+        self.assertEqual(self.read_alias('list'), 'replica')
+        self.assertIsNone(self.read_alias('export'))
+        # Тестовая реплика - зеркало основной базы на отдельном соединении: данные транзакции
+        # TestCase ей не видны, поэтому проверяется только маршрутизация запросов, а не ответ
+        with CaptureQueriesContext(connections['replica']) as replica, CaptureQueriesContext(connection) as primary:
+            response = self.client.get('/zones/point/', {'longitude': 5, 'latitude': 5})
+        self.assertEqual(response.status_code, 200)
+        zone_table = connection.ops.quote_name(Zone._meta.db_table)
+        self.assertTrue(any(zone_table in query['sql'] for query in replica.captured_queries))
+        self.assertFalse(any(zone_table in query['sql'] for query in primary.captured_queries))
+        router = ReplicaRouter()
+        self.assertEqual(router.db_for_write(Zone), 'default')
+        self.assertFalse(router.allow_migrate('replica', 'main'))
+
+    def test_client_reads_primary_after_write(self):
+        """После изменения клиент читает из основной базы: по cookie и по пользователю"""
+        response = self.client.post('/zones/', {
+            'name': 'Новая', 'provider': self.provider.pk, 'mpoly': 'SRID=4326;MULTIPOLYGON(((20 0, 30 0, 30 10, 20 10, 20 0)))',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        cookie = response.cookies[get_replica_config()['COOKIE_NAME']]
+        self.assertIsNone(self.read_alias('list', cookies={cookie.key: cookie.value}))
+        self.assertIsNone(self.read_alias('list', user=self.vasya))
+        self.assertEqual(self.read_alias('list'), 'replica')
+
+    async def test_client_reads_primary_after_async_write(self):
+        """Под ASGI закрепление после изменения работает так же"""
+        response = await self.async_client.post('/zones/', {
+            'name': 'Новая', 'provider': self.provider.pk, 'mpoly': 'SRID=4326;MULTIPOLYGON(((20 0, 30 0, 30 10, 20 10, 20 0)))',
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(get_replica_config()['COOKIE_NAME'], response.cookies)
+        self.assertIsNone(await sync_to_async(self.read_alias)('list', user=self.vasya))
+
+    def test_process_local_pin_cache_is_refused(self):
+        """Закрепление пользователей без cookie не работает на кэше отдельного процесса"""
+        with override_settings(READ_REPLICAS={'REPLICAS': {'replica': 1}, 'CACHE_ALIAS': 'default'}):
+            with self.assertRaises(ImproperlyConfigured):
+                self.read_alias('list', user=self.vasya)
+
+    @override_settings(ZONE_POINT_CACHE={'ENABLED': True, 'CACHE_ALIAS': 'shared', 'KEY_PREFIX': 'test-zone-point'})
+    def test_cached_point_reads_primary(self):
+        """С кэшем точек зоны в точке читаются из основной базы, чтобы не кэшировать данные реплики"""
+        self.assertIsNone(self.read_alias('point'))
+        self.assertEqual(self.read_alias('list'), 'replica')
+
+    @override_settings(READ_REPLICAS={'REPLICAS': {'replica': 1, 'other': 1}, 'SELECTION': 'latency', 'EXPLORE_RATE': 0})
+    def test_least_latency_selection(self):
+        """При выборе по задержке берется реплика с наименьшей сглаженной задержкой"""
+        selector = ReplicaSelector()
+        selector.observe('replica', 0.010, 0.5)
+        selector.observe('other', 0.002, 0.5)
+        self.assertEqual(selector.choose(), 'other')
+        selector.observe('other', 0.030, 0.5)
+        self.assertAlmostEqual(selector.latency('other'), 0.016)
+        self.assertEqual(selector.choose(), 'replica')
+
+
+class RequestMetricsTest(ProviderFixture, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_zone('Квадрат', (0, 0, 10, 10))
+        metrics_registry.reset()
+        self.client.force_login(self.vasya)
+        self.async_client.force_login(self.vasya)
+
+    def test_metrics_are_collected_per_action(self):
+        """Метрики копятся по действиям и отдаются в формате Prometheus только локально"""
+        self.assertEqual(self.client.get('/zones/point/', {'longitude': 5, 'latitude': 5}).status_code, 200)
+        text = self.client.get('/metrics/').content.decode()
+        labels = '{endpoint="zone-point",action="point",method="GET",status="200"}'
+        self.assertIn(f'api_requests_total{labels} 1', text)
+        queries = int(next(line for line in text.splitlines() if line.startswith(f'api_db_queries_total{labels}')).split()[-1])
+        self.assertGreater(queries, 0)
+        self.assertIn(f'api_request_duration_seconds_count{labels} 1', text)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 404)
+
+    async def test_metrics_in_async_chain(self):
+        """Под ASGI middleware остается асинхронным и считает запросы синхронных вьюх"""
+        self.assertTrue(asyncio.iscoroutinefunction(MetricsMiddleware(self.async_client.handler.get_response_async)))
+        response = await self.async_client.get('/zones/point/', {'longitude': 5, 'latitude': 5})
+        self.assertEqual(response.status_code, 200)
+        text = (await self.async_client.get('/metrics/')).content.decode()
+        labels = '{endpoint="zone-point",action="point",method="GET",status="200"}'
+        self.assertIn(f'api_requests_total{labels} 1', text)
+        queries = int(next(line for line in text.splitlines() if line.startswith(f'api_db_queries_total{labels}')).split()[-1])
+        self.assertGreater(queries, 0)
+
+    def test_metrics_access(self):
+        """С токеном метрики отдаются только по нему, за доверенным прокси проверяется адрес клиента"""
+        with override_settings(REQUEST_METRICS={'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics/').status_code, 404)
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer secret', REMOTE_ADDR='10.0.0.1').status_code, 200)
+        with override_settings(REQUEST_METRICS={'TRUSTED_PROXIES': ['10.0.0.2']}):
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='127.0.0.1').status_code, 200)
+            # Подставленный клиентом адрес левее реального не помогает
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.2', HTTP_X_FORWARDED_FOR='127.0.0.1, 10.0.0.1').status_code, 404)
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1', HTTP_X_FORWARDED_FOR='127.0.0.1').status_code, 404)
+
+    @override_settings(REQUEST_METRICS={'SLOW_REQUEST_MS': 0})
+    def test_serialization_time(self):
+        """Время сериализации ответа через сериалайзер попадает в метрики, ответ не меняется"""
+        zone = Zone.objects.get()
+        with self.assertLogs('main.metrics', 'WARNING') as logs:
+            response = self.client.get(f'/zones/{zone.pk}/')
+        self.assertEqual(response.json()['id'], zone.pk)
+        self.assertGreater(json.loads(logs.records[0].getMessage())['serialization_ms'], 0)
+
+    @override_settings(REQUEST_METRICS={'SLOW_REQUEST_MS': 0})
+    def test_fast_read_serialization_time(self):
+        """Время сборки ответа из values()-строк без сериалайзеров тоже учитывается как сериализация"""
+        with mock.patch.object(ZoneViewSet, 'fast_read', True), self.assertLogs('main.metrics', 'WARNING') as logs:
+            self.assertEqual(self.client.get('/zones/').status_code, 200)
+        self.assertGreater(json.loads(logs.records[0].getMessage())['serialization_ms'], 0)
+
+    def test_streaming_export_queries_are_counted(self):
+        """Запросы потоковой выгрузки выполняются при выдаче содержимого и попадают в метрики при закрытии ответа"""
+        response = self.client.get('/zones/export/')
+        labels = '{endpoint="zone-export",action="export",method="GET",status="200"}'
+        self.assertNotIn(f'api_requests_total{labels}', self.client.get('/metrics/').content.decode())
+        # Клиент тестов закрывает ответ, выдав содержимое
+        content = b''.join(response.streaming_content)
+        text = self.client.get('/metrics/').content.decode()
+        self.assertIn(f'api_requests_total{labels} 1', text)
+        queries = int(next(line for line in text.splitlines() if line.startswith(f'api_db_queries_total{labels}')).split()[-1])
+        self.assertGreater(queries, 0)
+        self.assertIn(f'api_response_bytes_total{labels} {len(content)}', text)
+
+    @override_settings(REQUEST_METRICS={'SLOW_REQUEST_MS': 0, 'SLOW_QUERIES_LOGGED': 2})
+    def test_slow_requests_are_logged_with_queries(self):
+        """Запрос дольше порога пишется в лог с самыми медленными SQL-запросами"""
+        with self.assertLogs('main.metrics', 'WARNING') as logs:
+            self.client.get('/zones/', {'provider': 1})
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['endpoint'], record['action']), ('zone-list', 'list'))
+        self.assertTrue(0 < len(record['slowest_queries']) <= 2)
+
+
+class FakeConnection:
+    closed = False
+    autocommit = True
+
+    def get_transaction_status(self):
+        return psycopg2_extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(SimpleTestCase):
+    def test_connections_are_reused_and_bounded(self):
+        """Пул переиспользует возвращенные соединения и не превышает MAX_SIZE"""
+        pool = ConnectionPool({'MAX_SIZE': 2, 'TIMEOUT': 0.05, 'HEALTH_CHECK': False})
+        first = pool.getconn(FakeConnection)
+        second = pool.getconn(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.getconn(FakeConnection)
+        pool.putconn(first)
+        self.assertIs(pool.getconn(FakeConnection), first)
+        second.closed = True
+        pool.putconn(second)
+        stats = pool.stats()
+        self.assertEqual((stats['size'], stats['in_use'], stats['created'], stats['checkouts'], stats['timeouts']), (1, 1, 2, 3, 1))
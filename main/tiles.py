@@ -0,0 +1,195 @@
+"""
+Векторные тайлы (Mapbox Vector Tiles) зон обслуживания для карт покрытия.
+
+Тайл собирается одним запросом к PostGIS (ST_TileEnvelope, ST_AsMVTGeom, ST_AsMVT):
+в слое zones по объекту на зону с атрибутами name, provider, provider_name, service_types
+(pk типов услуг через запятую), min_cost и max_cost.
+
+Готовые тайлы кэшируются в общем для всех процессов кэше (LocMemCache и DummyCache не
+допускаются: сброс в одном процессе не дошел бы до остальных). В ключ тайла, а через него
+и в ETag, входят версии всего кэша, уровня масштаба и самого тайла; изменение зоны меняет
+версии тайлов, задевающих ее прежний и новый охват, на каждом кэшируемом уровне, а если
+таких тайлов на уровне слишком много - версию всего уровня. Версия, которой нет в кэше
+(еще не задана или вытеснена), заменяется новой случайной, а не значением по умолчанию:
+иначе ключ вернулся бы к прежнему и отдал устаревший тайл, а клиент с прежним ETag получил
+бы ложный 304.
+"""
+import hashlib
+import math
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from main.cache import get_versions, shared_cache
+from main.models import Provider, Service, Zone
+
+
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+LAYER_NAME = 'zones'
+
+DEFAULTS = {
+    # Размер тайла во внутренних единицах MVT и запас по краю для отрисовки контуров
+    'EXTENT': 4096,
+    'BUFFER': 64,
+    'MAX_ZOOM': 22,
+}
+
+CACHE_DEFAULTS = {
+    'ENABLED': False,
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 3600,
+    # Кэшируются тайлы уровней не выше MAX_ZOOM
+    'MAX_ZOOM': 16,
+    # Если изменение зоны задевает на уровне больше тайлов, сбрасывается весь уровень
+    'MAX_TILES': 256,
+    'KEY_PREFIX': 'zone-tile',
+}
+
+# Предельная широта проекции Web Mercator
+MAX_LATITUDE = 85.0511287798
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'ZONE_TILES', {})}
+
+
+def get_cache_config():
+    return {**CACHE_DEFAULTS, **getattr(settings, 'ZONE_TILE_CACHE', {})}
+
+
+def tile_exists(z, x, y):
+    return 0 <= z <= get_config()['MAX_ZOOM'] and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_range(extent, z):
+    """
+    Диапазоны номеров тайлов уровня z ((x0, x1), (y0, y1)), задевающих охват в градусах,
+    с запасом в один тайл: контуры отрисовываются и в буфере соседних тайлов
+    """
+    xmin, ymin, xmax, ymax = extent
+    n = 2 ** z
+
+    def tile_x(longitude):
+        return min(n - 1, max(0, math.floor((longitude + 180) / 360 * n)))
+
+    def tile_y(latitude):
+        latitude = math.radians(min(MAX_LATITUDE, max(-MAX_LATITUDE, latitude)))
+        return min(n - 1, max(0, math.floor((1 - math.asinh(math.tan(latitude)) / math.pi) / 2 * n)))
+
+    return (
+        (max(0, tile_x(xmin) - 1), min(n - 1, tile_x(xmax) + 1)),
+        (max(0, tile_y(ymax) - 1), min(n - 1, tile_y(ymin) + 1)),
+    )
+
+
+def render_tile(queryset, z, x, y):
+    """
+    Тайл MVT с зонами из queryset (фильтры запроса), пересекающими тайл z/x/y
+    """
+    config = get_config()
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    srid = Zone._meta.get_field('mpoly').srid
+    params = [
+        z, x, y,
+        LAYER_NAME, config['EXTENT'],
+        config['EXTENT'], config['BUFFER'],
+        config['EXTENT'], config['BUFFER'],
+    ]
+    where = ''
+    if queryset.query.where:
+        subquery, subquery_params = queryset.values('pk').query.sql_with_params()
+        where = f'AND z.{qn("id")} IN ({subquery})'
+        params.extend(subquery_params)
+    sql = f"""
+        WITH bounds AS (SELECT ST_TileEnvelope(%s, %s, %s) AS geom)
+        SELECT ST_AsMVT(tile, %s, %s, 'geom', 'id') FROM (
+            SELECT z.{qn("id")} AS id, z.{qn("name")} AS name, z.{qn("provider_id")} AS provider, p.{qn("name")} AS provider_name,
+                s.service_types, s.min_cost, s.max_cost,
+                ST_AsMVTGeom(ST_Transform(z.{qn("mpoly")}, 3857), bounds.geom, %s, %s, true) AS geom
+            FROM {qn(Zone._meta.db_table)} z
+            JOIN {qn(Provider._meta.db_table)} p ON p.{qn("id")} = z.{qn("provider_id")}
+            CROSS JOIN bounds
+            LEFT JOIN LATERAL (
+                SELECT string_agg(DISTINCT {qn("service_type_id")}::text, ',') AS service_types,
+                    min({qn("cost")})::float8 AS min_cost, max({qn("cost")})::float8 AS max_cost
+                FROM {qn(Service._meta.db_table)} WHERE {qn("zone_id")} = z.{qn("id")}
+            ) s ON true
+            -- Отбор по индексу: охват тайла с буфером в СК зон
+            WHERE z.{qn("mpoly")} && ST_Transform(
+                ST_Expand(bounds.geom, (ST_XMax(bounds.geom) - ST_XMin(bounds.geom)) / %s * %s), {srid}
+            ) {where}
+        ) tile WHERE geom IS NOT NULL
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        tile = cursor.fetchone()[0]
+    return bytes(tile) if tile is not None else b''
+
+
+class TileCache:
+    """
+    Кэш готовых тайлов зон
+    """
+    @property
+    def config(self):
+        return get_cache_config()
+
+    @property
+    def enabled(self):
+        config = self.config
+        if config['ENABLED']:
+            shared_cache(config['CACHE_ALIAS'], 'ZONE_TILE_CACHE')
+        return config['ENABLED']
+
+    @property
+    def cache(self):
+        return caches[self.config['CACHE_ALIAS']]
+
+    def _key(self, *parts):
+        return ':'.join([self.config['KEY_PREFIX'], *map(str, parts)])
+
+    def cacheable(self, z):
+        return self.enabled and z <= self.config['MAX_ZOOM']
+
+    def key(self, z, x, y, query_params):
+        """
+        Ключ тайла с текущими версиями кэша, уровня и тайла; прочие параметры запроса (фильтры) - дайджестом
+        """
+        versions = get_versions(self.cache, [self._key('generation'), self._key('zoom', z), self._key('version', z, x, y)])
+        params = sorted((key, value) for key, values in query_params.lists() for value in values)
+        return self._key(
+            'tile', *versions, z, x, y,
+            hashlib.md5(repr(params).encode()).hexdigest(),
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, tile):
+        self.cache.set(key, tile, self.config['TIMEOUT'])
+
+    def invalidate_extent(self, extent):
+        """
+        Делает недействительными тайлы всех кэшируемых уровней, задевающие охват (xmin, ymin, xmax, ymax)
+        """
+        config = self.config
+        version = uuid.uuid4().hex
+        versions = {}
+        for z in range(config['MAX_ZOOM'] + 1):
+            (x0, x1), (y0, y1) = tile_range(extent, z)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > config['MAX_TILES']:
+                versions[self._key('zoom', z)] = version
+                continue
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    versions[self._key('version', z, x, y)] = version
+        self.cache.set_many(versions, None)
+
+    def invalidate_all(self):
+        self.cache.set(self._key('generation'), uuid.uuid4().hex, None)
+
+
+tile_cache = TileCache()
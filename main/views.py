@@ -1,15 +1,51 @@
+import hashlib
+
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.mixins import CreateModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.decorators import action
 from rest_framework.permissions import BasePermission, AllowAny, IsAuthenticated
-from main.models import Provider, Zone, Service
-from main.serializers import ZoneSerializerRead, ZoneSerializerWrite, ProviderSerializer, ServiceSerializerRead, ServiceSerializerWrite
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework import status
+from main.models import Provider, Zone, ZoneJob, Service, ServiceType, find_service_conflicts, raise_service_conflict, service_availability
+from main.serializers import ZoneSerializerRead, ZoneSerializerWrite, ZoneJobSerializer, ProviderSerializer, ServiceSerializerRead, ServiceSerializerWrite
+from main.spatial_index import zone_index
+from main.cache import point_cache
+from main.tiles import MVT_CONTENT_TYPE, render_tile, tile_cache, tile_exists
+from main.geometry import GeometryOptions, media_type_params
+from main.export import EXPORT_FORMATS, stream_zones
+from main.parsers import NDJSONParser
+from main.signals import services_changed_in_bulk
+from main.jobs import respond_async, submit
+from main.access import get_scope
+from main.metrics import MetricsMixin
+from main.conditional import ConditionalReadMixin
+from main.replicas import ReplicaReadMixin
+from main.fastread import availability_payloads, service_payloads, service_values, zone_payloads_from_rows, zone_values
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db.models import Max
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django_filters import rest_framework as filters
 from django.contrib.gis.geos import Point
 from django.utils.translation import gettext_lazy as _
 
 
 
+def query_point(query_params):
+    """
+    Обязательная точка запроса (долгота, широта)
+    """
+    try:
+        return float(query_params['longitude']), float(query_params['latitude'])
+    except (KeyError, ValueError):
+        raise ValidationError({'longitude': _('longitude and latitude are required numbers')})
+
+
 class IsManagerForNew(BasePermission):
     """
     Пользователь является менеджером поставщика для новой сущности
@@ -37,7 +73,7 @@ class CanUpdate(BasePermission):
     def has_object_permission(self, request, view, obj):
         return obj.can_update(request.user, request.data)
 
-class ZoneViewSet(ModelViewSet):
+class ZoneViewSet(MetricsMixin, ReplicaReadMixin, ConditionalReadMixin, ModelViewSet):
     """
     Вьюсет для работы с зонами обслуживания. 
     Для получения всех зон с услугами и поставщиками для конкретной точки
@@ -46,11 +82,87 @@ class ZoneViewSet(ModelViewSet):
     latitude - широта в градусах
     Пример ...zones/point?longitude=62.012122323&latitude=58.021312413
     Если широта и долгота не указаны, то выведет зоны на северном полюсе
+    При чтении зон геометрию можно упростить или исключить параметрами
+    geometry=full|bbox|none, simplify=<допуск>, precision=<знаков>,
+    формат геометрии - geometry_format=wkt|wkb|twkb либо Accept: application/json; geometry-format=twkb
     """
     serializer_class = ZoneSerializerRead
     queryset = Zone.objects.all()
     filter_backends = (filters.DjangoFilterBackend,)
     filterset_fields = ('services__service_type', 'provider', )
+    # Максимальное число точек в пакетном запросе points
+    max_batch_items = settings.ZONE_POINTS_BATCH_LIMIT
+    # Списки зон тяжелые из-за геометрии - страницы меньше, чем по умолчанию
+    page_size = 50
+    max_page_size = 500
+
+    # Ограничения запросов nearest и within
+    distance_lookup = settings.ZONE_DISTANCE_LOOKUP
+
+    # Действия, выводящие зоны через ZoneSerializerRead
+    read_actions = ['list', 'retrieve', 'point', 'points', 'nearest', 'within']
+    # Эти действия собирают ответ из values()-выборки без объектов сериалайзеров (main/fastread.py)
+    fast_read = settings.API_FAST_READ
+    fast_read_actions = ['list', 'point', 'nearest', 'within']
+    # ETag и Last-Modified: зоны (их updated_at меняется и с услугами), поставщики и типы услуг
+    conditional_actions = ('list', 'retrieve', 'point')
+    validator_aggregates = {
+        'updated': Max('updated_at'),
+        'providers_updated': Max('provider__updated_at'),
+        'service_types_updated': Max('services__service_type__updated_at'),
+    }
+
+    def get_geometry_options(self):
+        """
+        Параметры вывода геометрии из запроса (geometry, simplify, precision)
+        """
+        if not hasattr(self, '_geometry_options'):
+            # Формат геометрии можно запросить и параметром типа в Accept (application/json; geometry-format=twkb)
+            media_params = media_type_params(getattr(self.request, 'accepted_media_type', None))
+            self._geometry_options = GeometryOptions.from_query_params(self.request.query_params, media_params)
+        return self._geometry_options
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in self.read_actions:
+            if not self.use_fast_read():
+                # ZoneSerializerRead выводит поставщика и услуги с типами - загружаем их заранее,
+                # чтобы число запросов не зависело от числа зон
+                queryset = queryset.select_related('provider').prefetch_related('services__service_type')
+            queryset = self.get_geometry_options().apply(queryset)
+        return queryset
+
+    def get_validator_base_queryset(self):
+        # Без подгрузок и аннотаций геометрии
+        return self.queryset.all()
+
+    def use_fast_read(self):
+        return self.fast_read and self.action in self.fast_read_actions
+
+    def list(self, request, *args, **kwargs):
+        response = self.not_modified()
+        if response is not None:
+            return response
+        if not self.use_fast_read():
+            return super().list(request, *args, **kwargs)
+        # Зоны с поставщиками - одним запросом, услуги с типами - вторым
+        queryset = zone_values(self.filter_queryset(self.get_queryset()), self.get_geometry_options())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.build_payload(zone_payloads_from_rows, page))
+        return Response(self.build_payload(zone_payloads_from_rows, queryset))
+
+    def paginate_queryset(self, queryset):
+        # Ответы на запросы по точке - все найденные зоны без разбиения на страницы
+        if self.action in ('point', 'nearest', 'within'):
+            return None
+        return super().paginate_queryset(queryset)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action in self.read_actions:
+            context['geometry_options'] = self.get_geometry_options()
+        return context
 
     def get_serializer_class(self):        
         if self.action in ['destroy', 'partial_update', 'update', 'create']:
@@ -58,6 +170,28 @@ class ZoneViewSet(ModelViewSet):
         else:
             return ZoneSerializerRead
 
+    def create(self, request, *args, **kwargs):
+        if respond_async(request):
+            return self.deferred_response(submit(ZoneJob.CREATE, request.user, request.data))
+        return super().create(request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        if respond_async(request):
+            # Для проверки прав геометрия зоны не нужна
+            self.queryset = self.queryset.defer('mpoly')
+            action = ZoneJob.PARTIAL_UPDATE if kwargs.get('partial') else ZoneJob.UPDATE
+            return self.deferred_response(submit(action, request.user, request.data, self.get_object()))
+        return super().update(request, *args, **kwargs)
+
+    def deferred_response(self, job):
+        """
+        Ответ 202 на отложенную запись зоны: задание и его адрес
+        """
+        return Response(ZoneJobSerializer(job).data, status=status.HTTP_202_ACCEPTED, headers={
+            'Location': reverse('zonejob-detail', args=[job.pk], request=self.request),
+            'Preference-Applied': 'respond-async',
+        })
+
     def get_permissions(self):
         action = self.action
         if action == 'destroy':
@@ -82,13 +216,194 @@ class ZoneViewSet(ModelViewSet):
         """
         longitude = float(request.GET.get('longitude', '0'))
         latitude = float(request.GET.get('latitude', '90'))
-        print(longitude)
-        point = Point(longitude, latitude)
-        self.queryset = self.queryset.filter(mpoly__contains=point)
-        return super().list(request, *args, **kwargs)
+        cache_key = None
+        if point_cache.enabled:
+            # Ответ вычисляется и кэшируется для ближайшего узла сетки вместе с ETag и Last-Modified
+            longitude, latitude = point_cache.snap(longitude, latitude)
+            params = request.GET.copy()
+            # Формат из заголовка Accept тоже различает ответы
+            params['geometry_format'] = self.get_geometry_options().format
+            cache_key = point_cache.key(longitude, latitude, params)
+            cached = point_cache.get(cache_key)
+            if cached is not None:
+                data, validators = cached
+                return self.check_validators(validators) or Response(data)
+        # Если включен внутрипроцессный индекс, проверка вхождения выполняется в памяти
+        zone_ids = zone_index.lookup(longitude, latitude)
+        if zone_ids is None:
+            point = Point(longitude, latitude)
+            self.queryset = self.queryset.containing(point)
+        else:
+            self.queryset = self.queryset.filter(pk__in=zone_ids)
+        response = self.list(request, *args, **kwargs)
+        if cache_key is not None and response.status_code == status.HTTP_200_OK:
+            point_cache.set(cache_key, (response.data, self._validators))
+        return response
+
+    def get_read_alias(self, request):
+        # Ответ, прочитанный с отстающей реплики сразу после сброса кэша точек, остался бы
+        # в кэше до истечения TTL. С кэшем точки читаются из основной базы: промахи редки
+        if self.action == 'point' and point_cache.enabled:
+            return None
+        return super().get_read_alias(request)
+
+    @action(methods=['get',], detail=False)
+    def nearest(self, request, *args, **kwargs):
+        """
+        АПИ для получения k ближайших к точке зон по возрастанию расстояния.
+        Параметры: longitude, latitude - точка в градусах, k - число зон (по умолчанию 10).
+        Поддерживает фильтры services__service_type и provider и параметры геометрии.
+        У каждой зоны есть поле distance - расстояние до точки в метрах (0, если зона содержит точку)
+        """
+        longitude, latitude = query_point(self.request.query_params)
+        k = self._query_number('k', int, self.distance_lookup['DEFAULT_K'], 1, self.distance_lookup['MAX_K'])
+        distances = self.filter_queryset(self.queryset.all()).nearest(longitude, latitude, k)
+        return self._distance_response(request, distances)
+
+    @action(methods=['get',], detail=False)
+    def within(self, request, *args, **kwargs):
+        """
+        АПИ для получения зон не дальше radius метров от точки по возрастанию расстояния.
+        Параметры: longitude, latitude - точка в градусах, radius - радиус в метрах.
+        Поддерживает фильтры services__service_type и provider и параметры геометрии.
+        У каждой зоны есть поле distance - расстояние до точки в метрах
+        """
+        longitude, latitude = query_point(self.request.query_params)
+        radius = self._query_number('radius', float, None, 0, self.distance_lookup['MAX_RADIUS'], exclusive_minimum=True)
+        distances = self.filter_queryset(self.queryset.all()).within_distance(
+            longitude, latitude, radius, self.distance_lookup['MAX_RESULTS'],
+        )
+        return self._distance_response(request, distances)
+
+    def _distance_response(self, request, distances):
+        """
+        Зоны из пар (pk, расстояние) в их порядке с полем distance
+        """
+        self.queryset = self.queryset.filter(pk__in=[pk for pk, _ in distances])
+        zones = {zone['id']: zone for zone in self.list(request).data}
+        return Response([{**zones[pk], 'distance': distance} for pk, distance in distances if pk in zones])
+
+    def _query_number(self, name, type_, default, minimum, maximum, exclusive_minimum=False):
+        """
+        Числовой параметр запроса в пределах [minimum, maximum] ((minimum, maximum] при exclusive_minimum);
+        без значения по умолчанию - обязательный
+        """
+        value = self.request.query_params.get(name)
+        if value is None and default is not None:
+            return default
+        try:
+            value = type_(value)
+        except (TypeError, ValueError):
+            value = None
+        limits = {'min': minimum, 'max': maximum}
+        if exclusive_minimum:
+            if value is None or not minimum < value <= maximum:
+                raise ValidationError({name: _('Expected a number greater than %(min)s and not greater than %(max)s') % limits})
+        elif value is None or not minimum <= value <= maximum:
+            raise ValidationError({name: _('Expected a number from %(min)s to %(max)s') % limits})
+        return value
+
+    def tiles(self, request, z, x, y, *args, **kwargs):
+        """
+        АПИ векторных тайлов зон для карт покрытия: zones/tiles/<z>/<x>/<y>.mvt (Mapbox Vector Tile).
+        Поддерживает фильтры списка services__service_type и provider.
+        Тайлы кэшируются (ZONE_TILE_CACHE) и сбрасываются при изменении зон в их охвате
+        """
+        if not tile_exists(z, x, y):
+            raise NotFound(_('Tile does not exist'))
+        tile = cache_key = None
+        if tile_cache.cacheable(z):
+            cache_key = tile_cache.key(z, x, y, request.GET)
+            # В ключ входят версии кэша и уровня, поэтому он же служит ETag
+            not_modified = self.check_validators(('W/"%s"' % hashlib.md5(cache_key.encode()).hexdigest(), None))
+            if not_modified is not None:
+                return not_modified
+            tile = tile_cache.get(cache_key)
+        if tile is None:
+            tile = render_tile(self.filter_queryset(self.queryset.all()), z, x, y)
+            if cache_key is not None:
+                tile_cache.set(cache_key, tile)
+        return HttpResponse(tile, content_type=MVT_CONTENT_TYPE)
+
+    @action(methods=['get',], detail=False)
+    def export(self, request, *args, **kwargs):
+        """
+        АПИ для потоковой выгрузки зон с услугами.
+        output=ndjson (по умолчанию) - по объекту GeoJSON Feature на строку,
+        output=geojson - FeatureCollection.
+        Поддерживает фильтры списка и параметры геометрии geometry, simplify, precision
+        """
+        fmt = request.query_params.get('output', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            raise ValidationError({'output': _('Expected one of: %(formats)s') % {'formats': ', '.join(EXPORT_FORMATS)}})
+        queryset = self.filter_queryset(self.get_queryset())
+        content = stream_zones(queryset, self.get_geometry_options(), fmt, settings.ZONE_EXPORT_CHUNK_SIZE)
+        return StreamingHttpResponse(content, content_type=EXPORT_FORMATS[fmt])
+
+    @action(methods=['post',], detail=False, permission_classes=[AllowAny,], parser_classes=[JSONParser, NDJSONParser])
+    def points(self, request, *args, **kwargs):
+        """
+        АПИ для пакетного получения зон по множеству точек за один запрос.
+        Тело запроса - JSON {"points": [[долгота, широта], ...]}, JSON-список точек
+        либо NDJSON (application/x-ndjson) по одной точке на строку.
+        Точка задается парой [долгота, широта] или объектом {"longitude": ..., "latitude": ...}.
+        Фильтры services__service_type и provider применяются ко всем точкам.
+        Ответ - список {"longitude", "latitude", "zones"} в порядке входных точек
+        """
+        data = request.data
+        if isinstance(data, dict):
+            data = data.get('points')
+        if not isinstance(data, list):
+            raise ValidationError({'points': _('Expected a list of points')})
+        if len(data) > self.max_batch_items:
+            raise ValidationError({'points': _('Too many points, the limit is %(limit)s') % {'limit': self.max_batch_items}})
+        points = [self._parse_point(item) for item in data]
+
+        queryset = self.filter_queryset(self.get_queryset())
+        zone_ids = None
+        if zone_index.enabled and zone_index.warm and not queryset.query.where:
+            zone_ids = [zone_index.lookup(longitude, latitude) for longitude, latitude in points]
+            # Индекс могли сбросить посреди цикла (изменение зон) - тогда все точки ищутся в базе
+            if None in zone_ids:
+                zone_ids = None
+        if zone_ids is None:
+            zone_ids = queryset.ids_by_points(points)
 
+        zones = self.get_queryset().filter(pk__in={pk for ids in zone_ids for pk in ids})
+        serialized = {zone['id']: zone for zone in self.get_serializer(zones, many=True).data}
+        return Response([
+            {'longitude': longitude, 'latitude': latitude, 'zones': [serialized[pk] for pk in ids]}
+            for (longitude, latitude), ids in zip(points, zone_ids)
+        ])
 
-class ProviderViewSet(ModelViewSet):
+    @staticmethod
+    def _parse_point(item):
+        """
+        Приводит точку из тела запроса к паре (долгота, широта)
+        """
+        try:
+            if isinstance(item, dict):
+                longitude, latitude = item['longitude'], item['latitude']
+            else:
+                longitude, latitude = item
+            return float(longitude), float(latitude)
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError({'points': _('Invalid point: %(point)s') % {'point': item}})
+
+
+class ZoneJobViewSet(MetricsMixin, ReadOnlyModelViewSet):
+    """
+    Вьюсет заданий отложенной записи зон: состояние и ошибки. Пользователь видит только свои задания
+    """
+    serializer_class = ZoneJobSerializer
+    queryset = ZoneJob.objects.all()
+    permission_classes = [IsAuthenticated,]
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
+
+
+class ProviderViewSet(MetricsMixin, ReplicaReadMixin, ConditionalReadMixin, ModelViewSet):
     """
     Вьюсет для работы с поставщиками.
     При создании и обновлении поставщика полю manager автоматически присваивается пользователь
@@ -96,6 +411,9 @@ class ProviderViewSet(ModelViewSet):
     """
     serializer_class = ProviderSerializer
     queryset = Provider.objects.all()
+    validator_aggregates = {'updated': Max('updated_at')}
+    # Список - только поставщики пользователя
+    validators_vary_by_user = True
 
     def get_queryset(self):
         if self.action in ['list', 'retrieve']:
@@ -119,12 +437,38 @@ class ProviderViewSet(ModelViewSet):
             serializer.context['manager'] = self.request.user
         return serializer
 
-class ServiceViewSet(ReadOnlyModelViewSet, DestroyModelMixin, CreateModelMixin, UpdateModelMixin):
+class ServiceViewSet(MetricsMixin, ReplicaReadMixin, ConditionalReadMixin, ReadOnlyModelViewSet, DestroyModelMixin, CreateModelMixin, UpdateModelMixin):
     """
     Вьюсет для работы с Услугами. Возможно просмотреть, создать и удалить  услугу
     """
     serializer_class = ServiceSerializerRead
     queryset = Service.objects.all()
+    # Максимальное число услуг в пакетном запросе bulk
+    max_batch_items = settings.SERVICE_BULK_LIMIT
+    # list собирает ответ из values()-выборки без объектов сериалайзеров (main/fastread.py)
+    fast_read = settings.API_FAST_READ
+    validator_aggregates = {
+        'updated': Max('updated_at'),
+        'service_types_updated': Max('service_type__updated_at'),
+    }
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ['list', 'retrieve']:
+            queryset = queryset.select_related('service_type')
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        response = self.not_modified()
+        if response is not None:
+            return response
+        if not self.fast_read:
+            return super().list(request, *args, **kwargs)
+        queryset = service_values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.build_payload(service_payloads, page))
+        return Response(self.build_payload(service_payloads, queryset))
 
     def get_serializer_class(self):
         if self.action in ['list', 'retrieve']:
@@ -143,3 +487,146 @@ class ServiceViewSet(ReadOnlyModelViewSet, DestroyModelMixin, CreateModelMixin,
         else:
             permission_classes = [IsAuthenticated,]
         return [permission() for permission in permission_classes]
+
+    @action(methods=['get',], detail=False)
+    def availability(self, request, *args, **kwargs):
+        """
+        АПИ доступности услуг в точке: какие типы услуг оказываются в точке и почем.
+        Параметры: longitude, latitude - точка в градусах, service_type - pk типа услуги (необязательно).
+        Без service_type - список по всем типам услуг в точке, с ним - один объект с полем available.
+        Ответ строится одним запросом по таблице покрытия (SERVICE_COVERAGE), зоны и услуги не загружаются
+        """
+        longitude, latitude = query_point(request.query_params)
+        service_type = request.query_params.get('service_type')
+        if service_type is not None:
+            try:
+                service_type = int(service_type)
+            except ValueError:
+                raise ValidationError({'service_type': _('Expected a service type id')})
+        rows = self.build_payload(availability_payloads, service_availability(Point(longitude, latitude), service_type))
+        if service_type is None:
+            return Response(rows)
+        if rows:
+            return Response({**rows[0], 'available': True})
+        return Response({
+            'service_type': service_type, 'available': False,
+            'min_cost': None, 'max_cost': None, 'providers': [], 'zones': [],
+        })
+
+    @action(methods=['post', 'patch'], detail=False)
+    def bulk(self, request, *args, **kwargs):
+        """
+        АПИ для пакетного создания (POST) и изменения (PATCH) услуг. Тело запроса - JSON-список услуг;
+        при изменении у каждой услуги обязателен id, остальные поля передаются только изменяемые.
+        Права проверяются один раз для каждой зоны, пересечения - одним запросом
+        для всего пакета, включая пересечения услуг пакета между собой.
+        Услуги сохраняются в одной транзакции: если хотя бы одна услуга не прошла проверку,
+        ничего не сохраняется и возвращается 400 со списком ошибок по каждой услуге
+        """
+        data = request.data
+        if not isinstance(data, list):
+            raise ValidationError(_('Expected a list of services'))
+        if len(data) > self.max_batch_items:
+            raise ValidationError(_('Too many services, the limit is %(limit)s') % {'limit': self.max_batch_items})
+        updating = request.method == 'PATCH'
+        errors = [{} for _item in data]
+        instances = [None] * len(data)
+        if updating:
+            self._load_bulk_instances(data, instances, errors)
+
+        # Зоны и типы услуг всего пакета загружаем заранее двумя запросами
+        zones = Zone.objects.defer('mpoly').in_bulk(self._item_pks(data, 'zone'))
+        service_types = ServiceType.objects.in_bulk(self._item_pks(data, 'service_type'))
+        managed_providers = get_scope(request.user).provider_ids
+        context = {
+            **self.get_serializer_context(),
+            'preloaded': {Zone: zones, ServiceType: service_types},
+            'check_overlaps': False,
+        }
+
+        item_serializers = []
+        candidates = {}
+        for i, (item, instance) in enumerate(zip(data, instances)):
+            serializer = ServiceSerializerWrite(instance, data=item, partial=updating, context=context)
+            item_serializers.append(serializer)
+            if errors[i]:
+                continue
+            if not serializer.is_valid():
+                errors[i] = serializer.errors
+                continue
+            validated = serializer.validated_data
+            zone = validated.get('zone', getattr(instance, 'zone', None))
+            if instance is not None and instance.zone.provider_id not in managed_providers:
+                errors[i] = {'id': [IsObjectManager.message]}
+            elif zone.provider_id not in managed_providers:
+                errors[i] = {'zone': [IsManagerForNew.message]}
+            else:
+                service_type_id = validated['service_type'].pk if 'service_type' in validated else instance.service_type_id
+                candidates[i] = (zone.pk, service_type_id, getattr(instance, 'pk', None))
+
+        # Проверка пересечений и запись - в одной транзакции
+        with transaction.atomic():
+            conflicts = find_service_conflicts(
+                list(candidates.values()), within_batch=True,
+                replaced_ids=[instance.pk for instance in instances if instance is not None],
+            )
+            for i, zone_names in zip(candidates, conflicts):
+                if zone_names:
+                    try:
+                        raise_service_conflict(zone_names)
+                    except DjangoValidationError as e:
+                        errors[i] = e.message_dict
+            if any(errors):
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+
+            if updating:
+                zone_ids = {instance.zone_id for instance in instances}
+                fields = {'updated_at'}
+                now = timezone.now()
+                for serializer, instance in zip(item_serializers, instances):
+                    for field, value in serializer.validated_data.items():
+                        setattr(instance, field, value)
+                        fields.add(field)
+                    # bulk_update не заполняет auto_now
+                    instance.updated_at = now
+                Service.objects.bulk_update(instances, sorted(fields))
+                services, response_status = instances, status.HTTP_200_OK
+            else:
+                services = Service.objects.bulk_create([Service(**serializer.validated_data) for serializer in item_serializers])
+                zone_ids, response_status = set(), status.HTTP_201_CREATED
+            services_changed_in_bulk(zone_ids | {service.zone_id for service in services})
+        return Response(ServiceSerializerWrite(services, many=True).data, status=response_status)
+
+    @staticmethod
+    def _load_bulk_instances(data, instances, errors):
+        """
+        Изменяемые услуги пакета одним запросом (с зонами без геометрии); ошибки id - в errors
+        """
+        services = Service.objects.select_related('zone').defer('zone__mpoly').in_bulk(ServiceViewSet._item_pks(data, 'id'))
+        seen = set()
+        for i, item in enumerate(data):
+            try:
+                pk = int(item['id'])
+            except (KeyError, TypeError, ValueError):
+                errors[i] = {'id': [_('This field is required.')]}
+                continue
+            if pk not in services:
+                errors[i] = {'id': [_('Service does not exist')]}
+            elif pk in seen:
+                errors[i] = {'id': [_('Service is repeated in the batch')]}
+            else:
+                instances[i] = services[pk]
+            seen.add(pk)
+
+    @staticmethod
+    def _item_pks(data, field):
+        """
+        Целочисленные значения поля field из элементов пакета; некорректные отловит сериалайзер
+        """
+        pks = set()
+        for item in data:
+            try:
+                pks.add(int(item[field]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return pks